@@ -1,14 +1,38 @@
 import os
+import re
+import csv
+import json
+import gzip
+import zlib
+import functools
+import itertools
+import logging
+import cProfile
+import pstats
 import pandas as pd
-from flask import Flask, jsonify, request, send_file, render_template
+from flask import Flask, jsonify, request, send_file, render_template, g, Response
 from flask_cors import CORS
 import datetime
 import numpy as np
 import sqlite3
-from io import BytesIO
+import threading
+import time
+import uuid
+import hashlib
+import multiprocessing
+import queue
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from difflib import SequenceMatcher
+from io import StringIO, TextIOWrapper
 import openpyxl
 from openpyxl.styles import Font
+from openpyxl.formatting.rule import CellIsRule
 from openpyxl.utils import get_column_letter
+import erp_import
+import erp_snapshot
+import metrics
 
 # --- Configuración de Archivos y Columnas ---
 APP_ROOT = os.path.dirname(os.path.abspath(__file__))
@@ -16,6 +40,7 @@ DATABASE_FOLDER = os.path.join(APP_ROOT, 'databases')
 ITEM_MASTER_CSV_PATH = os.path.join(DATABASE_FOLDER, 'AURRSGLBD0250 - Item Stockroom Balance.csv')
 GRN_CSV_FILE_PATH = os.path.join(DATABASE_FOLDER, 'AURRSGLBD0280 - Stock In Goods Inwards And Inspection.csv')
 DB_FILE_PATH = os.path.join(APP_ROOT, 'inbound_log.db')
+LOG_ARCHIVE_DB_PATH = os.path.join(APP_ROOT, 'inbound_log_archive.db')
 
 COLUMNS_TO_READ_MASTER = [
     'Item_Code', 'Item_Description', 'Weight_per_Unit',
@@ -24,54 +49,778 @@ COLUMNS_TO_READ_MASTER = [
 GRN_COLUMN_NAME_IN_CSV = 'GRN_Number' 
 COLUMNS_TO_READ_GRN = [GRN_COLUMN_NAME_IN_CSV, 'Item_Code', 'Quantity']
 
+# --- Logging y diagnóstico ---
+# INBOUND_LOG_LEVEL controla el detalle (DEBUG vuelca los payloads de add_log/update_log).
+# INBOUND_PROFILE=1 activa cProfile por petición (opcionalmente solo para los endpoints de
+# INBOUND_PROFILE_ENDPOINTS, separados por comas); los .prof se guardan en 'profiles'.
+LOG_LEVEL = os.environ.get('INBOUND_LOG_LEVEL', 'INFO').upper()
+PROFILE_REQUESTS = os.environ.get('INBOUND_PROFILE', '').lower() in ('1', 'true', 'yes', 'on')
+PROFILE_ENDPOINTS = {name.strip() for name in os.environ.get('INBOUND_PROFILE_ENDPOINTS', '').split(',') if name.strip()}
+PROFILES_FOLDER = os.path.join(APP_ROOT, 'profiles')
+
+logger = logging.getLogger('inbound')
+if not logger.handlers:
+    _log_handler = logging.StreamHandler()
+    _log_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s [%(threadName)s] %(name)s: %(message)s'))
+    logger.addHandler(_log_handler)
+    logger.propagate = False
+logger.setLevel(LOG_LEVEL)
+
+metrics.describe('inbound_http_request_duration_seconds', 'histogram', 'Latencia de las peticiones HTTP por endpoint.')
+metrics.describe('inbound_http_requests_total', 'counter', 'Peticiones HTTP por endpoint y código de estado.')
+metrics.describe('inbound_csv_cache_lookups_total', 'counter', 'Búsquedas en los índices en memoria del ERP (hit/miss).')
+metrics.describe('inbound_csv_cache_loads_total', 'counter', '(Re)construcciones de los índices en memoria del ERP.')
+metrics.describe('inbound_csv_cache_rows_loaded_total', 'counter', 'Filas leídas al (re)construir los índices del ERP.')
+metrics.describe('inbound_csv_cache_rows', 'gauge', 'Filas del archivo del ERP cargado en el índice.')
+metrics.describe('inbound_csv_cache_keys', 'gauge', 'Claves en el índice en memoria.')
+metrics.describe('inbound_csv_cache_load_seconds', 'gauge', 'Duración de la última carga del índice.')
+metrics.describe('inbound_erp_imports_total', 'counter', 'Importaciones de los CSV del ERP por modo (full, delta, rejected).')
+metrics.describe('inbound_log_writer_group_requests', 'histogram', 'Peticiones de escritura agrupadas en cada COMMIT del escritor de logs.')
+metrics.describe('inbound_db_rows_read_total', 'counter', 'Filas leídas de SQLite por consulta.')
+metrics.describe('inbound_db_write_wait_seconds', 'histogram', 'Espera para obtener el bloqueo de escritura de SQLite.')
+metrics.describe('inbound_db_commit_seconds', 'histogram', 'Duración de los COMMIT de SQLite.')
+metrics.describe('inbound_db_busy_retries_total', 'counter', 'Reintentos por base de datos ocupada (SQLITE_BUSY).')
+metrics.describe('inbound_db_write_errors_total', 'counter', 'Transacciones de escritura fallidas.')
+metrics.describe('inbound_db_connections_opened', 'gauge', 'Conexiones SQLite abiertas por los hilos del proceso.')
+metrics.describe('inbound_log_stream_clients', 'gauge', 'Clientes conectados a /api/log_stream.')
+metrics.describe('inbound_log_stream_events_total', 'counter', 'Eventos enviados por /api/log_stream.')
+metrics.describe('inbound_log_import_rows_total', 'counter', 'Filas de /api/import_log por resultado (imported, replayed, rejected).')
+metrics.describe('inbound_idempotent_replays_total', 'counter', 'Escaneos reenviados con una clave ya guardada (no se insertan de nuevo).')
+metrics.describe('inbound_log_archived_rows_total', 'counter', 'Filas de logs movidas al archivo mensual.')
+metrics.describe('inbound_http_not_modified_total', 'counter', 'Respuestas 304 servidas tras la comprobación de versión (sin consultar datos).')
+metrics.describe('inbound_http_compressed_bytes_total', 'counter', 'Bytes de las respuestas comprimidas, antes (original) y después (sent).')
+metrics.describe('inbound_export_jobs_total', 'counter', 'Exportaciones por tipo y resultado (hit = archivo reutilizado, done, empty, error).')
+metrics.describe('inbound_export_build_seconds', 'histogram', 'Duración de la generación de cada libro Excel.')
+
 app = Flask(__name__, template_folder='templates', static_folder='static')
 CORS(app)
 
-# --- Funciones de Manejo de CSV ---
-def read_csv_safe(file_path, columns=None):
-    if not os.path.exists(file_path):
-        print(f"Error CSV: Archivo no encontrado en {file_path}")
+# --- Instrumentación de peticiones ---
+# Latencia y código de estado por endpoint; con INBOUND_PROFILE se perfila una
+# petición a la vez (las concurrentes se atienden sin perfilar).
+_profile_lock = threading.Lock()
+
+def _should_profile_request():
+    if not PROFILE_REQUESTS: return False
+    return not PROFILE_ENDPOINTS or request.endpoint in PROFILE_ENDPOINTS
+
+def _finish_request_profile():
+    profiler = g.pop('profiler', None)
+    if profiler is None: return
+    try:
+        profiler.disable()
+        os.makedirs(PROFILES_FOLDER, exist_ok=True)
+        timestamp_str = datetime.datetime.now().strftime("%Y%m%d_%H%M%S_%f")
+        profile_path = os.path.join(PROFILES_FOLDER, f"{request.endpoint or 'unknown'}_{timestamp_str}.prof")
+        profiler.dump_stats(profile_path)
+        if logger.isEnabledFor(logging.DEBUG):
+            summary = StringIO()
+            pstats.Stats(profiler, stream=summary).sort_stats('cumulative').print_stats(15)
+            logger.debug("Perfil %s %s:\n%s", request.method, request.path, summary.getvalue())
+        logger.info("Perfil de %s %s guardado en %s", request.method, request.path, profile_path)
+    except OSError as e:
+        logger.error("No se pudo guardar el perfil de %s: %s", request.path, e)
+    finally:
+        _profile_lock.release()
+
+@app.before_request
+def _start_request_instrumentation():
+    g.request_start = time.perf_counter()
+    if _should_profile_request() and _profile_lock.acquire(blocking=False):
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+
+@app.after_request
+def _record_request_metrics(response):
+    endpoint = request.endpoint or 'not_found'
+    start = g.get('request_start')
+    if start is not None:
+        metrics.observe('inbound_http_request_duration_seconds', time.perf_counter() - start, {'endpoint': endpoint})
+    metrics.inc('inbound_http_requests_total', {'endpoint': endpoint, 'status': response.status_code})
+    _finish_request_profile()
+    return response
+
+@app.teardown_request
+def _teardown_request_instrumentation(exc):
+    # after_request no corre si la vista lanzó una excepción: liberar aquí el perfilador
+    _finish_request_profile()
+
+# --- Respuestas comprimidas y validadores (ETag / Last-Modified) ---
+# Los endpoints de lectura frecuente calculan primero una versión barata de sus datos
+# (máximos por índice, firmas de los CSV) y responden 304 si el cliente ya la tiene; solo
+# si cambió leen los datos. @compressed_response comprime con gzip o deflate según
+# Accept-Encoding. Un ETag fuerte se vuelve débil al comprimir (el cuerpo enviado ya no es
+# el mismo byte a byte); If-None-Match en GET compara en modo débil, así que sigue valiendo.
+COMPRESS_MIN_BYTES = 1024     # Por debajo, la cabecera gzip y la CPU no compensan
+COMPRESS_LEVEL = 5
+
+def _http_datetime(value):
+    # Fecha HTTP (UTC, sin fracciones) desde un timestamp ISO local del log o un mtime en ns
+    if value is None: return None
+    if isinstance(value, int):
+        moment = datetime.datetime.fromtimestamp(value / 1e9, tz=datetime.timezone.utc)
+    else:
+        moment = datetime.datetime.fromisoformat(value).astimezone(datetime.timezone.utc)
+    return moment.replace(microsecond=0)
+
+def make_version_etag(*parts):
+    return hashlib.sha1('|'.join(str(part) for part in parts).encode('utf-8')).hexdigest()[:24]
+
+def not_modified_response(etag, last_modified=None):
+    """Devuelve un 304 si el cliente ya tiene la versión (etag, last_modified); si no, None.
+
+    If-None-Match manda sobre If-Modified-Since cuando vienen ambos (RFC 9110).
+    """
+    if request.if_none_match:
+        matched = request.if_none_match.contains_weak(etag)
+    elif request.if_modified_since and last_modified is not None:
+        matched = last_modified <= request.if_modified_since
+    else:
+        matched = False
+    if not matched: return None
+    metrics.inc('inbound_http_not_modified_total', {'endpoint': request.endpoint})
+    return set_validators(Response(status=304), etag, last_modified)
+
+def set_validators(response, etag, last_modified=None):
+    response.set_etag(etag, weak=True)
+    if last_modified is not None: response.last_modified = last_modified
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+def _negotiate_encoding():
+    accepted = request.accept_encodings
+    for encoding in ('gzip', 'deflate'):
+        if accepted[encoding] > 0: return encoding  # Quality 0 o ausente: no aceptado
+    return None
+
+def compress_response(response):
+    response.vary.add('Accept-Encoding')
+    if (response.status_code != 200 or response.direct_passthrough or response.is_streamed
+            or 'Content-Encoding' in response.headers):
+        return response
+    encoding = _negotiate_encoding()
+    if encoding is None: return response
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN_BYTES: return response
+    if encoding == 'gzip':
+        body = gzip.compress(data, compresslevel=COMPRESS_LEVEL, mtime=0)
+    else:
+        body = zlib.compress(data, COMPRESS_LEVEL)  # "deflate" en HTTP es el formato zlib
+    response.set_data(body)
+    response.headers['Content-Encoding'] = encoding
+    etag, weak = response.get_etag()
+    if etag and not weak: response.set_etag(etag, weak=True)
+    metrics.inc('inbound_http_compressed_bytes_total', {'stage': 'original'}, len(data))
+    metrics.inc('inbound_http_compressed_bytes_total', {'stage': 'sent'}, len(body))
+    return response
+
+def compressed_response(view):
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        return compress_response(app.make_response(view(*args, **kwargs)))
+    return wrapper
+
+def json_response(body_text, status=200):
+    # Para cuerpos JSON ya serializados (p. ej. armados por SQLite), sin pasar por jsonify
+    return Response(body_text, status=status, mimetype='application/json')
+
+# --- Caché en memoria de los CSV del ERP ---
+# Cada caché guarda un índice ya construido y la firma (mtime, tamaño) del archivo
+# del que salió. Si la firma cambia, el CSV se reimporta a su tabla SQLite (ver
+# erp_import.py), el índice se reconstruye desde esa tabla en un hilo de fondo y
+# se reemplaza de una sola vez: las peticiones en curso siguen usando el anterior.
+# El índice es una instantánea columnar mapeada en memoria (ver erp_snapshot.py),
+# así que reiniciar el proceso no vuelve a recorrer la tabla.
+# El ERP deja copias nuevas de los CSV varias veces al día: una recarga espera a que el
+# archivo deje de cambiar y erp_import lo verifica y aplica solo las filas que cambiaron;
+# el índice cargado recibe esas filas encima de su instantánea (ver _load_erp_snapshot).
+# Un CSV rechazado solo por traer muchas menos filas que la importación anterior se acepta si
+# sigue igual durante ERP_SMALLER_FILE_CYCLES revisiones del vigilante: una copia truncada la
+# reemplaza la siguiente exportación, una exportación legítimamente más chica se queda.
+SNAPSHOTS_FOLDER = os.path.join(DATABASE_FOLDER, 'snapshots')
+ERP_FILE_SETTLE_SECONDS = float(os.environ.get('INBOUND_ERP_SETTLE_SECONDS', '3'))
+ERP_FILE_SETTLE_TIMEOUT_SECONDS = 300
+ERP_MIN_ROW_RATIO = float(os.environ.get('INBOUND_ERP_MIN_ROW_RATIO', str(erp_import.MIN_ROW_RATIO)))
+ERP_SNAPSHOT_MAX_CHANGES = int(os.environ.get('INBOUND_ERP_SNAPSHOT_MAX_CHANGES', '50000'))  # Luego se reescribe completa
+ERP_WATCH_INTERVAL_SECONDS = 30
+ERP_SMALLER_FILE_CYCLES = int(os.environ.get('INBOUND_ERP_SMALLER_FILE_CYCLES', '10'))
+def _file_signature(file_path):
+    try:
+        stat_result = os.stat(file_path)
+    except OSError:
         return None
+    return (stat_result.st_mtime_ns, stat_result.st_size)
+
+def _new_csv_cache(name, file_path, import_table, build_index):
+    return {
+        'name': name, 'file_path': file_path, 'import_table': import_table, 'build_index': build_index,
+        'lock': threading.Lock(), 'load_lock': threading.Lock(),
+        'index': None, 'signature': None, 'failed_signature': None, 'reloading': False,
+        'row_count': 0, 'key_count': 0, 'malformed_count': 0, 'load_seconds': None, 'loaded_at': None,
+        'import_mode': None, 'changed_rows': None, 'source_sha1': None,
+        'rejection': None, 'accepted_smaller_signature': None,
+    }
+
+def _load_csv_cache(cache):
+    with cache['load_lock']:
+        signature = _file_signature(cache['file_path'])
+        if cache['index'] is not None and signature == cache['signature']:
+            return
+        start = time.perf_counter()
+        accept_smaller = signature is not None and signature == cache['accepted_smaller_signature']
+        import_info = cache['import_table'](min_row_ratio=None if accept_smaller else ERP_MIN_ROW_RATIO)
+        if import_info is None:
+            metrics.inc('inbound_erp_imports_total', {'cache': cache['name'], 'mode': 'rejected'})
+            cache['failed_signature'] = signature
+            rejection = erp_import.get_rejection(cache['file_path'])
+            cache['rejection'] = dict(rejection, unchanged_cycles=0) if rejection else None
+            return
+        cache['rejection'] = None
+        if not import_info['skipped']:
+            metrics.inc('inbound_erp_imports_total', {'cache': cache['name'], 'mode': import_info['import_mode']})
+        elif cache['index'] is not None and import_info['source_sha1'] == cache['source_sha1']:
+            # Mismo contenido (archivo tocado o copiado de nuevo): el índice cargado sigue valiendo
+            cache['signature'] = (import_info['source_mtime_ns'], import_info['source_size'])
+            cache['failed_signature'] = None
+            logger.info("Caché CSV (%s): contenido sin cambios; se conserva el índice", cache['name'])
+            return
+        try:
+            # Un solo proceso escribe la instantánea; los demás esperan y la abren ya hecha
+            os.makedirs(SNAPSHOTS_FOLDER, exist_ok=True)
+            with erp_import.interprocess_lock(os.path.join(SNAPSHOTS_FOLDER, f"{cache['name']}.lock")):
+                index = cache['build_index'](get_db_connection(), import_info)
+        except (sqlite3.Error, OSError, ValueError) as e:
+            logger.error("Caché CSV (%s): Error construyendo índice desde SQLite: %s", cache['name'], e)
+            cache['failed_signature'] = signature
+            return
+        elapsed = time.perf_counter() - start
+        row_count = import_info['row_count']
+        cache['index'] = index
+        cache['signature'] = (import_info['source_mtime_ns'], import_info['source_size'])
+        cache['failed_signature'] = None
+        cache['row_count'] = row_count
+        cache['key_count'] = len(index)
+        cache['malformed_count'] = import_info['malformed_count'] or 0
+        cache['load_seconds'] = elapsed
+        cache['loaded_at'] = datetime.datetime.now().isoformat(timespec='seconds')
+        cache['import_mode'] = import_info['import_mode']
+        cache['changed_rows'] = import_info['changed_rows']
+        cache['source_sha1'] = import_info['source_sha1']
+        metrics.inc('inbound_csv_cache_loads_total', {'cache': cache['name']})
+        metrics.inc('inbound_csv_cache_rows_loaded_total', {'cache': cache['name']}, row_count)
+        logger.info("Caché CSV (%s): %d filas, %d claves cargadas en %.2f s", cache['name'], row_count, len(index), elapsed)
+
+def _reload_csv_cache_worker(cache):
     try:
-        df = pd.read_csv(file_path, usecols=columns, dtype=str, keep_default_na=True)
-        df = df.replace({np.nan: None})
-        return df
+        # Un CSV nuevo puede estar copiándose todavía: esperar a que su firma se estabilice
+        # (el índice anterior sigue atendiendo). La carga inicial no espera.
+        if cache['index'] is not None and erp_import.wait_for_complete_file(
+                cache['file_path'], ERP_FILE_SETTLE_SECONDS, ERP_FILE_SETTLE_TIMEOUT_SECONDS) is None:
+            logger.warning("Caché CSV (%s): %s sigue cambiando; se reintentará", cache['name'], cache['file_path'])
+            return
+        _load_csv_cache(cache)
     except Exception as e:
-        print(f"Error CSV: Error inesperado leyendo CSV {file_path}: {e}")
-        return None
+        logger.exception("Caché CSV (%s): Error recargando índice: %s", cache['name'], e)
+    finally:
+        with cache['lock']:
+            cache['reloading'] = False
+
+def _start_csv_cache_reload(cache):
+    with cache['lock']:
+        if cache['reloading']: return
+        cache['reloading'] = True
+    threading.Thread(target=_reload_csv_cache_worker, args=(cache,),
+                     name=f"reload-{cache['name']}", daemon=True).start()
+
+def get_csv_cache_index(cache):
+    if cache['index'] is None:
+        _load_csv_cache(cache)  # Primera carga: esperar (o unirse a una recarga en curso)
+        return cache['index']
+    signature = _file_signature(cache['file_path'])
+    if signature is not None and signature != cache['signature'] and signature != cache['failed_signature']:
+        _start_csv_cache_reload(cache)
+    return cache['index']
+
+def lookup_csv_cache(cache, index, key, default=None):
+    value = index.get(key) if index is not None else None
+    metrics.inc('inbound_csv_cache_lookups_total', {'cache': cache['name'], 'result': 'miss' if value is None else 'hit'})
+    return default if value is None else value
+
+def get_csv_cache_stats(cache):
+    return {
+        'file': os.path.basename(cache['file_path']),
+        'loaded': cache['index'] is not None,
+        'rowCount': cache['row_count'],
+        'keyCount': cache['key_count'],
+        'malformedRows': cache['malformed_count'],
+        'loadSeconds': round(cache['load_seconds'], 3) if cache['load_seconds'] is not None else None,
+        'loadedAt': cache['loaded_at'],
+        'importMode': cache['import_mode'],
+        'changedRows': cache['changed_rows'],
+        'reloading': cache['reloading'],
+        'rejected': _csv_cache_rejection_stats(cache['rejection']),
+    }
+
+def _csv_cache_rejection_stats(rejection):
+    if rejection is None: return None
+    return {
+        'reason': rejection['reason'],
+        'rejectedAt': rejection['rejected_at'],
+        'rowCountCheck': rejection['row_count_check'],
+        'unchangedCycles': rejection['unchanged_cycles'],
+        'acceptAfterCycles': ERP_SMALLER_FILE_CYCLES if rejection['row_count_check'] else None,
+    }
+
+def _confirm_smaller_file(cache):
+    # Llamada en cada revisión del vigilante: cuenta cuántas seguidas lleva sin cambios un CSV
+    # rechazado por la comparación de filas y, al llegar a ERP_SMALLER_FILE_CYCLES, lo reimporta
+    # sin esa comparación
+    rejection = cache['rejection']
+    if rejection is None or not rejection['row_count_check'] or ERP_SMALLER_FILE_CYCLES <= 0: return
+    if _file_signature(cache['file_path']) != rejection['signature']:
+        rejection['unchanged_cycles'] = 0  # Cambió: get_csv_cache_index ya lanzó la recarga normal
+        return
+    rejection['unchanged_cycles'] += 1
+    if rejection['unchanged_cycles'] < ERP_SMALLER_FILE_CYCLES: return
+    logger.warning("Caché CSV (%s): %s sigue igual tras %d revisiones; se acepta con menos filas (%s)",
+                   cache['name'], os.path.basename(cache['file_path']), rejection['unchanged_cycles'], rejection['reason'])
+    cache['accepted_smaller_signature'] = rejection['signature']
+    _start_csv_cache_reload(cache)
+
+def _watch_erp_files_worker():
+    # Detecta las exportaciones nuevas aunque no lleguen peticiones (get_csv_cache_index
+    # compara la firma y, si cambió, lanza la recarga en segundo plano)
+    while True:
+        time.sleep(ERP_WATCH_INTERVAL_SECONDS)
+        for cache in (item_master_cache, grn_cache):
+            if cache['index'] is not None: get_csv_cache_index(cache)
+            _confirm_smaller_file(cache)
+
+def _load_erp_snapshot(conn, import_info, columns, read_table, read_changes, scalar_column=None):
+    # Si hubo refrescos por diferencias desde la última instantánea completa, se abre esa
+    # instantánea y se le superponen las filas de erp_changes (leídas ahora de la tabla).
+    # Sin instantánea base, o con demasiados cambios, se escribe una completa y se olvidan.
+    table_name = import_info['table_name']
+    base_sha1 = import_info['snapshot_sha1'] or import_info['source_sha1']
+    if base_sha1 != import_info['source_sha1']:
+        base_key = erp_snapshot.snapshot_key(dict(import_info, source_sha1=base_sha1), columns)
+        base = erp_snapshot.open_snapshot(SNAPSHOTS_FOLDER, table_name, base_key, scalar_column=scalar_column)
+        if base is not None and erp_import.count_changes(conn, table_name) <= ERP_SNAPSHOT_MAX_CHANGES:
+            return base.with_changes(read_changes())
+    index = erp_snapshot.load_or_build(SNAPSHOTS_FOLDER, table_name, import_info, columns, read_table,
+                                       scalar_column=scalar_column)
+    if base_sha1 != import_info['source_sha1']:
+        with db_write_transaction() as write_conn:
+            erp_import.mark_snapshot_current(write_conn, table_name, import_info['source_sha1'])
+    return index
+
+def _build_item_master_index(conn, import_info):
+    def read_table():
+        columns_sql = ', '.join(f'"{col}"' for col in COLUMNS_TO_READ_MASTER)
+        cursor = conn.cursor()
+        cursor.row_factory = None
+        rows = cursor.execute(f"SELECT {columns_sql} FROM {erp_import.ITEM_MASTER_TABLE}").fetchall()
+        columns = {col: [row[i] if row[i] is not None else '' for row in rows]
+                   for i, col in enumerate(COLUMNS_TO_READ_MASTER)}
+        return columns['Item_Code'], columns
+    def read_changes():
+        columns_sql = ', '.join(f'm."{col}"' for col in COLUMNS_TO_READ_MASTER)
+        cursor = conn.cursor()
+        cursor.row_factory = None
+        rows = cursor.execute(f'''SELECT c.key1, m.rowid IS NOT NULL, {columns_sql}
+                                  FROM {erp_import.ERP_CHANGES_TABLE} c
+                                  LEFT JOIN {erp_import.ITEM_MASTER_TABLE} m ON m.Item_Code = c.key1
+                                  WHERE c.table_name = ?''', (erp_import.ITEM_MASTER_TABLE,))
+        return {row[0]: ({col: value if value is not None else '' for col, value in zip(COLUMNS_TO_READ_MASTER, row[2:])}
+                         if row[1] else None) for row in rows}
+    return _load_erp_snapshot(conn, import_info, COLUMNS_TO_READ_MASTER, read_table, read_changes)
+
+def _import_item_master(min_row_ratio):
+    return erp_import.import_item_master(DB_FILE_PATH, ITEM_MASTER_CSV_PATH, COLUMNS_TO_READ_MASTER,
+                                         min_row_ratio=min_row_ratio)
+
+item_master_cache = _new_csv_cache('maestro', ITEM_MASTER_CSV_PATH, _import_item_master, _build_item_master_index)
 
 def get_item_details_from_master_csv(item_code):
-    df_master = read_csv_safe(ITEM_MASTER_CSV_PATH, columns=COLUMNS_TO_READ_MASTER)
-    if df_master is None: return None
-    result = df_master[df_master['Item_Code'] == item_code]
-    return result.iloc[0].fillna('').to_dict() if not result.empty else None
+    index = get_csv_cache_index(item_master_cache)
+    if index is None: return None
+    return lookup_csv_cache(item_master_cache, index, item_code)
+
+# --- Búsqueda de artículos por prefijo / texto / aproximada ---
+ITEM_SEARCH_DEFAULT_LIMIT = 10
+ITEM_SEARCH_MAX_LIMIT = 50
+ITEM_SEARCH_FUZZY_MIN_LENGTH = 6      # Cada mitad necesita al menos un trigrama
+ITEM_SEARCH_FUZZY_CANDIDATES = 200
+ITEM_SEARCH_FUZZY_CUTOFF = 0.7
+
+def _fts_phrase(text):
+    return '"' + text.replace('"', '""') + '"'
+
+def _search_item_text(conn, terms, limit, any_term=False):
+    # Subcadenas en código o descripción: índice FTS5 trigram (sin ORDER BY rank, para que
+    # LIMIT corte pronto) o, si la base no lo tiene, LIKE sobre item_master.
+    try:
+        expr = (' OR ' if any_term else ' AND ').join(_fts_phrase(term) for term in terms)
+        sql = f"SELECT Item_Code FROM {erp_import.ITEM_SEARCH_TABLE} WHERE {erp_import.ITEM_SEARCH_TABLE} MATCH ? LIMIT ?"
+        return [row[0] for row in conn.execute(sql, (expr, limit))]
+    except sqlite3.OperationalError:
+        clause = '(Item_Code LIKE ? OR Item_Description LIKE ?)'
+        where_sql = (' OR ' if any_term else ' AND ').join(clause for _ in terms)
+        params = [f"%{term}%" for term in terms for _ in range(2)]
+        sql = f"SELECT Item_Code FROM {erp_import.ITEM_MASTER_TABLE} WHERE {where_sql} LIMIT ?"
+        return [row[0] for row in conn.execute(sql, params + [limit])]
+
+def search_item_codes(query, limit):
+    # Devuelve [(Item_Code, tipo)] sin repetidos, en orden de relevancia: prefijo de código
+    # (rango sobre la PK de item_master), subcadenas de código/descripción y, si nada
+    # coincide, búsqueda aproximada: con un solo error de tipeo, una de las dos mitades
+    # del código sigue intacta, así que se buscan ambas y se ordenan por similitud.
+    conn = get_db_connection()
+    matches = {}
+    def add(codes, match_type):
+        for code in codes:
+            if len(matches) >= limit: return
+            matches.setdefault(code, match_type)
+
+    prefix_sql = (f"SELECT Item_Code FROM {erp_import.ITEM_MASTER_TABLE} "
+                  "WHERE Item_Code >= ? AND Item_Code < ? ORDER BY Item_Code LIMIT ?")
+    for prefix in dict.fromkeys((query, query.upper())):
+        add((row[0] for row in conn.execute(prefix_sql, (prefix, prefix + '\U0010ffff', limit))), 'code_prefix')
+    terms = [term for term in query.split() if len(term) >= 3]
+    if len(matches) < limit and terms:
+        add(_search_item_text(conn, terms, limit + len(matches)), 'contains')
+    if not matches and len(terms) == 1 and len(query) >= ITEM_SEARCH_FUZZY_MIN_LENGTH:
+        half = len(query) // 2
+        candidates = _search_item_text(conn, [query[:half], query[half:]], ITEM_SEARCH_FUZZY_CANDIDATES, any_term=True)
+        target = query.upper()
+        scored = sorted(((SequenceMatcher(None, target, code.upper()).ratio(), code)
+                         for code in candidates if code not in matches), reverse=True)
+        add((code for score, code in scored if score >= ITEM_SEARCH_FUZZY_CUTOFF), 'fuzzy')
+    metrics.inc('inbound_db_rows_read_total', {'query': 'search_items'}, len(matches))
+    return list(matches.items())
+
+def _build_grn_index(conn, import_info):
+    # Clave (GRN, ítem) -> cantidad esperada. Cuando el CSV cambia, un refresco por diferencias
+    # (import_mode 'delta') solo relee las claves de erp_changes y las superpone a la instantánea
+    # ya escrita; el índice completo se reconstruye únicamente en una importación 'full'
+    # (primera carga, columnas distintas o demasiados cambios acumulados).
+    def read_table():
+        cursor = conn.cursor()
+        cursor.row_factory = None
+        rows = cursor.execute(
+            f"SELECT GRN_Number, Item_Code, COALESCE(Quantity, 0) FROM {erp_import.GRN_LINES_TABLE}").fetchall()
+        return [(grn_number, item_code) for grn_number, item_code, _ in rows], {'Quantity': [row[2] for row in rows]}
+    def read_changes():
+        cursor = conn.cursor()
+        cursor.row_factory = None
+        rows = cursor.execute(f'''SELECT c.key1, c.key2, g.Item_Code IS NOT NULL, COALESCE(g.Quantity, 0)
+                                  FROM {erp_import.ERP_CHANGES_TABLE} c
+                                  LEFT JOIN {erp_import.GRN_LINES_TABLE} g ON g.GRN_Number = c.key1 AND g.Item_Code = c.key2
+                                  WHERE c.table_name = ?''', (erp_import.GRN_LINES_TABLE,))
+        return {(grn_number, item_code): quantity if present else None for grn_number, item_code, present, quantity in rows}
+    return _load_erp_snapshot(conn, import_info, ['GRN_Number', 'Item_Code', 'Quantity'], read_table, read_changes,
+                              scalar_column='Quantity')
+
+def _import_grn_lines(min_row_ratio):
+    return erp_import.import_grn_lines(DB_FILE_PATH, GRN_CSV_FILE_PATH, COLUMNS_TO_READ_GRN,
+                                       grn_column=GRN_COLUMN_NAME_IN_CSV, min_row_ratio=min_row_ratio)
+
+grn_cache = _new_csv_cache('GRN', GRN_CSV_FILE_PATH, _import_grn_lines, _build_grn_index)
 
 def get_grn_specific_expected_quantity(import_ref_form, item_code_form):
-    expected_quantity = 0
-    df_grn = read_csv_safe(GRN_CSV_FILE_PATH, columns=COLUMNS_TO_READ_GRN)
-    if df_grn is None:
-        print(f"Advertencia CSV: No se pudo leer el archivo GRN {GRN_CSV_FILE_PATH}.")
-        return expected_quantity
-    result = df_grn[
-        (df_grn[GRN_COLUMN_NAME_IN_CSV] == import_ref_form) &
-        (df_grn['Item_Code'] == item_code_form)
-    ]
-    if not result.empty:
-        quantity_value = result.iloc[0].get('Quantity')
-        if quantity_value is not None:
-            try:
-                numeric_value = pd.to_numeric(quantity_value, errors='coerce')
-                if pd.notna(numeric_value): expected_quantity = int(numeric_value)
-                else: print(f"Advertencia CSV: Cantidad no numérica ('{quantity_value}') para GRN {import_ref_form}, Item {item_code_form}.")
-            except (ValueError, TypeError): print(f"Advertencia CSV: Error convirtiendo cantidad ('{quantity_value}') para GRN {import_ref_form}, Item {item_code_form}.")
-        else: print(f"Advertencia CSV: Columna 'Quantity' vacía para GRN {import_ref_form}, Item {item_code_form}.")
-    return expected_quantity
+    index = get_csv_cache_index(grn_cache)
+    if index is None:
+        logger.warning("Advertencia CSV: No se pudo leer el archivo GRN %s.", GRN_CSV_FILE_PATH)
+        return 0
+    return lookup_csv_cache(grn_cache, index, (import_ref_form, item_code_form), 0)
+
+# --- Capa de conexiones SQLite ---
+# Cada hilo del servidor (waitress usa un pool fijo) reutiliza su propia conexión, así que
+# las sentencias preparadas quedan en la caché de sentencias de esa conexión. La BD está en
+# modo WAL: las lecturas (get_logs, exportaciones) no se bloquean mientras otro hilo escribe.
+DB_BUSY_TIMEOUT_SECONDS = 0.25   # Espera interna de SQLite antes de contar un reintento
+DB_WRITE_TIMEOUT_SECONDS = 10    # Tiempo total máximo esperando el bloqueo de escritura
+DB_CONNECTION_PRAGMAS = [
+    "PRAGMA synchronous = NORMAL",      # Seguro con WAL y evita un fsync por commit
+    "PRAGMA cache_size = -20000",       # ~20 MB de caché de páginas por conexión
+    "PRAGMA mmap_size = 268435456",     # Lecturas vía mmap compartido entre conexiones
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA foreign_keys = ON",
+]
+
+_db_local = threading.local()
+_db_stats_lock = threading.Lock()
+db_pool_stats = {
+    'connections_opened': 0, 'write_transactions': 0, 'write_errors': 0,
+    'busy_retries': 0, 'write_wait_seconds_total': 0.0, 'write_wait_seconds_max': 0.0,
+}
+
+def _db_stats_add(key, amount=1):
+    with _db_stats_lock:
+        db_pool_stats[key] += amount
+
+def get_db_connection():
+    conn = getattr(_db_local, 'conn', None)
+    if conn is None:
+        conn = sqlite3.connect(DB_FILE_PATH, timeout=DB_BUSY_TIMEOUT_SECONDS,
+                               isolation_level=None, cached_statements=256)
+        conn.row_factory = sqlite3.Row
+        for pragma in DB_CONNECTION_PRAGMAS:
+            conn.execute(pragma)
+        conn.execute("ATTACH DATABASE ? AS archive", (LOG_ARCHIVE_DB_PATH,))  # Ver archive_logs_db
+        _db_local.conn = conn
+        _db_stats_add('connections_opened')
+    return conn
+
+@contextmanager
+def db_write_transaction():
+    """Abre una transacción de escritura (BEGIN IMMEDIATE) en la conexión del hilo.
+
+    Reintenta mientras otro escritor tenga el bloqueo, hasta DB_WRITE_TIMEOUT_SECONDS,
+    y acumula el tiempo de espera y los reintentos en db_pool_stats.
+    """
+    conn = get_db_connection()
+    start = time.perf_counter()
+    retries = 0
+    while True:
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            break
+        except sqlite3.OperationalError as e:
+            waited = time.perf_counter() - start
+            if 'locked' not in str(e) and 'busy' not in str(e): raise
+            if waited >= DB_WRITE_TIMEOUT_SECONDS:
+                _db_stats_add('write_errors')
+                metrics.inc('inbound_db_write_errors_total')
+                raise
+            retries += 1
+            metrics.inc('inbound_db_busy_retries_total')
+            time.sleep(min(0.01 * retries, 0.1))
+    waited = time.perf_counter() - start
+    with _db_stats_lock:
+        db_pool_stats['write_transactions'] += 1
+        db_pool_stats['busy_retries'] += retries
+        db_pool_stats['write_wait_seconds_total'] += waited
+        db_pool_stats['write_wait_seconds_max'] = max(db_pool_stats['write_wait_seconds_max'], waited)
+    metrics.observe('inbound_db_write_wait_seconds', waited)
+    try:
+        yield conn
+        commit_start = time.perf_counter()
+        conn.execute("COMMIT")
+        metrics.observe('inbound_db_commit_seconds', time.perf_counter() - commit_start)
+    except BaseException:
+        if conn.in_transaction: conn.execute("ROLLBACK")
+        _db_stats_add('write_errors')
+        metrics.inc('inbound_db_write_errors_total')
+        raise
+
+def get_db_pool_stats():
+    with _db_stats_lock:
+        stats = dict(db_pool_stats)
+    stats['write_wait_seconds_total'] = round(stats['write_wait_seconds_total'], 4)
+    stats['write_wait_seconds_max'] = round(stats['write_wait_seconds_max'], 4)
+    return stats
 
 # --- Funciones de Base de Datos SQLite ---
+SQL_INSERT_LOG = '''INSERT INTO logs (timestamp, importRef, waybill, itemCode, itemDescription,
+                                   binLocation, relocatedBin, qtyReceived, qtyGrn, difference)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'''
+SQL_UPDATE_LOG = '''UPDATE logs SET waybill = ?, relocatedBin = ?, qtyReceived = ?, timestamp = ?
+                    WHERE id = ?'''
+SQL_SELECT_LOG_BY_ID = "SELECT * FROM logs WHERE id = ?"
+# Lo recibido incluye lo ya archivado del mismo (GRN, ítem) (ver archive_logs_db)
+SQL_SELECT_TOTAL_RECEIVED = '''SELECT COALESCE((SELECT totalReceived FROM grn_item_totals WHERE importRef = ?1 AND itemCode = ?2), 0)
+                                  + COALESCE((SELECT totalReceived FROM archive.log_archive_summary
+                                              WHERE importRef = ?1 AND itemCode = ?2), 0)'''
+# Tras editar una fila o importar escaneos con fecha pasada, la diferencia acumulada de las
+# filas del mismo (GRN, ítem) desde la posición (timestamp, id) indicada se recalcula en orden
+# de escaneo (timestamp, id): cada fila guarda SUM(qtyReceived hasta ella) - su qtyGrn. Un
+# escaneo en vivo lleva la hora actual, así que al insertarlo ese orden coincide con el de id.
+# Parámetros: (importRef, itemCode, timestamp, id).
+SQL_RECOMPUTE_DIFFERENCES = '''WITH scan AS (
+                                   SELECT id, SUM(qtyReceived) OVER (ORDER BY timestamp, id) + COALESCE((
+                                       SELECT s.totalReceived FROM archive.log_archive_summary s
+                                       WHERE s.importRef = COALESCE(?1, '') AND s.itemCode = COALESCE(?2, '')
+                                   ), 0) - COALESCE(qtyGrn, 0) AS difference
+                                   FROM logs WHERE importRef IS ?1 AND itemCode IS ?2
+                               )
+                               UPDATE logs SET difference = scan.difference FROM scan
+                               WHERE logs.id = scan.id AND (logs.timestamp, logs.id) >= (?3, ?4)
+                                 AND logs.difference IS NOT scan.difference'''
+SQL_SELECT_PAIR_FROM_POSITION = '''SELECT * FROM logs WHERE importRef IS ?1 AND itemCode IS ?2 AND (timestamp, id) >= (?3, ?4)
+                                   ORDER BY timestamp, id'''
+
+# Totales recibidos por (GRN, ítem), mantenidos por triggers en la misma transacción que
+# cada INSERT/UPDATE/DELETE sobre 'logs'. Las claves NULL se guardan como ''.
+GRN_ITEM_TOTALS_DDL = [
+    '''CREATE TABLE IF NOT EXISTS grn_item_totals (
+           importRef TEXT NOT NULL, itemCode TEXT NOT NULL, totalReceived INTEGER NOT NULL DEFAULT 0,
+           rowCount INTEGER NOT NULL DEFAULT 0, qtyGrn INTEGER, itemDescription TEXT, lastLogId INTEGER,
+           PRIMARY KEY (importRef, itemCode)
+       ) WITHOUT ROWID''',
+    '''CREATE TRIGGER IF NOT EXISTS trg_logs_totals_insert AFTER INSERT ON logs BEGIN
+           INSERT INTO grn_item_totals (importRef, itemCode, totalReceived, rowCount, qtyGrn, itemDescription, lastLogId)
+           VALUES (COALESCE(NEW.importRef, ''), COALESCE(NEW.itemCode, ''), COALESCE(NEW.qtyReceived, 0), 1,
+                   NEW.qtyGrn, NEW.itemDescription, NEW.id)
+           ON CONFLICT (importRef, itemCode) DO UPDATE SET
+               totalReceived = totalReceived + excluded.totalReceived, rowCount = rowCount + 1,
+               qtyGrn = excluded.qtyGrn, itemDescription = excluded.itemDescription, lastLogId = excluded.lastLogId;
+       END''',
+    '''CREATE TRIGGER IF NOT EXISTS trg_logs_totals_update AFTER UPDATE OF qtyReceived, importRef, itemCode ON logs BEGIN
+           UPDATE grn_item_totals SET totalReceived = totalReceived - COALESCE(OLD.qtyReceived, 0), rowCount = rowCount - 1
+           WHERE importRef = COALESCE(OLD.importRef, '') AND itemCode = COALESCE(OLD.itemCode, '');
+           INSERT INTO grn_item_totals (importRef, itemCode, totalReceived, rowCount, qtyGrn, itemDescription, lastLogId)
+           VALUES (COALESCE(NEW.importRef, ''), COALESCE(NEW.itemCode, ''), COALESCE(NEW.qtyReceived, 0), 1,
+                   NEW.qtyGrn, NEW.itemDescription, NEW.id)
+           ON CONFLICT (importRef, itemCode) DO UPDATE SET
+               totalReceived = totalReceived + excluded.totalReceived, rowCount = rowCount + 1;
+           DELETE FROM grn_item_totals
+           WHERE importRef = COALESCE(OLD.importRef, '') AND itemCode = COALESCE(OLD.itemCode, '') AND rowCount <= 0;
+       END''',
+    '''CREATE TRIGGER IF NOT EXISTS trg_logs_totals_delete AFTER DELETE ON logs BEGIN
+           UPDATE grn_item_totals SET totalReceived = totalReceived - COALESCE(OLD.qtyReceived, 0), rowCount = rowCount - 1
+           WHERE importRef = COALESCE(OLD.importRef, '') AND itemCode = COALESCE(OLD.itemCode, '');
+           DELETE FROM grn_item_totals
+           WHERE importRef = COALESCE(OLD.importRef, '') AND itemCode = COALESCE(OLD.itemCode, '') AND rowCount <= 0;
+       END''',
+]
+SQL_REBUILD_GRN_ITEM_TOTALS = '''INSERT INTO grn_item_totals (importRef, itemCode, totalReceived, rowCount, qtyGrn, itemDescription, lastLogId)
+                                 SELECT COALESCE(importRef, ''), COALESCE(itemCode, ''), COALESCE(SUM(qtyReceived), 0), COUNT(*),
+                                        qtyGrn, itemDescription, MAX(id)
+                                 FROM logs GROUP BY COALESCE(importRef, ''), COALESCE(itemCode, '')'''
+
+# Diario de cambios de 'logs' para /api/log_stream: cada INSERT (o UPDATE que cambia algún
+# valor) deja un evento con número de secuencia creciente, que es el id SSE (Last-Event-ID).
+# changedAt es la hora local de la escritura (no el timestamp del escaneo, que una importación
+# o una edición puede dejar en el pasado): de ahí sale el Last-Modified de get_logs.
+# Solo se conservan los últimos LOG_EVENTS_RETENTION eventos.
+LOG_EVENTS_RETENTION = 50000
+LOG_EVENT_CHANGED_AT_SQL = "strftime('%Y-%m-%dT%H:%M:%S', 'now', 'localtime')"
+LOG_EVENTS_DDL = [
+    '''CREATE TABLE IF NOT EXISTS log_events (
+           seq INTEGER PRIMARY KEY AUTOINCREMENT, logId INTEGER NOT NULL, kind TEXT NOT NULL, changedAt TEXT
+       )''',
+    f'''CREATE TRIGGER IF NOT EXISTS trg_logs_event_insert AFTER INSERT ON logs BEGIN
+           INSERT INTO log_events (logId, kind, changedAt) VALUES (NEW.id, 'insert', {LOG_EVENT_CHANGED_AT_SQL});
+       END''',
+    f'''CREATE TRIGGER IF NOT EXISTS trg_logs_event_update AFTER UPDATE ON logs
+       WHEN OLD.waybill IS NOT NEW.waybill OR OLD.relocatedBin IS NOT NEW.relocatedBin
+         OR OLD.qtyReceived IS NOT NEW.qtyReceived OR OLD.qtyGrn IS NOT NEW.qtyGrn
+         OR OLD.difference IS NOT NEW.difference OR OLD.timestamp IS NOT NEW.timestamp BEGIN
+           INSERT INTO log_events (logId, kind, changedAt) VALUES (NEW.id, 'update', {LOG_EVENT_CHANGED_AT_SQL});
+       END''',
+    f'''CREATE TRIGGER IF NOT EXISTS trg_log_events_prune AFTER INSERT ON log_events BEGIN
+           DELETE FROM log_events WHERE seq <= NEW.seq - {LOG_EVENTS_RETENTION};
+       END''',
+]
+SQL_SELECT_LOG_EVENTS_AFTER = '''SELECT e.seq AS eventId, e.kind AS eventKind, l.*
+                                 FROM log_events e LEFT JOIN logs l ON l.id = e.logId
+                                 WHERE e.seq > ? ORDER BY e.seq LIMIT ?'''
+
+# Claves de idempotencia de add_log/add_logs: el cliente manda una clave por escaneo
+# (cabecera Idempotency-Key o campo idempotencyKey) y la reintenta tal cual si no recibió
+# respuesta. La clave se guarda en la misma transacción que la fila, junto con la entrada
+# devuelta, así que un reintento recibe la entrada original sin volver a insertar.
+IDEMPOTENCY_KEY_TTL_SECONDS = 48 * 3600
+IDEMPOTENCY_KEY_MAX_LENGTH = 128
+IDEMPOTENCY_PURGE_INTERVAL_SECONDS = 3600
+IDEMPOTENCY_KEYS_DDL = [
+    '''CREATE TABLE IF NOT EXISTS idempotency_keys (
+           idempotencyKey TEXT PRIMARY KEY, requestHash TEXT NOT NULL, logId INTEGER NOT NULL,
+           entry TEXT NOT NULL, createdAt REAL NOT NULL
+       ) WITHOUT ROWID''',
+    "CREATE INDEX IF NOT EXISTS idx_idempotency_keys_createdAt ON idempotency_keys (createdAt)",
+]
+# OR REPLACE: una clave vencida que la purga aún no borró no debe hacer fallar la transacción
+# (load_idempotent_entries ya la ignoró dentro de la misma transacción de escritura)
+SQL_INSERT_IDEMPOTENCY_KEY = '''INSERT OR REPLACE INTO idempotency_keys (idempotencyKey, requestHash, logId, entry, createdAt)
+                                VALUES (?, ?, ?, ?, ?)'''
+SQL_PURGE_IDEMPOTENCY_KEYS = "DELETE FROM idempotency_keys WHERE createdAt < ?"
+
+# Archivo del log: ver archive_logs_db. Una tabla logs_AAAA_MM por mes, con el mismo esquema.
+LOG_ARCHIVE_AFTER_DAYS = int(os.environ.get('INBOUND_LOG_ARCHIVE_DAYS', '180'))           # 0 = desactivado
+LOG_ARCHIVE_CLOSED_DAYS = int(os.environ.get('INBOUND_LOG_ARCHIVE_CLOSED_DAYS', '30'))    # 0 = desactivado
+LOG_ARCHIVE_INTERVAL_SECONDS = 6 * 3600
+LOG_ARCHIVE_BATCH_GRNS = 50          # GRN por transacción: el bloqueo de escritura dura poco
+LOG_ARCHIVE_DDL = [
+    '''CREATE TABLE IF NOT EXISTS log_archive_summary (
+           importRef TEXT NOT NULL, itemCode TEXT NOT NULL, rowCount INTEGER NOT NULL, totalReceived INTEGER NOT NULL,
+           qtyGrn INTEGER, itemDescription TEXT, firstTimestamp TEXT, lastTimestamp TEXT, lastLogId INTEGER,
+           PRIMARY KEY (importRef, itemCode)
+       ) WITHOUT ROWID''',
+    '''CREATE TABLE IF NOT EXISTS log_archive_runs (
+           id INTEGER PRIMARY KEY AUTOINCREMENT, finishedAt TEXT NOT NULL, grnCount INTEGER NOT NULL,
+           rowCount INTEGER NOT NULL, seconds REAL
+       )''',
+]
+SQL_CREATE_ARCHIVE_MONTH = '''CREATE TABLE IF NOT EXISTS archive.{table} (
+                                  id INTEGER PRIMARY KEY, timestamp TEXT NOT NULL, importRef TEXT, waybill TEXT,
+                                  itemCode TEXT, itemDescription TEXT, binLocation TEXT, relocatedBin TEXT,
+                                  qtyReceived INTEGER, qtyGrn INTEGER, difference INTEGER
+                              )'''
+SQL_CREATE_ARCHIVE_MONTH_INDEX = "CREATE INDEX IF NOT EXISTS archive.idx_{table}_importRef_itemCode ON {table} (importRef, itemCode)"
+# GRN completos a archivar: sin escaneos desde idle_cutoff, o cerrados (nada pendiente ni en
+# el log ni en el GRN del ERP) y sin escaneos desde closed_cutoff
+SQL_SELECT_ARCHIVABLE_GRNS = f'''SELECT a.importRef FROM (
+                                     SELECT COALESCE(importRef, '') AS importRef, MAX(timestamp) AS lastTimestamp
+                                     FROM logs GROUP BY 1
+                                 ) a
+                                 WHERE a.lastTimestamp < :idle_cutoff
+                                    OR (a.lastTimestamp < :closed_cutoff
+                                        AND NOT EXISTS (SELECT 1 FROM grn_item_totals t WHERE t.importRef = a.importRef
+                                                          AND t.totalReceived < COALESCE(t.qtyGrn, 0))
+                                        AND NOT EXISTS (SELECT 1 FROM {erp_import.GRN_LINES_TABLE} g
+                                                        LEFT JOIN grn_item_totals t
+                                                               ON t.importRef = g.GRN_Number AND t.itemCode = g.Item_Code
+                                                        WHERE g.GRN_Number = a.importRef
+                                                          AND COALESCE(t.totalReceived, 0) < COALESCE(g.Quantity, 0)))
+                                 ORDER BY a.lastTimestamp'''
+# Solo suma las filas con id mayor que el lastLogId ya resumido (los id de 'logs' no se reusan,
+# AUTOINCREMENT): el archivo y 'logs' son dos archivos y su COMMIT no es atómico, así que si una
+# pasada se corta después de confirmar el archivo, la siguiente vuelve a ver esas filas en 'logs'
+# y no las cuenta dos veces
+SQL_UPSERT_ARCHIVE_SUMMARY = '''INSERT INTO archive.log_archive_summary (importRef, itemCode, rowCount, totalReceived, qtyGrn,
+                                                                        itemDescription, firstTimestamp, lastTimestamp, lastLogId)
+                                SELECT COALESCE(importRef, ''), COALESCE(itemCode, ''), COUNT(*), COALESCE(SUM(qtyReceived), 0),
+                                       qtyGrn, itemDescription, MIN(timestamp), MAX(timestamp), MAX(id)
+                                FROM logs WHERE {where_sql} AND id > COALESCE((
+                                    SELECT s.lastLogId FROM archive.log_archive_summary s
+                                    WHERE s.importRef = COALESCE(logs.importRef, '') AND s.itemCode = COALESCE(logs.itemCode, '')
+                                ), 0)
+                                GROUP BY 1, 2
+                                ON CONFLICT (importRef, itemCode) DO UPDATE SET
+                                    rowCount = rowCount + excluded.rowCount, totalReceived = totalReceived + excluded.totalReceived,
+                                    qtyGrn = excluded.qtyGrn, itemDescription = excluded.itemDescription,
+                                    firstTimestamp = MIN(firstTimestamp, excluded.firstTimestamp),
+                                    lastTimestamp = MAX(lastTimestamp, excluded.lastTimestamp),
+                                    lastLogId = MAX(lastLogId, excluded.lastLogId)'''
+SQL_INSERT_ARCHIVE_RUN = "INSERT INTO archive.log_archive_runs (finishedAt, grnCount, rowCount, seconds) VALUES (?, ?, ?, ?)"
+
+LOG_COLUMNS = ['id', 'timestamp', 'importRef', 'waybill', 'itemCode', 'itemDescription',
+               'binLocation', 'relocatedBin', 'qtyReceived', 'qtyGrn', 'difference']
+LOGS_PAGE_DEFAULT_LIMIT = 200
+LOGS_PAGE_MAX_LIMIT = 2000
+LOG_FILTER_COLUMNS = {'importRef': 'importRef', 'itemCode': 'itemCode', 'waybill': 'waybill'}
+LOG_EXPORT_COLUMNS = [
+    ('timestamp', 'Timestamp'), ('importRef', 'GRN 1.'), ('waybill', 'Waybill'),
+    ('itemCode', 'Item Code'), ('itemDescription', 'Item Description'),
+    ('binLocation', 'Bin Location (Original)'), ('relocatedBin', 'Relocated Bin (New)'),
+    ('qtyReceived', 'Qty. Received'), ('qtyGrn', 'Qty. GRN'), ('difference', 'Difference'),
+]
+ADD_LOGS_MAX_LINES = 1000
+LOG_STREAM_MAX_CLIENTS = 8          # Cada conexión SSE ocupa un hilo del servidor
+LOG_STREAM_MAX_SECONDS = 300        # Luego se cierra y el navegador reconecta con Last-Event-ID
+LOG_STREAM_POLL_SECONDS = 1.0       # Revisión de log_events (cambios hechos por otros procesos)
+LOG_STREAM_HEARTBEAT_SECONDS = 15
+LOG_STREAM_RETRY_MS = 3000
+LOG_STREAM_BATCH_LIMIT = 500
+
 def init_db():
+    conn = None
     try:
         conn = sqlite3.connect(DB_FILE_PATH)
         cursor = conn.cursor()
+        journal_mode = cursor.execute("PRAGMA journal_mode = WAL").fetchone()[0]
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS logs (
                 id INTEGER PRIMARY KEY AUTOINCREMENT, timestamp TEXT NOT NULL, importRef TEXT,
@@ -79,198 +828,1502 @@ def init_db():
                 relocatedBin TEXT, qtyReceived INTEGER, qtyGrn INTEGER, difference INTEGER
             )''') 
         cursor.execute("CREATE INDEX IF NOT EXISTS idx_importRef_itemCode ON logs (importRef, itemCode)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_logs_itemCode ON logs (itemCode)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_logs_waybill ON logs (waybill)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_logs_timestamp ON logs (timestamp)")
+        totals_existed = cursor.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'grn_item_totals'").fetchone() is not None
+        _migrate_log_events(cursor)
+        for ddl in GRN_ITEM_TOTALS_DDL + LOG_EVENTS_DDL + IDEMPOTENCY_KEYS_DDL:
+            cursor.execute(ddl)
+        if not totals_existed:
+            # Primera vez: poblar los totales con el histórico existente
+            cursor.execute(SQL_REBUILD_GRN_ITEM_TOTALS)
+            logger.info("DB: Tabla grn_item_totals creada con %d pares (GRN, ítem).", cursor.rowcount)
         conn.commit()
-        print(f"DB: Base de datos SQLite inicializada/verificada en: {DB_FILE_PATH}")
-    except sqlite3.Error as e: print(f"DB Error (init_db): {e}")
+        erp_import.ensure_erp_tables(conn, COLUMNS_TO_READ_MASTER)
+        init_log_archive_db()
+        logger.info("DB: Base de datos SQLite inicializada/verificada en: %s (journal_mode=%s)", DB_FILE_PATH, journal_mode)
+    except sqlite3.Error as e: logger.error("DB Error (init_db): %s", e)
     finally:
         if conn: conn.close()
 
-def save_log_entry_db(entry_data):
-    conn = None
+def _migrate_log_events(cursor):
+    # Bases anteriores a changedAt: agregar la columna y rehacer los triggers que la llenan
+    columns = {row[1] for row in cursor.execute("PRAGMA table_info(log_events)")}
+    if not columns or 'changedAt' in columns: return
+    cursor.execute("ALTER TABLE log_events ADD COLUMN changedAt TEXT")
+    cursor.execute("DROP TRIGGER IF EXISTS trg_logs_event_insert")
+    cursor.execute("DROP TRIGGER IF EXISTS trg_logs_event_update")
+    logger.info("DB: Columna changedAt agregada a log_events.")
+
+def init_log_archive_db():
+    conn = sqlite3.connect(LOG_ARCHIVE_DB_PATH)
     try:
-        conn = sqlite3.connect(DB_FILE_PATH, timeout=10)
-        cursor = conn.cursor()
-        sql = '''INSERT INTO logs (timestamp, importRef, waybill, itemCode, itemDescription,
-                              binLocation, relocatedBin, qtyReceived, qtyGrn, difference)
-                 VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'''
+        conn.execute("PRAGMA journal_mode = WAL")
+        for ddl in LOG_ARCHIVE_DDL:
+            conn.execute(ddl)
+        conn.commit()
+    finally:
+        conn.close()
+
+# --- Aviso de cambios a los clientes de /api/log_stream ---
+# Las escrituras de este proceso despiertan a los streams al instante; los cambios hechos
+# por otros procesos se ven en la siguiente revisión (LOG_STREAM_POLL_SECONDS).
+_log_events_condition = threading.Condition()
+log_stream_state = {'generation': 0, 'clients': 0}
+
+def notify_log_events():
+    with _log_events_condition:
+        log_stream_state['generation'] += 1
+        _log_events_condition.notify_all()
+
+def wait_for_log_events(generation, timeout):
+    with _log_events_condition:
+        return _log_events_condition.wait_for(lambda: log_stream_state['generation'] != generation, timeout)
+
+def get_last_log_event_id():
+    return get_db_connection().execute("SELECT MAX(seq) FROM log_events").fetchone()[0] or 0
+
+def query_log_events_after_db(last_event_id, limit):
+    # Devuelve (eventos, último seq leído, hay_más). Si un registro cambió varias veces en
+    # el tramo leído solo se envía su último estado. eventos es None cuando el cliente quedó
+    # más atrás de lo que conserva log_events (o la base es otra) y debe recargar la tabla.
+    conn = get_db_connection()
+    min_seq, max_seq = conn.execute("SELECT MIN(seq), MAX(seq) FROM log_events").fetchone()
+    if (max_seq or 0) < last_event_id or (min_seq is not None and last_event_id < min_seq - 1):
+        return None, last_event_id, False
+    events = {}
+    last_seq = last_event_id
+    rows = conn.execute(SQL_SELECT_LOG_EVENTS_AFTER, (last_event_id, limit)).fetchall()
+    for row in rows:
+        last_seq = row['eventId']
+        if row['id'] is None: continue  # El registro ya no existe
+        previous = events.pop(row['id'], None)
+        kind = 'insert' if previous and previous[1] == 'insert' else row['eventKind']
+        entry = dict(row)
+        del entry['eventId'], entry['eventKind']
+        events[row['id']] = (row['eventId'], kind, entry)
+    metrics.inc('inbound_db_rows_read_total', {'query': 'log_stream'}, len(rows))
+    return list(events.values()), last_seq, len(rows) >= limit
+
+def parse_idempotency_key(value):
+    """Valida la clave de idempotencia recibida (o None si no se envió). Lanza ValueError."""
+    if value is None or value == '': return None
+    if not isinstance(value, str) or len(value.strip()) > IDEMPOTENCY_KEY_MAX_LENGTH or not value.strip():
+        raise ValueError(f"Clave de idempotencia inválida (texto de 1 a {IDEMPOTENCY_KEY_MAX_LENGTH} caracteres)")
+    return value.strip()
+
+def idempotency_request_hash(data):
+    # Huella de la línea enviada, para rechazar una clave reutilizada con otros datos
+    payload = {key: value for key, value in data.items() if key != 'idempotencyKey'}
+    return hashlib.sha1(json.dumps(payload, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+def load_idempotent_entries(conn, keys):
+    """Devuelve {clave: (hash, entrada guardada)} de las claves vigentes entre 'keys'."""
+    keys = list(set(keys))
+    if not keys: return {}
+    placeholders = ', '.join('?' for _ in keys)
+    rows = conn.execute(
+        f"SELECT idempotencyKey, requestHash, entry FROM idempotency_keys "
+        f"WHERE idempotencyKey IN ({placeholders}) AND createdAt >= ?",
+        keys + [time.time() - IDEMPOTENCY_KEY_TTL_SECONDS]).fetchall()
+    return {row['idempotencyKey']: (row['requestHash'], json.loads(row['entry'])) for row in rows}
+
+def purge_idempotency_keys_db():
+    try:
+        with db_write_transaction() as conn:
+            deleted = conn.execute(SQL_PURGE_IDEMPOTENCY_KEYS, (time.time() - IDEMPOTENCY_KEY_TTL_SECONDS,)).rowcount
+        if deleted: logger.info("DB: %d claves de idempotencia vencidas eliminadas.", deleted)
+    except sqlite3.Error as e:
+        logger.error("DB Error (purge_idempotency_keys_db): %s", e)
+
+def _purge_idempotency_keys_worker():
+    while True:
+        purge_idempotency_keys_db()
+        time.sleep(IDEMPOTENCY_PURGE_INTERVAL_SECONDS)
+
+def _insert_log_entries(conn, entries, idempotency, stored, running_totals):
+    # Inserta las entradas de una petición. Los totales y claves que toca quedan en dicts
+    # propios y solo se pasan a los del grupo si la petición entera se guardó.
+    request_totals = {}
+    request_stored = {}
+    results = []
+    for entry_data, key_info in zip(entries, idempotency):
+        if key_info is not None and (key_info[0] in request_stored or key_info[0] in stored):
+            results.append(((request_stored.get(key_info[0]) or stored[key_info[0]])[1], True))
+            continue
+        pair = (entry_data.get('importRef') or '', entry_data.get('itemCode') or '')
+        if pair not in request_totals:
+            request_totals[pair] = running_totals[pair] if pair in running_totals else \
+                conn.execute(SQL_SELECT_TOTAL_RECEIVED, pair).fetchone()[0]
+        request_totals[pair] += entry_data.get('qtyReceived', 0)
+        difference = request_totals[pair] - entry_data.get('qtyGrn', 0)
         values = (
             entry_data.get('timestamp'), entry_data.get('importRef'), entry_data.get('waybill'),
             entry_data.get('itemCode'), entry_data.get('itemDescription'), entry_data.get('binLocation'),
-            entry_data.get('relocateBin'), 
+            entry_data.get('relocatedBin'),
             entry_data.get('qtyReceived'), entry_data.get('qtyGrn'),
-            entry_data.get('difference')
+            difference
         )
-        cursor.execute(sql, values)
-        entry_id = cursor.lastrowid
-        conn.commit()
-        print(f"DB (save_log_entry_db): Entrada guardada con ID: {entry_id}")
-        return entry_id
+        log_id = conn.execute(SQL_INSERT_LOG, values).lastrowid
+        saved_entry = {"id": log_id, **entry_data, "difference": difference}
+        if key_info is not None:
+            conn.execute(SQL_INSERT_IDEMPOTENCY_KEY,
+                         (key_info[0], key_info[1], log_id, json.dumps(saved_entry), time.time()))
+            request_stored[key_info[0]] = (key_info[1], saved_entry)
+        results.append((saved_entry, False))
+    running_totals.update(request_totals)
+    stored.update(request_stored)
+    return results
+
+def save_log_entries_db(requests):
+    # Inserta las entradas de varias peticiones en una sola transacción (un solo commit). La
+    # diferencia acumulada se calcula a partir de grn_item_totals y se va sumando en memoria,
+    # de modo que un mismo ítem repetido dentro del grupo queda bien acumulado.
+    # requests: [(entries, idempotency), ...]; idempotency es una lista paralela a entries con
+    # (clave, hash) o None. Una clave que ya está guardada (p. ej. un reintento que llegó
+    # mientras se escribía el original) no vuelve a insertar.
+    # Cada petición va en su propio SAVEPOINT: si falla, solo se deshace esa y las demás del
+    # grupo se guardan. Devuelve, por petición, [(entrada guardada, repetida), ...] o la
+    # excepción que la hizo fallar; None si falló la transacción entera.
+    try:
+        with db_write_transaction() as conn:
+            stored = load_idempotent_entries(
+                conn, [key_info[0] for _, idempotency in requests for key_info in idempotency if key_info])
+            running_totals = {}
+            outcomes = []
+            for entries, idempotency in requests:
+                conn.execute("SAVEPOINT log_request")
+                try:
+                    outcomes.append(_insert_log_entries(conn, entries, idempotency, stored, running_totals))
+                except Exception as e:
+                    conn.execute("ROLLBACK TO log_request")
+                    logger.error("DB Error (save_log_entries_db): Petición de %d entradas descartada: %s", len(entries), e)
+                    outcomes.append(e)
+                conn.execute("RELEASE log_request")
+        logger.debug("DB (save_log_entries_db): %d peticiones guardadas en una transacción.", len(outcomes))
+        notify_log_events()
+        return outcomes
     except sqlite3.Error as e:
-        print(f"DB Error (save_log_entry_db): {e}")
-        if conn: conn.rollback()
+        logger.error("DB Error (save_log_entries_db): %s", e)
         return None
-    finally:
-        if conn: conn.close()
 
-def update_log_entry_db(log_id, entry_data_for_db): 
-    conn = None
+# --- Escritor de registros con commits agrupados ---
+# Los escaneos no se escriben desde el hilo de cada petición: se encolan y un único hilo
+# escritor toma todo lo que esté esperando (hasta LOG_WRITER_MAX_BATCH_ENTRIES entradas)
+# y lo guarda con save_log_entries_db en una sola transacción. Con muchas pistolas a la vez
+# hay un COMMIT por grupo en lugar de uno por escaneo, y las peticiones no compiten por el
+# bloqueo de escritura. Cada petición recibe un Future con sus propios resultados (o la
+# excepción si solo esa petición falló); el modo ASGI (asgi.py) lo espera sin ocupar un hilo.
+LOG_WRITER_MAX_BATCH_ENTRIES = 1000
+LOG_WRITER_GROUP_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128)
+_log_write_queue = queue.SimpleQueue()
+_log_writer_lock = threading.Lock()
+_log_writer_thread = None
+
+def submit_log_entries(entries, idempotency=None):
+    """Encola entradas para el escritor. El Future devuelve [(entrada, repetida), ...] o None."""
+    future = Future()
+    _ensure_log_writer()
+    _log_write_queue.put((list(entries), list(idempotency or [None] * len(entries)), future))
+    return future
+
+def _ensure_log_writer():
+    global _log_writer_thread
+    if _log_writer_thread is not None and _log_writer_thread.is_alive(): return
+    with _log_writer_lock:
+        if _log_writer_thread is None or not _log_writer_thread.is_alive():
+            _log_writer_thread = threading.Thread(target=_log_writer_worker, name='log-writer', daemon=True)
+            _log_writer_thread.start()
+
+def _log_writer_worker():
+    while True:
+        group = [_log_write_queue.get()]
+        entry_count = len(group[0][0])
+        while entry_count < LOG_WRITER_MAX_BATCH_ENTRIES:
+            try:
+                request_item = _log_write_queue.get_nowait()
+            except queue.Empty:
+                break
+            group.append(request_item)
+            entry_count += len(request_item[0])
+        group = [item for item in group if item[2].set_running_or_notify_cancel()]
+        if not group: continue
+        try:
+            outcomes = save_log_entries_db([(entries, idempotency) for entries, idempotency, _ in group])
+        except Exception as e:
+            logger.exception("Escritor de logs: Error guardando un grupo de %d peticiones: %s", len(group), e)
+            for _, _, future in group: future.set_exception(e)
+            continue
+        metrics.observe('inbound_log_writer_group_requests', len(group), buckets=LOG_WRITER_GROUP_BUCKETS)
+        for (_, _, future), outcome in zip(group, outcomes or [None] * len(group)):
+            if isinstance(outcome, Exception): future.set_exception(outcome)
+            else: future.set_result(outcome)
+
+def save_log_entry_db(entry_data, idempotency_key_info=None):
+    # La diferencia acumulada se calcula dentro de la transacción de escritura, para que dos
+    # escaneos simultáneos del mismo ítem no lean el mismo total.
     try:
-        conn = sqlite3.connect(DB_FILE_PATH, timeout=10)
-        cursor = conn.cursor()
-        sql = '''UPDATE logs SET 
-                    waybill = ?, 
-                    relocatedBin = ?, 
-                    qtyReceived = ?, 
-                    difference = ?,
-                    timestamp = ? 
-                 WHERE id = ?'''
-        values = (
-            entry_data_for_db.get('waybill'), 
-            entry_data_for_db.get('relocatedBin'), # Clave de BD 'relocatedBin' (con d)
-            entry_data_for_db.get('qtyReceived'), 
-            entry_data_for_db.get('difference'),
-            entry_data_for_db.get('timestamp'), 
-            log_id
-        )
-        cursor.execute(sql, values)
-        conn.commit()
-        print(f"DB (update_log_entry_db): Filas actualizadas para ID {log_id}: {cursor.rowcount}")
-        return cursor.rowcount > 0
-    except sqlite3.Error as e:
-        print(f"DB Error (update_log_entry_db) para ID {log_id}: {e}")
-        if conn: conn.rollback()
-        return False
-    finally:
-        if conn: conn.close()
+        return _single_log_entry_result(submit_log_entries([entry_data], [idempotency_key_info]).result())
+    except sqlite3.Error:
+        return None, False
 
-def load_log_data_db():
-    logs = []
-    conn = None
+def _single_log_entry_result(results):
+    if not results: return None, False
+    saved_entry, replayed = results[0]
+    logger.debug("DB (save_log_entry_db): Entrada guardada con ID: %s", saved_entry['id'])
+    return saved_entry, replayed
+
+def update_log_entry_db(log_id, entry_data_for_db): 
+    # Devuelve las filas afectadas (la editada primero y luego las posteriores del mismo
+    # GRN/ítem en orden de escaneo, cuya diferencia acumulada cambia), o None si el ID no existe.
+    values = (
+        entry_data_for_db.get('waybill'), 
+        entry_data_for_db.get('relocatedBin'), # Clave de BD 'relocatedBin' (con d)
+        entry_data_for_db.get('qtyReceived'), 
+        entry_data_for_db.get('timestamp'), 
+        log_id
+    )
     try:
-        conn = sqlite3.connect(DB_FILE_PATH)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM logs ORDER BY id DESC")
-        rows = cursor.fetchall()
-        for row in rows: logs.append(dict(row)) 
-        print(f"DB (load_log_data_db): Cargados {len(logs)} registros.") # DEBUG
-        return logs
+        with db_write_transaction() as conn:
+            original = conn.execute(SQL_SELECT_LOG_BY_ID, (log_id,)).fetchone()
+            if original is None: return None
+            conn.execute(SQL_UPDATE_LOG, values)
+            # La edición cambia el timestamp: recalcular desde la posición más temprana de las dos
+            position = (original['importRef'], original['itemCode'],
+                        min(filter(None, (original['timestamp'], entry_data_for_db.get('timestamp')))), log_id)
+            conn.execute(SQL_RECOMPUTE_DIFFERENCES, position)
+            rows = [dict(row) for row in conn.execute(SQL_SELECT_PAIR_FROM_POSITION, position)]
+            affected = [row for row in rows if row['id'] == log_id] + [row for row in rows if row['id'] != log_id]
+        logger.debug("DB (update_log_entry_db): ID %s actualizado; %d filas con diferencia recalculada.", log_id, len(affected))
+        notify_log_events()
+        return affected
     except sqlite3.Error as e:
-        print(f"DB Error (load_log_data_db): {e}")
-        return []
-    finally:
-        if conn: conn.close()
+        logger.error("DB Error (update_log_entry_db) para ID %s: %s", log_id, e)
+        return None
+
+def parse_log_filters(args):
+    """Lee los filtros del log (importRef, itemCode, waybill, date_from, date_to, include_archive) de request.args.
+
+    Las fechas son YYYY-MM-DD y date_to es inclusivo. Con include_archive (o con date_from) la
+    consulta incluye también las tablas mensuales del archivo (ver logs_source_sql). Lanza ValueError con un mensaje
+    para el usuario si una fecha no es válida.
+    """
+    filters = {}
+    for key in LOG_FILTER_COLUMNS:
+        value = (args.get(key) or '').strip()
+        if value: filters[key] = value
+    for key in ('date_from', 'date_to'):
+        value = (args.get(key) or '').strip()
+        if not value: continue
+        try:
+            filters[key] = datetime.date.fromisoformat(value)
+        except ValueError:
+            raise ValueError(f"Fecha inválida en '{key}': {value} (formato esperado YYYY-MM-DD)")
+    if str(args.get('include_archive') or '').strip().lower() in ('1', 'true', 'yes', 'on'):
+        filters['include_archive'] = True
+    return filters
+
+def build_log_filter_sql(filters):
+    clauses, params = [], []
+    for key, column in LOG_FILTER_COLUMNS.items():
+        if key in filters:
+            clauses.append(f"{column} = ?")
+            params.append(filters[key])
+    if 'date_from' in filters:
+        clauses.append("timestamp >= ?")
+        params.append(filters['date_from'].isoformat())
+    if 'date_to' in filters:
+        clauses.append("timestamp < ?")
+        params.append((filters['date_to'] + datetime.timedelta(days=1)).isoformat())
+    return clauses, params
+
+# Versión barata de 'logs' para los validadores de get_logs: cada subconsulta se resuelve
+# con un índice (MAX sobre la clave o sobre idx_logs_timestamp), sin recorrer la tabla.
+SQL_SELECT_LOGS_VERSION = '''SELECT (SELECT MAX(id) FROM main.logs),
+                                  (SELECT changedAt FROM log_events ORDER BY seq DESC LIMIT 1),
+                                  (SELECT MAX(seq) FROM log_events),
+                                  (SELECT MAX(id) FROM archive.log_archive_runs),
+                                  (SELECT MAX(finishedAt) FROM archive.log_archive_runs)'''
+LOG_JSON_OBJECT_SQL = "json_object(" + ', '.join(f"'{column}', {column}" for column in LOG_COLUMNS) + ")"
+
+def get_logs_version_db():
+    max_id, last_changed_at, last_event_id, archive_run_id, archive_finished_at = \
+        get_db_connection().execute(SQL_SELECT_LOGS_VERSION).fetchone()
+    # Hora de la última escritura (evento o pasada del archivo), no el timestamp de los datos:
+    # filas importadas o editadas con fechas pasadas también mueven Last-Modified
+    last_modified = max(filter(None, (last_changed_at, archive_finished_at)), default=None)
+    return {'maxId': max_id or 0, 'lastEventId': last_event_id or 0, 'archiveRunId': archive_run_id or 0,
+            'lastModified': last_modified}
+
+def query_logs_page_db(filters, limit, before_id=None, since_id=None):
+    # Paginación por clave (id): before_id pagina hacia atrás, since_id trae solo filas nuevas.
+    # En ambos casos la página se devuelve de la más nueva a la más antigua.
+    # SQLite arma el array JSON de la página (json_group_array): Python no crea un dict por fila.
+    # Devuelve (texto JSON, filas, hay_más, id más nuevo, id más antiguo).
+    clauses, params = build_log_filter_sql(filters)
+    if before_id is not None:
+        clauses.append("id < ?")
+        params.append(before_id)
+    if since_id is not None:
+        clauses.append("id > ?")
+        params.append(since_id)
+    where_sql = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+    order_sql = "ASC" if since_id is not None else "DESC"
+    sql = f'''WITH page AS MATERIALIZED (SELECT * FROM {logs_source_sql(filters)} {where_sql} ORDER BY id {order_sql} LIMIT ?),
+                  kept AS MATERIALIZED (SELECT * FROM page ORDER BY id {order_sql} LIMIT ?)
+             SELECT (SELECT json_group_array({LOG_JSON_OBJECT_SQL}) FROM (SELECT * FROM kept ORDER BY id DESC)),
+                    (SELECT COUNT(*) FROM kept), (SELECT COUNT(*) FROM page), (SELECT MAX(id) FROM kept), (SELECT MIN(id) FROM kept)'''
+    cursor = get_db_connection().cursor()
+    cursor.row_factory = None
+    logs_json, row_count, fetched, newest_id, oldest_id = cursor.execute(sql, params + [limit + 1, limit]).fetchone()
+    metrics.inc('inbound_db_rows_read_total', {'query': 'get_logs'}, row_count)
+    return logs_json, row_count, fetched > limit, newest_id, oldest_id
+
+# --- Archivo del log (retención) ---
+# Los GRN sin actividad salen de 'logs' hacia tablas mensuales logs_AAAA_MM (según la fecha
+# de cada fila) en inbound_log_archive.db, adjuntada como 'archive' en cada conexión. Se
+# mueve el GRN completo, así las diferencias acumuladas de un (GRN, ítem) nunca quedan
+# repartidas. 'logs' y grn_item_totals conservan solo el trabajo vigente; log_archive_summary
+# guarda una fila por (GRN, ítem) archivado, que se suma a lo recibido si el GRN vuelve a
+# tener escaneos. Las filas archivadas son de solo lectura (auditoría): get_logs y las
+# exportaciones las incluyen con include_archive=1, o con date_from para los meses del rango.
+def list_archive_months():
+    rows = get_db_connection().execute(
+        "SELECT name FROM archive.sqlite_master WHERE type = 'table' AND name GLOB 'logs_[0-9][0-9][0-9][0-9]_[0-9][0-9]'")
+    return sorted(row[0][5:].replace('_', '-') for row in rows)
+
+def logs_source_sql(filters):
+    # 'logs' o, si los filtros piden archivo, la unión de 'logs' con los meses archivados
+    if not filters.get('include_archive') and 'date_from' not in filters: return 'logs'
+    months = list_archive_months()
+    if 'date_from' in filters: months = [month for month in months if month >= filters['date_from'].isoformat()[:7]]
+    if 'date_to' in filters: months = [month for month in months if month <= filters['date_to'].isoformat()[:7]]
+    if not months: return 'logs'
+    columns = ', '.join(LOG_COLUMNS)
+    parts = [f"SELECT {columns} FROM main.logs"]
+    parts += [f"SELECT {columns} FROM archive.logs_{month.replace('-', '_')}" for month in months]
+    return f"({' UNION ALL '.join(parts)}) AS logs"
+
+def _archive_month_table(month):
+    # Filas con timestamp mal formado van a logs_0000_00
+    return f"logs_{month.replace('-', '_')}" if month and re.fullmatch(r'\d{4}-\d{2}', month) else 'logs_0000_00'
+
+def _grn_refs_where(import_refs):
+    # importRef NULL se agrupa como ''
+    where_sql = f"importRef IN ({', '.join('?' for _ in import_refs)})"
+    if '' in import_refs: where_sql = f"({where_sql} OR importRef IS NULL)"
+    return where_sql, list(import_refs)
+
+def _archive_grn_batch(conn, import_refs, active_cutoff):
+    # Dentro de la transacción de escritura: descarta los GRN que recibieron escaneos desde
+    # que se eligieron, copia sus filas a los meses del archivo, suma el resumen y las borra
+    # de 'logs' (los triggers ajustan grn_item_totals). Devuelve (GRN, filas) movidos.
+    where_sql, params = _grn_refs_where(import_refs)
+    active = {row[0] for row in conn.execute(
+        f"SELECT DISTINCT COALESCE(importRef, '') FROM logs WHERE {where_sql} AND timestamp >= ?", params + [active_cutoff])}
+    import_refs = [import_ref for import_ref in import_refs if import_ref not in active]
+    if not import_refs: return 0, 0
+    where_sql, params = _grn_refs_where(import_refs)
+    columns = ', '.join(LOG_COLUMNS)
+    months = [row[0] for row in conn.execute(f"SELECT DISTINCT substr(timestamp, 1, 7) FROM logs WHERE {where_sql}", params)]
+    for month in months:
+        table = _archive_month_table(month)
+        conn.execute(SQL_CREATE_ARCHIVE_MONTH.format(table=table))
+        conn.execute(SQL_CREATE_ARCHIVE_MONTH_INDEX.format(table=table))
+        # OR IGNORE: si una pasada anterior se cortó entre el archivo y 'logs', las filas ya copiadas se saltan
+        conn.execute(f"INSERT OR IGNORE INTO archive.{table} ({columns}) SELECT {columns} FROM logs "
+                     f"WHERE {where_sql} AND substr(timestamp, 1, 7) IS ?", params + [month])
+    conn.execute(SQL_UPSERT_ARCHIVE_SUMMARY.format(where_sql=where_sql), params)
+    row_count = conn.execute(f"DELETE FROM logs WHERE {where_sql}", params).rowcount
+    return len(import_refs), row_count
+
+def archive_logs_db():
+    """Mueve al archivo los GRN que cumplen la política de retención. Devuelve (GRN, filas) movidos."""
+    if LOG_ARCHIVE_AFTER_DAYS <= 0 and LOG_ARCHIVE_CLOSED_DAYS <= 0: return 0, 0
+    start = time.perf_counter()
+    now = datetime.datetime.now()
+    def cutoff(days):
+        return (now - datetime.timedelta(days=days)).isoformat(timespec='seconds') if days > 0 else ''
+    cutoffs = {'idle_cutoff': cutoff(LOG_ARCHIVE_AFTER_DAYS), 'closed_cutoff': cutoff(LOG_ARCHIVE_CLOSED_DAYS)}
+    import_refs = [row[0] for row in get_db_connection().execute(SQL_SELECT_ARCHIVABLE_GRNS, cutoffs)]
+    grn_count = row_count = 0
+    for batch_start in range(0, len(import_refs), LOG_ARCHIVE_BATCH_GRNS):
+        with db_write_transaction() as conn:
+            moved_grns, moved_rows = _archive_grn_batch(
+                conn, import_refs[batch_start:batch_start + LOG_ARCHIVE_BATCH_GRNS], max(cutoffs.values()))
+        grn_count += moved_grns
+        row_count += moved_rows
+    if row_count:
+        elapsed = time.perf_counter() - start
+        with db_write_transaction() as conn:
+            conn.execute(SQL_INSERT_ARCHIVE_RUN,
+                         (datetime.datetime.now().isoformat(timespec='seconds'), grn_count, row_count, elapsed))
+        metrics.inc('inbound_log_archived_rows_total', amount=row_count)
+        logger.info("Archivo: %d GRN (%d filas) movidos al archivo en %.2f s", grn_count, row_count, elapsed)
+    return grn_count, row_count
+
+def get_log_archive_status():
+    conn = get_db_connection()
+    months = []
+    for month in list_archive_months():
+        table = _archive_month_table(month)
+        months.append({"month": month, "rows": conn.execute(f"SELECT COUNT(*) FROM archive.{table}").fetchone()[0]})
+    runs = [dict(row) for row in conn.execute("SELECT * FROM archive.log_archive_runs ORDER BY id DESC LIMIT 10")]
+    return {
+        "hotRows": conn.execute("SELECT COUNT(*) FROM logs").fetchone()[0],
+        "archivedGrns": conn.execute("SELECT COUNT(DISTINCT importRef) FROM archive.log_archive_summary").fetchone()[0],
+        "months": months,
+        "recentRuns": runs,
+        "policy": {"archiveAfterDays": LOG_ARCHIVE_AFTER_DAYS, "archiveClosedAfterDays": LOG_ARCHIVE_CLOSED_DAYS},
+    }
+
+def _archive_logs_worker():
+    while True:
+        try:
+            archive_logs_db()
+        except sqlite3.Error as e:
+            logger.error("DB Error (archive_logs_db): %s", e)
+        time.sleep(LOG_ARCHIVE_INTERVAL_SECONDS)
+
+def write_log_export_xlsx(filters, output, progress=None):
+    # Libro en modo write-only: las filas van del cursor SQLite al archivo sin pasar por
+    # listas ni DataFrames. openpyxl escribe los anchos de columna antes de la primera fila,
+    # así que se calculan antes con un único agregado MAX(LENGTH()) en SQLite.
+    # progress(filas_escritas, total) se llama cada EXPORT_PROGRESS_EVERY_ROWS filas.
+    clauses, params = build_log_filter_sql(filters)
+    where_sql = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+    columns = [column for column, _ in LOG_EXPORT_COLUMNS]
+    headers = [header for _, header in LOG_EXPORT_COLUMNS]
+    conn = get_db_connection()
+    source_sql = logs_source_sql(filters)
+    length_sql = ", ".join(f"MAX(LENGTH({column}))" for column in columns)
+    row_count, *max_lengths = conn.execute(f"SELECT COUNT(*), {length_sql} FROM {source_sql} {where_sql}", params).fetchone()
+    if row_count == 0: return 0
+
+    workbook = openpyxl.Workbook(write_only=True)
+    worksheet = workbook.create_sheet('InboundLog')
+    for i, (header, max_length) in enumerate(zip(headers, max_lengths)):
+        worksheet.column_dimensions[get_column_letter(i + 1)].width = max(max_length or 0, len(header)) + 2
+    worksheet.append(headers)
+    cursor = conn.cursor()
+    cursor.row_factory = None
+    cursor.execute(f"SELECT {', '.join(columns)} FROM {source_sql} {where_sql} ORDER BY id DESC", params)
+    for rows_written, row in enumerate(cursor, 1):
+        worksheet.append(row)
+        if progress and rows_written % EXPORT_PROGRESS_EVERY_ROWS == 0: progress(rows_written, row_count)
+    workbook.save(output)
+    if progress: progress(row_count, row_count)
+    metrics.inc('inbound_db_rows_read_total', {'query': 'export_log'}, row_count)
+    return row_count
 
 def get_log_entry_by_id(log_id):
-    conn = None
     try:
-        conn = sqlite3.connect(DB_FILE_PATH)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM logs WHERE id = ?", (log_id,))
-        row = cursor.fetchone()
+        row = get_db_connection().execute(SQL_SELECT_LOG_BY_ID, (log_id,)).fetchone()
         return dict(row) if row else None
     except sqlite3.Error as e:
-        print(f"DB Error (get_log_entry_by_id) para ID {log_id}: {e}")
+        logger.error("DB Error (get_log_entry_by_id) para ID %s: %s", log_id, e)
         return None
-    finally:
-        if conn: conn.close()
 
 def get_total_received_for_grn_item(import_ref, item_code):
     total_received = 0
-    conn = None
     try:
-        conn = sqlite3.connect(DB_FILE_PATH)
-        cursor = conn.cursor()
-        sql = "SELECT SUM(qtyReceived) FROM logs WHERE importRef = ? AND itemCode = ?"
-        cursor.execute(sql, (import_ref, item_code))
-        result = cursor.fetchone()
+        result = get_db_connection().execute(SQL_SELECT_TOTAL_RECEIVED, (import_ref or '', item_code or '')).fetchone()
         if result and result[0] is not None: total_received = int(result[0])
-    except sqlite3.Error as e: print(f"DB Error (get_total_received_for_grn_item): {e}")
-    finally:
-        if conn: conn.close()
+    except sqlite3.Error as e: logger.error("DB Error (get_total_received_for_grn_item): %s", e)
     return total_received
 
+def grn_totals_source_sql(include_archive):
+    # grn_item_totals solo cubre 'logs'; con include_archive se suman los totales archivados
+    if not include_archive: return 'grn_item_totals'
+    return '''(SELECT importRef, itemCode, MAX(itemDescription) AS itemDescription,
+                      SUM(totalReceived) AS totalReceived, MAX(qtyGrn) AS qtyGrn
+               FROM (SELECT importRef, itemCode, itemDescription, totalReceived, qtyGrn FROM grn_item_totals
+                     UNION ALL
+                     SELECT importRef, itemCode, itemDescription, totalReceived, qtyGrn FROM archive.log_archive_summary)
+               GROUP BY importRef, itemCode)'''
+
+def load_grn_summary_db(include_archive=False):
+    # Recorrido directo de grn_item_totals cruzado con la cantidad esperada de grn_lines.
+    # Si la línea no está en el GRN importado se usa el qtyGrn del registro más reciente del log.
+    sql = f'''SELECT t.importRef, t.itemCode, t.itemDescription, t.totalReceived,
+                     COALESCE(g.Quantity, t.qtyGrn) AS totalExpectedGrn
+              FROM {grn_totals_source_sql(include_archive)} t
+              LEFT JOIN {erp_import.GRN_LINES_TABLE} g
+                     ON g.GRN_Number = t.importRef AND g.Item_Code = t.itemCode
+              ORDER BY t.importRef, t.itemCode'''
+    try:
+        return _read_sql_dataframe(sql, 'export_summary')
+    except sqlite3.Error as e:
+        logger.error("DB Error (load_grn_summary_db): %s", e)
+        return None
+
+def load_waybill_summary_db(include_archive=False):
+    # Única pasada sobre 'logs': total recibido y escaneos por (GRN, waybill, ítem). La
+    # descripción sale de grn_item_totals, cruzada después de agrupar (una fila por grupo).
+    source_filters = {'include_archive': True} if include_archive else {}
+    sql = f'''SELECT w.importRef, w.waybill, w.itemCode, t.itemDescription, w.totalReceived, w.scanCount
+             FROM (SELECT COALESCE(importRef, '') AS importRef, COALESCE(waybill, '') AS waybill,
+                          COALESCE(itemCode, '') AS itemCode, COALESCE(SUM(qtyReceived), 0) AS totalReceived,
+                          COUNT(*) AS scanCount
+                   FROM {logs_source_sql(source_filters)} GROUP BY 1, 2, 3) w
+             LEFT JOIN {grn_totals_source_sql(include_archive)} t ON t.importRef = w.importRef AND t.itemCode = w.itemCode
+             ORDER BY w.importRef, w.waybill, w.itemCode'''
+    try:
+        return _read_sql_dataframe(sql, 'export_summary_waybill')
+    except sqlite3.Error as e:
+        logger.error("DB Error (load_waybill_summary_db): %s", e)
+        return None
+
+def _read_sql_dataframe(sql, query_label):
+    cursor = get_db_connection().execute(sql)
+    columns = [description[0] for description in cursor.description]
+    df = pd.DataFrame.from_records([tuple(row) for row in cursor], columns=columns)
+    metrics.inc('inbound_db_rows_read_total', {'query': query_label}, len(df))
+    return df
+
+# --- Analítica de diferencias (/api/analytics/variance) ---
+# Lo que el supervisor busca en el resumen Excel, como JSON y sin armar libros: diferencia
+# por (GRN, ítem) y por GRN, % de avance frente a las cantidades del CSV de GRN y los
+# waybills y días que más aportan a las diferencias. Dos consultas agregadas en SQLite
+# (líneas y recepciones por waybill/día) y el resto con bincount / groupby. El JSON se
+# guarda por versión del log (como get_logs) y del CSV de GRN: mientras no haya escrituras
+# nuevas, volver a pedirlo no recalcula nada.
+VARIANCE_TOP_DEFAULT = 10
+VARIANCE_TOP_MAX = 100
+VARIANCE_ITEMS_DEFAULT_LIMIT = 500
+VARIANCE_ITEMS_MAX_LIMIT = 5000
+_variance_cache_lock = threading.Lock()
+variance_cache = {'version': None, 'reports': {}}
+
+def _variance_lines_sql(include_archive, import_ref):
+    # Una fila por (GRN, ítem): lo recibido (logs y, con include_archive, el archivo) y lo
+    # esperado del CSV; más las líneas del CSV de esos GRN que aún no tienen escaneos.
+    grn_filter = "WHERE importRef = ?" if import_ref is not None else ""
+    return f'''WITH totals AS MATERIALIZED (SELECT * FROM {grn_totals_source_sql(include_archive)} {grn_filter})
+               SELECT t.importRef, t.itemCode, t.itemDescription, t.totalReceived,
+                      COALESCE(g.Quantity, t.qtyGrn, 0) AS expected, g.Item_Code IS NOT NULL AS inGrn
+               FROM totals t
+               LEFT JOIN {erp_import.GRN_LINES_TABLE} g ON g.GRN_Number = t.importRef AND g.Item_Code = t.itemCode
+               UNION ALL
+               SELECT g.GRN_Number, g.Item_Code, m.Item_Description, 0, COALESCE(g.Quantity, 0), 1
+               FROM {erp_import.GRN_LINES_TABLE} g
+               LEFT JOIN {erp_import.ITEM_MASTER_TABLE} m ON m.Item_Code = g.Item_Code
+               WHERE g.GRN_Number IN (SELECT DISTINCT importRef FROM totals)
+                 AND NOT EXISTS (SELECT 1 FROM totals t WHERE t.importRef = g.GRN_Number AND t.itemCode = g.Item_Code)'''
+
+def _variance_receipts_sql(include_archive, import_ref):
+    source_filters = {'include_archive': True} if include_archive else {}
+    grn_filter = "WHERE importRef = ?" if import_ref is not None else ""
+    return f'''SELECT COALESCE(importRef, '') AS importRef, COALESCE(itemCode, '') AS itemCode,
+                      COALESCE(waybill, '') AS waybill, substr(timestamp, 1, 10) AS day,
+                      COALESCE(SUM(qtyReceived), 0) AS received, COUNT(*) AS scans
+               FROM {logs_source_sql(source_filters)} {grn_filter} GROUP BY 1, 2, 3, 4'''
+
+def _records(df):
+    return df.astype(object).where(df.notna(), None).to_dict('records')
+
+def _variance_offenders(receipts, group_column, top):
+    # Cada (GRN, ítem) reparte su diferencia entre sus recepciones según lo que aportó cada una
+    grouped = receipts.groupby(group_column, sort=False).agg(
+        scans=('scans', 'sum'), receivedQty=('received', 'sum'),
+        varianceQty=('allocated', 'sum'), discrepancyQty=('discrepancy', 'sum')).reset_index()
+    grouped = grouped[grouped['discrepancyQty'] > 0]
+    grouped = grouped.sort_values(['discrepancyQty', group_column], ascending=[False, True]).head(top)
+    grouped[['varianceQty', 'discrepancyQty']] = grouped[['varianceQty', 'discrepancyQty']].round(2)
+    return _records(grouped)
+
+def compute_variance_report(include_archive=False, import_ref=None, top=VARIANCE_TOP_DEFAULT,
+                            item_limit=VARIANCE_ITEMS_DEFAULT_LIMIT):
+    params = (import_ref,) if import_ref is not None else ()
+    conn = get_db_connection()
+    lines = pd.DataFrame.from_records(
+        [tuple(row) for row in conn.execute(_variance_lines_sql(include_archive, import_ref), params)],
+        columns=['importRef', 'itemCode', 'itemDescription', 'receivedQty', 'expectedQty', 'inGrn'])
+    receipts = pd.DataFrame.from_records(
+        [tuple(row) for row in conn.execute(_variance_receipts_sql(include_archive, import_ref), params)],
+        columns=['importRef', 'itemCode', 'waybill', 'day', 'received', 'scans'])
+    metrics.inc('inbound_db_rows_read_total', {'query': 'analytics_variance'}, len(lines) + len(receipts))
+
+    received = lines['receivedQty'].to_numpy(dtype=np.int64)
+    expected = lines['expectedQty'].to_numpy(dtype=np.int64)
+    in_grn = lines['inGrn'].to_numpy(dtype=bool)
+    variance = received - expected
+    shortage = np.clip(-variance, 0, None)
+    overage = np.clip(variance, 0, None)
+    covered = np.minimum(received, expected)  # Un exceso no tapa el faltante de otra línea
+    lines['varianceQty'] = variance
+    lines['inGrn'] = in_grn
+
+    # Por GRN: sumas con bincount sobre el código factorizado
+    codes, grn_refs = pd.factorize(lines['importRef'], sort=True)
+    grn_count = len(grn_refs)
+    def per_grn(values):
+        return np.bincount(codes, weights=values, minlength=grn_count).astype(np.int64)
+    grn_expected, grn_covered = per_grn(expected), per_grn(covered)
+    grns = pd.DataFrame({
+        'importRef': np.asarray(grn_refs, dtype=object),
+        'lineCount': np.bincount(codes, minlength=grn_count),
+        'expectedQty': grn_expected, 'receivedQty': per_grn(received), 'varianceQty': per_grn(variance),
+        'shortageQty': per_grn(shortage), 'overageQty': per_grn(overage),
+        'linesShort': per_grn(shortage > 0), 'linesOver': per_grn(overage > 0),
+        'linesMissing': per_grn((received == 0) & (expected > 0)), 'linesNotInGrn': per_grn(~in_grn),
+    })
+    with np.errstate(divide='ignore', invalid='ignore'):
+        completion = np.where(grn_expected > 0, np.round(100.0 * grn_covered / grn_expected, 1), np.nan)
+    grns['completionPct'] = completion
+    grns = grns.iloc[np.lexsort((grns['importRef'].to_numpy(), -(grns['shortageQty'] + grns['overageQty']).to_numpy()))]
+
+    discrepancies = lines[variance != 0]
+    discrepancies = discrepancies.iloc[np.argsort(-np.abs(discrepancies['varianceQty'].to_numpy()), kind='stable')]
+
+    # Reparto de la diferencia de cada línea entre sus recepciones (waybill, día)
+    if len(receipts):
+        pair_index = pd.MultiIndex.from_frame(lines[['importRef', 'itemCode']])
+        positions = pair_index.get_indexer(pd.MultiIndex.from_frame(receipts[['importRef', 'itemCode']]))
+        found = positions >= 0
+        pair_received = np.where(found, received[positions], 0)
+        pair_variance = np.where(found, variance[positions], 0)
+        receipt_qty = receipts['received'].to_numpy(dtype=np.float64)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            allocated = np.where(pair_received > 0, receipt_qty / pair_received * pair_variance, 0.0)
+        receipts['allocated'] = allocated
+        receipts['discrepancy'] = np.abs(allocated)
+        top_waybills = _variance_offenders(receipts, 'waybill', top)
+        top_days = _variance_offenders(receipts, 'day', top)
+    else:
+        top_waybills, top_days = [], []
+
+    total_expected, total_covered = int(expected.sum()), int(covered.sum())
+    return {
+        'generatedAt': datetime.datetime.now().isoformat(timespec='seconds'),
+        'includeArchive': bool(include_archive),
+        'importRef': import_ref,
+        'totals': {
+            'grnCount': grn_count, 'lineCount': len(lines),
+            'expectedQty': total_expected, 'receivedQty': int(received.sum()), 'varianceQty': int(variance.sum()),
+            'shortageQty': int(shortage.sum()), 'overageQty': int(overage.sum()),
+            'linesShort': int((shortage > 0).sum()), 'linesOver': int((overage > 0).sum()),
+            'linesMissing': int(((received == 0) & (expected > 0)).sum()), 'linesNotInGrn': int((~in_grn).sum()),
+            'completionPct': round(100.0 * total_covered / total_expected, 1) if total_expected else None,
+        },
+        'grns': _records(grns),
+        'items': _records(discrepancies.head(item_limit)[['importRef', 'itemCode', 'itemDescription', 'expectedQty',
+                                                          'receivedQty', 'varianceQty', 'inGrn']]),
+        'itemDiscrepancyCount': len(discrepancies),
+        'topWaybills': top_waybills,
+        'topDays': top_days,
+    }
+
+def get_variance_report_json(version_key, params):
+    # Un cálculo por (versión, parámetros); una versión nueva descarta todo lo anterior.
+    # El candado solo protege el diccionario: el cálculo corre fuera, y quien pide la misma
+    # clave mientras tanto espera el Future del que la está calculando.
+    with _variance_cache_lock:
+        if variance_cache['version'] != version_key:
+            variance_cache['version'] = version_key
+            variance_cache['reports'] = {}
+        future = variance_cache['reports'].get(params)
+        owner = future is None
+        if owner:
+            future = variance_cache['reports'][params] = Future()
+    if not owner: return future.result()
+    try:
+        report_json = json.dumps(compute_variance_report(*params), ensure_ascii=False)
+    except Exception as e:
+        with _variance_cache_lock:
+            # Que la próxima petición reintente en vez de recibir este error
+            if variance_cache['reports'].get(params) is future: del variance_cache['reports'][params]
+        future.set_exception(e)
+        raise
+    future.set_result(report_json)
+    return report_json
+
+SUMMARY_GRN_COLUMNS = {
+    'importRef': 'Número de GRN', 'itemCode': 'Código Ítem', 'itemDescription': 'Descripción Ítem',
+    'totalReceived': 'Total Recibido (por GRN)', 'totalExpectedGrn': 'Total Esperado para Ítem (según GRN)',
+    'difference': 'Diferencia',
+}
+SUMMARY_WAYBILL_COLUMNS = {
+    'importRef': 'Número de GRN', 'waybill': 'Waybill', 'itemCode': 'Código Ítem',
+    'itemDescription': 'Descripción Ítem', 'totalReceived': 'Total Recibido (por Waybill)', 'scanCount': 'Escaneos',
+}
+SUMMARY_POSITIVE_FONT = Font(color="0000FF", bold=True)
+SUMMARY_NEGATIVE_FONT = Font(color="FF0000", bold=True)
+
+def _append_summary_sheet(workbook, title, df, column_headers, highlight_column=None):
+    # Sin estilos celda a celda: los anchos salen de un str_len vectorizado por columna y el
+    # azul/rojo de la diferencia es una regla de formato condicional de la hoja. Las filas se
+    # pasan al libro write-only como listas de valores ya convertidos (to_numpy().tolist()),
+    # una llamada a append por fila, que es lo mínimo que admite openpyxl.
+    df = df[list(column_headers)]
+    headers = list(column_headers.values())
+    worksheet = workbook.create_sheet(title)
+    for i, (column, header) in enumerate(zip(df.columns, headers)):
+        lengths = np.char.str_len(df[column].to_numpy(dtype=str))
+        worksheet.column_dimensions[get_column_letter(i + 1)].width = max(int(lengths.max(initial=0)), len(header)) + 2
+    if highlight_column is not None and len(df):
+        letter = get_column_letter(df.columns.get_loc(highlight_column) + 1)
+        cell_range = f"{letter}2:{letter}{len(df) + 1}"
+        worksheet.conditional_formatting.add(
+            cell_range, CellIsRule(operator='greaterThan', formula=['0'], font=SUMMARY_POSITIVE_FONT))
+        worksheet.conditional_formatting.add(
+            cell_range, CellIsRule(operator='lessThan', formula=['0'], font=SUMMARY_NEGATIVE_FONT))
+    worksheet.append(headers)
+    for row in df.to_numpy(dtype=object).tolist():
+        worksheet.append(row)
+
+def write_grn_summary_xlsx(filters, output, progress=None):
+    # El resumen es de todo el log vigente; de 'filters' solo se usa include_archive (sumar el archivo).
+    # Hoja 'ResumenPorGRN' desde grn_item_totals y hoja 'ResumenPorWaybill' desde una sola
+    # pasada agrupada sobre 'logs'.
+    include_archive = bool(filters.get('include_archive'))
+    df_grn = load_grn_summary_db(include_archive)
+    df_waybill = load_waybill_summary_db(include_archive)
+    if df_grn is None or df_waybill is None:
+        raise RuntimeError("Error interno al leer los registros para el resumen")
+    if df_grn.empty:
+        logger.info("API Resumen: No hay datos en el log para generar resumen.")
+        return 0
+    total_rows = len(df_grn) + len(df_waybill)
+    if progress: progress(0, total_rows)
+
+    for column in ('totalReceived', 'totalExpectedGrn'):
+        df_grn[column] = pd.to_numeric(df_grn[column], errors='coerce').fillna(0).astype('int64')
+    df_grn['difference'] = df_grn['totalReceived'] - df_grn['totalExpectedGrn']
+    df_grn['itemDescription'] = df_grn['itemDescription'].fillna('')
+    df_waybill['itemDescription'] = df_waybill['itemDescription'].fillna('')
+
+    workbook = openpyxl.Workbook(write_only=True)
+    _append_summary_sheet(workbook, 'ResumenPorGRN', df_grn, SUMMARY_GRN_COLUMNS, highlight_column='difference')
+    if progress: progress(len(df_grn), total_rows)
+    _append_summary_sheet(workbook, 'ResumenPorWaybill', df_waybill, SUMMARY_WAYBILL_COLUMNS)
+    workbook.save(output)
+    if progress: progress(total_rows, total_rows)
+    return len(df_grn)
+
+# --- Exportaciones en segundo plano con caché de archivos ---
+# Cada exportación es un trabajo en un pool de hilos. El libro terminado se guarda en
+# 'exports' con un nombre derivado de (tipo, filtros, versión de los datos): mientras el
+# log no cambie, la misma petición reutiliza el archivo. Dos peticiones iguales
+# simultáneas comparten el mismo trabajo. Los archivos viejos se borran por edad y
+# por tamaño total de la carpeta.
+# El id del trabajo es el nombre del archivo: con varios procesos (serve.py) cualquiera
+# de ellos puede responder por un trabajo lanzado en otro. Con INBOUND_EXPORT_PROCESSES > 0
+# el libro se genera en un pool de procesos y no compite por el GIL con las peticiones.
+EXPORTS_FOLDER = os.path.join(APP_ROOT, 'exports')
+EXPORT_WORKERS = 2
+EXPORT_PROGRESS_EVERY_ROWS = 5000
+EXPORT_CACHE_MAX_AGE_SECONDS = 24 * 3600
+EXPORT_CACHE_MAX_BYTES = 500 * 1024 * 1024
+EXPORT_JOB_TTL_SECONDS = 3600         # Tiempo que se recuerda un trabajo terminado
+EXPORT_SYNC_TIMEOUT_SECONDS = 120     # Espera de /api/export_log y /api/export_summary
+EXPORT_PROCESSES = int(os.environ.get('INBOUND_EXPORT_PROCESSES', '0'))
+EXPORT_KINDS = {
+    'log': {'write': write_log_export_xlsx, 'filename_prefix': 'inbound_log', 'uses_filters': True},
+    'summary': {'write': write_grn_summary_xlsx, 'filename_prefix': 'resumen_por_grn', 'uses_filters': False},
+}
+
+_export_executor = ThreadPoolExecutor(max_workers=EXPORT_WORKERS, thread_name_prefix='export')
+_export_jobs_lock = threading.Lock()
+export_jobs = {}
+_export_process_pool_lock = threading.Lock()
+_export_process_pool = None
+
+def get_export_data_version(kind):
+    # Cambia con cada INSERT/UPDATE del log (último evento de log_events), con cada pasada
+    # del archivo que movió filas y, para el resumen, cuando se reimporta el CSV de GRN.
+    conn = get_db_connection()
+    version = {'maxId': conn.execute("SELECT MAX(id) FROM logs").fetchone()[0] or 0,
+               'lastEventId': get_last_log_event_id(),
+               'archiveRunId': conn.execute("SELECT MAX(id) FROM archive.log_archive_runs").fetchone()[0] or 0}
+    if kind == 'summary':
+        info = erp_import.get_import_info(conn, erp_import.GRN_LINES_TABLE)
+        version['grnImport'] = [info['source_mtime_ns'], info['source_size']] if info else None
+    return version
+
+def get_export_artifact_path(kind, filters):
+    key_data = {
+        'kind': kind,
+        'filters': {key: str(value) for key, value in filters.items()
+                    if EXPORT_KINDS[kind]['uses_filters'] or key == 'include_archive'},
+        'version': get_export_data_version(kind),
+    }
+    digest = hashlib.sha1(json.dumps(key_data, sort_keys=True).encode('utf-8')).hexdigest()[:20]
+    return os.path.join(EXPORTS_FOLDER, f"{kind}_{digest}.xlsx")
+
+def evict_export_artifacts():
+    if not os.path.isdir(EXPORTS_FOLDER): return
+    now = time.time()
+    artifacts = []
+    for dir_entry in os.scandir(EXPORTS_FOLDER):
+        try:
+            stat_result = dir_entry.stat()
+        except OSError:
+            continue
+        expired = now - stat_result.st_mtime > EXPORT_CACHE_MAX_AGE_SECONDS
+        if dir_entry.name.endswith('.xlsx') and not expired:
+            artifacts.append((stat_result.st_mtime, stat_result.st_size, dir_entry.path))
+        elif expired:
+            _remove_export_file(dir_entry.path)
+    total_bytes = sum(size for _, size, _ in artifacts)
+    for _, size, path in sorted(artifacts):
+        if total_bytes <= EXPORT_CACHE_MAX_BYTES: break
+        if _remove_export_file(path): total_bytes -= size
+
+def _remove_export_file(path):
+    try:
+        os.remove(path)
+        return True
+    except OSError as e:
+        # En Windows falla si el archivo se está descargando; se reintenta en la próxima limpieza
+        logger.debug("Export: No se pudo borrar %s: %s", path, e)
+        return False
+
+def _prune_export_jobs():
+    now = time.time()
+    for job_id in [job_id for job_id, job in export_jobs.items()
+                   if job['finishedAt'] is not None and now - job['finishedAt'] > EXPORT_JOB_TTL_SECONDS]:
+        del export_jobs[job_id]
+
+def _get_export_process_pool():
+    global _export_process_pool
+    with _export_process_pool_lock:
+        if _export_process_pool is None:
+            _export_process_pool = ProcessPoolExecutor(max_workers=EXPORT_PROCESSES,
+                                                       mp_context=multiprocessing.get_context('spawn'))
+        return _export_process_pool
+
+def _discard_export_process_pool():
+    global _export_process_pool
+    with _export_process_pool_lock:
+        _export_process_pool = None
+
+def _new_export_job(job_id, kind, path):
+    return {
+        'id': job_id, 'kind': kind, 'path': path, 'status': 'queued', 'cached': False,
+        'rows': 0, 'totalRows': None, 'error': None, 'createdAt': time.time(), 'finishedAt': None, 'future': None,
+    }
+
+def _set_export_job_progress(job, rows, total_rows):
+    job['rows'] = rows
+    job['totalRows'] = total_rows
+
+def write_export_file(kind, filters, path, progress=None):
+    # Se ejecuta en el hilo del trabajo o en un proceso del pool (sin progreso parcial).
+    conn = get_db_connection()
+    with open(path, 'wb') as output:
+        # Una sola transacción de lectura: conteo, anchos y filas salen de la misma foto del log
+        conn.execute("BEGIN")
+        try:
+            return EXPORT_KINDS[kind]['write'](filters, output, progress)
+        finally:
+            conn.execute("COMMIT")
+
+def _run_export_job(job, filters):
+    job['status'] = 'running'
+    start = time.perf_counter()
+    temp_path = f"{job['path']}.{uuid.uuid4().hex}.tmp"
+    try:
+        os.makedirs(EXPORTS_FOLDER, exist_ok=True)
+        if EXPORT_PROCESSES > 0:
+            row_count = _get_export_process_pool().submit(write_export_file, job['kind'], filters, temp_path).result()
+        else:
+            row_count = write_export_file(job['kind'], filters, temp_path,
+                                          lambda rows, total: _set_export_job_progress(job, rows, total))
+        if row_count == 0:
+            os.remove(temp_path)
+            job['status'] = 'empty'
+        else:
+            os.replace(temp_path, job['path'])
+            job['status'] = 'done'
+            evict_export_artifacts()
+        metrics.observe('inbound_export_build_seconds', time.perf_counter() - start, {'kind': job['kind']})
+        logger.info("Export (%s): %d filas en %.2f s -> %s", job['kind'], row_count, time.perf_counter() - start,
+                    os.path.basename(job['path']))
+    except Exception as e:
+        logger.exception("Export (%s): Error generando el archivo: %s", job['kind'], e)
+        if isinstance(e, BrokenProcessPool): _discard_export_process_pool()
+        job['status'] = 'error'
+        job['error'] = "Error interno al generar el archivo Excel"
+        if os.path.exists(temp_path): _remove_export_file(temp_path)
+    finally:
+        job['finishedAt'] = time.time()
+        metrics.inc('inbound_export_jobs_total', {'kind': job['kind'], 'result': job['status']})
+
+def submit_export_job(kind, filters):
+    # Devuelve el trabajo (dict) que produce el archivo pedido: uno ya terminado y aún en
+    # disco, uno en curso con la misma clave, o uno nuevo encolado en el pool.
+    path = get_export_artifact_path(kind, filters)
+    job_id = os.path.splitext(os.path.basename(path))[0]
+    with _export_jobs_lock:
+        _prune_export_jobs()
+        job = export_jobs.get(job_id)
+        if job is not None:
+            if job['status'] in ('queued', 'running', 'empty'): return job
+            if job['status'] == 'done' and os.path.exists(path):
+                metrics.inc('inbound_export_jobs_total', {'kind': kind, 'result': 'hit'})
+                return job
+        job = _new_export_job(job_id, kind, path)
+        export_jobs[job['id']] = job
+        if os.path.exists(path):
+            os.utime(path)  # Los archivos usados se conservan más tiempo
+            job.update(status='done', cached=True, finishedAt=time.time())
+            metrics.inc('inbound_export_jobs_total', {'kind': kind, 'result': 'hit'})
+            return job
+        job['future'] = _export_executor.submit(_run_export_job, job, filters)
+    return job
+
+def find_export_job(job_id):
+    # Trabajo de este proceso o, si lo lanzó otro proceso, reconstruido desde 'exports'
+    job = export_jobs.get(job_id)
+    kind, _, digest = job_id.partition('_')
+    if job is not None or kind not in EXPORT_KINDS or len(digest) != 20 or not all(c in '0123456789abcdef' for c in digest):
+        return job
+    path = os.path.join(EXPORTS_FOLDER, f"{job_id}.xlsx")
+    if os.path.exists(path):
+        job = _new_export_job(job_id, kind, path)
+        job.update(status='done', cached=True, finishedAt=time.time())
+        return job
+    if os.path.isdir(EXPORTS_FOLDER) and any(name.startswith(f"{job_id}.xlsx.") and name.endswith('.tmp')
+                                             for name in os.listdir(EXPORTS_FOLDER)):
+        job = _new_export_job(job_id, kind, path)
+        job['status'] = 'running'
+        return job
+    return None
+
+def export_job_to_json(job):
+    return {
+        "jobId": job['id'], "kind": job['kind'], "status": job['status'], "cached": job['cached'],
+        "rows": job['rows'], "totalRows": job['totalRows'], "error": job['error'],
+        "downloadUrl": f"/api/export_jobs/{job['id']}/download" if job['status'] == 'done' else None,
+    }
+
+def send_export_job_file(job):
+    prefix = EXPORT_KINDS[job['kind']]['filename_prefix']
+    timestamp_str = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    return send_file(
+        job['path'],
+        mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+        as_attachment=True,
+        download_name=f"{prefix}_{timestamp_str}.xlsx"
+    )
+
+def _export_job_response(job, empty_message):
+    if job['status'] == 'done': return send_export_job_file(job)
+    if job['status'] == 'empty': return jsonify({"error": empty_message}), 404
+    if job['status'] == 'error': return jsonify({"error": job['error']}), 500
+    # Sigue en curso: el cliente puede consultar el trabajo en lugar de esperar
+    return jsonify(export_job_to_json(job)), 202
+
+def wait_for_export_job(job, timeout):
+    if job['future'] is None: return
+    try:
+        job['future'].result(timeout=timeout)
+    except FutureTimeoutError:
+        pass
+
 # --- Endpoints de la API ---
 @app.route('/api/find_item/<item_code>/<import_ref>', methods=['GET'])
+@compressed_response
 def find_item(item_code, import_ref):
+    # La respuesta solo depende de los dos CSV del ERP: la versión es la firma de cada índice cargado
+    get_csv_cache_index(item_master_cache)
+    get_csv_cache_index(grn_cache)
+    signatures = (item_master_cache['signature'], grn_cache['signature'])
+    etag = make_version_etag('item', *signatures, item_code, import_ref)
+    last_modified = _http_datetime(max((signature[0] for signature in signatures if signature), default=None))
+    not_modified = not_modified_response(etag, last_modified)
+    if not_modified is not None: return not_modified
     item_details = get_item_details_from_master_csv(item_code)
     if item_details is None:
         return jsonify({"error": f"Artículo {item_code} no encontrado en el maestro."}), 404
     expected_quantity = get_grn_specific_expected_quantity(import_ref, item_code)
-    response_data = {
+    response_data = item_details_to_json(item_details, item_code)
+    response_data["defaultQtyGrn"] = expected_quantity
+    return set_validators(jsonify(response_data), etag, last_modified)
+
+def item_details_to_json(item_details, item_code):
+    return {
         "itemCode": item_details.get('Item_Code', item_code),
         "description": item_details.get('Item_Description', 'N/A'),
         "binLocation": item_details.get('Bin_1', 'N/A'),
         "aditionalBins": item_details.get('Aditional_Bin_Location', 'N/A'),
         "weight": item_details.get('Weight_per_Unit', 'N/A'),
-        "defaultQtyGrn": expected_quantity
     }
-    return jsonify(response_data), 200
 
-@app.route('/api/add_log', methods=['POST'])
-def add_log():
-    data = request.get_json()
-    print(f"API (add_log): Recibido para log: {data}")
+SQL_SELECT_GRN_PRELOAD = f'''SELECT g.Item_Code, g.Quantity,
+                                    COALESCE(t.totalReceived, 0) + COALESCE(a.totalReceived, 0) AS qtyReceived
+                             FROM {erp_import.GRN_LINES_TABLE} g
+                             LEFT JOIN grn_item_totals t ON t.importRef = g.GRN_Number AND t.itemCode = g.Item_Code
+                             LEFT JOIN archive.log_archive_summary a ON a.importRef = g.GRN_Number AND a.itemCode = g.Item_Code
+                             WHERE g.GRN_Number = ? ORDER BY g.Item_Code'''
+
+# Versión barata del GRN para el ETag de grn_preload: lastLogId avanza con cada escaneo nuevo,
+# la suma y el número de filas cambian con una edición o un borrado, y la corrida de archivo
+# cubre lo que pasa a log_archive_summary
+SQL_SELECT_GRN_VERSION = '''SELECT MAX(lastLogId), COALESCE(SUM(totalReceived), 0), COALESCE(SUM(rowCount), 0),
+                                 (SELECT MAX(id) FROM archive.log_archive_runs)
+                          FROM grn_item_totals WHERE importRef = ?'''
+
+@app.route('/api/grn/<import_ref>', methods=['GET'])
+@compressed_response
+def grn_preload(import_ref):
+    # Todas las líneas esperadas de un GRN con los datos del maestro y lo recibido hasta ahora,
+    # para que la página valide los escaneos localmente. El ETag sale de las firmas de los dos
+    # CSV del ERP y de la versión del GRN en grn_item_totals: el 304 no ejecuta la consulta.
+    item_master_index = get_csv_cache_index(item_master_cache)
+    if item_master_index is None:
+        return jsonify({"error": "Maestro de artículos no disponible"}), 503
+    get_csv_cache_index(grn_cache)
+    try:
+        conn = get_db_connection()
+        grn_version = conn.execute(SQL_SELECT_GRN_VERSION, (import_ref,)).fetchone()
+        etag = make_version_etag('grn', item_master_cache['signature'], grn_cache['signature'], *grn_version, import_ref)
+        not_modified = not_modified_response(etag)
+        if not_modified is not None: return not_modified
+        rows = conn.execute(SQL_SELECT_GRN_PRELOAD, (import_ref,)).fetchall()
+    except sqlite3.Error as e:
+        logger.error("DB Error (grn_preload) para GRN %s: %s", import_ref, e)
+        return jsonify({"error": "Error interno al leer el GRN"}), 500
+    if not rows:
+        return jsonify({"error": f"GRN {import_ref} no encontrado."}), 404
+    metrics.inc('inbound_db_rows_read_total', {'query': 'grn_preload'}, len(rows))
+    lines = []
+    for item_code, expected_quantity, qty_received in rows:
+        item_details = lookup_csv_cache(item_master_cache, item_master_index, item_code)
+        line = item_details_to_json(item_details, item_code) if item_details else {"itemCode": item_code, "inMaster": False}
+        line["defaultQtyGrn"] = expected_quantity if expected_quantity is not None else 0
+        line["qtyReceived"] = qty_received
+        lines.append(line)
+    return set_validators(jsonify({"importRef": import_ref, "lines": lines}), etag)
+
+@app.route('/api/search_items', methods=['GET'])
+def search_items():
+    # ?q=<código parcial o palabras de la descripción>&import_ref=<GRN opcional>&limit=<n>
+    query = (request.args.get('q') or '').strip()
+    import_ref = (request.args.get('import_ref') or '').strip()
+    limit = request.args.get('limit', ITEM_SEARCH_DEFAULT_LIMIT, type=int)
+    if not query:
+        return jsonify({"error": "Falta el parámetro 'q'"}), 400
+    if limit is None or limit <= 0:
+        return jsonify({"error": "'limit' debe ser un número mayor que 0"}), 400
+    limit = min(limit, ITEM_SEARCH_MAX_LIMIT)
+    item_master_index = get_csv_cache_index(item_master_cache)
+    if item_master_index is None:
+        return jsonify({"error": "Maestro de artículos no disponible"}), 503
+    try:
+        matches = search_item_codes(query, limit)
+    except sqlite3.Error as e:
+        logger.error("DB Error (search_items): %s", e)
+        return jsonify({"error": "Error interno al buscar artículos"}), 500
+    grn_index = get_csv_cache_index(grn_cache) if import_ref else None
+    results = []
+    for item_code, match_type in matches:
+        item_details = item_master_index.get(item_code)
+        if item_details is None: continue  # Maestro recargándose: la tabla ya es más nueva que el índice
+        result = item_details_to_json(item_details, item_code)
+        result["matchType"] = match_type
+        if import_ref:
+            result["defaultQtyGrn"] = grn_index.get((import_ref, item_code), 0) if grn_index is not None else 0
+        results.append(result)
+    return jsonify({"query": query, "results": results}), 200
+
+def build_log_entry(data, item_master_index, grn_index):
+    # Valida una línea de recepción y la completa con los datos del maestro y del GRN.
+    # Devuelve (entrada, None) o (None, mensaje de error).
     required_fields = ['importRef', 'waybill', 'itemCode', 'quantity']
-    if not data or not all(field in data for field in required_fields):
-        return jsonify({"error": "Faltan datos requeridos"}), 400
+    if not isinstance(data, dict) or not all(field in data for field in required_fields):
+        return None, "Faltan datos requeridos"
     try:
         quantity_received_now = int(data['quantity'])
-        if quantity_received_now <= 0: return jsonify({"error": "Cantidad debe ser > 0"}), 400
-    except (ValueError, TypeError): return jsonify({"error": "Cantidad debe ser número"}), 400
+        if quantity_received_now <= 0: return None, "Cantidad debe ser > 0"
+    except (ValueError, TypeError): return None, "Cantidad debe ser número"
 
     item_code = data['itemCode']
     import_ref = data['importRef']
-    item_details = get_item_details_from_master_csv(item_code)
-    if item_details is None: return jsonify({"error": f"Artículo {item_code} no existe."}), 400
-    
-    item_description = item_details.get('Item_Description', 'N/A')
-    original_bin = item_details.get('Bin_1', 'N/A')
-    expected_quantity_grn = get_grn_specific_expected_quantity(import_ref, item_code)
-    
-    total_already_received_for_grn_item = get_total_received_for_grn_item(import_ref, item_code)
-    new_cumulative_total_received = total_already_received_for_grn_item + quantity_received_now
-    cumulative_difference = new_cumulative_total_received - expected_quantity_grn
+    item_details = lookup_csv_cache(item_master_cache, item_master_index, item_code)
+    if item_details is None: return None, f"Artículo {item_code} no existe."
 
-    log_entry_data_for_db = { 
+    return {
         "timestamp": datetime.datetime.now().isoformat(timespec='seconds'),
         "importRef": import_ref, 
         "waybill": data['waybill'], 
         "itemCode": item_code,
-        "itemDescription": item_description, 
-        "binLocation": original_bin,
+        "itemDescription": item_details.get('Item_Description', 'N/A'), 
+        "binLocation": item_details.get('Bin_1', 'N/A'),
         "relocatedBin": data.get('relocateBin', ''), 
         "qtyReceived": quantity_received_now,
-        "qtyGrn": expected_quantity_grn, 
-        "difference": cumulative_difference
-    }
-    
-    new_log_id = save_log_entry_db(log_entry_data_for_db) 
-    if new_log_id is not None: 
-        log_entry_data_for_response = {
-            "id": new_log_id,
-            "timestamp": log_entry_data_for_db["timestamp"],
-            "importRef": log_entry_data_for_db["importRef"],
-            "waybill": log_entry_data_for_db["waybill"],
-            "itemCode": log_entry_data_for_db["itemCode"],
-            "itemDescription": log_entry_data_for_db["itemDescription"],
-            "binLocation": log_entry_data_for_db["binLocation"],
-            "relocatedBin": data.get('relocateBin', ''), # <-- CORREGIDO
-            "qtyReceived": log_entry_data_for_db["qtyReceived"],
-            "qtyGrn": log_entry_data_for_db["qtyGrn"],
-            "difference": log_entry_data_for_db["difference"]
-        }
-        print(f"API (add_log): Devolviendo entrada: {log_entry_data_for_response}")
-        return jsonify({"message": "Registro añadido con éxito", "entry": log_entry_data_for_response}), 201
-    else:
-        print(f"API (add_log): Error al guardar, new_log_id es None.")
+        "qtyGrn": lookup_csv_cache(grn_cache, grn_index, (import_ref, item_code), 0), 
+    }, None
+
+def _idempotent_add_log_response(saved_entry):
+    metrics.inc('inbound_idempotent_replays_total', {'endpoint': 'add_log'})
+    response = jsonify({"message": "Registro ya añadido (reintento)", "entry": saved_entry, "replayed": True})
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response, 201
+
+# add_log y add_logs se dividen en dos mitades: prepare_*_request valida dentro del contexto
+# de la petición y devuelve (respuesta, None) o (None, escritura pendiente); la escritura
+# ({'entries', 'idempotency', 'finish'}) pasa por el escritor agrupado y finish(resultados)
+# arma la respuesta. La vista Flask espera el Future en su hilo; asgi.py lo espera con await.
+def run_log_write(pending):
+    entries = pending['entries']
+    try:
+        results = submit_log_entries(entries, pending['idempotency']).result() if entries else []
+    except sqlite3.Error:
+        results = None  # Solo esta petición falló (ya registrado): finish responde el 500 habitual
+    return pending['finish'](results)
+
+def prepare_add_log_request():
+    data = request.get_json()
+    logger.debug("API (add_log): Recibido para log: %s", data)
+    if not data or not isinstance(data, dict):
+        return (jsonify({"error": "Faltan datos requeridos"}), 400), None
+    try:
+        idempotency_key = parse_idempotency_key(request.headers.get('Idempotency-Key') or data.get('idempotencyKey'))
+    except ValueError as e:
+        return (jsonify({"error": str(e)}), 400), None
+    key_info = None
+    if idempotency_key:
+        # Reintento de una petición ya guardada: devolver la entrada original sin validar ni escribir
+        key_info = (idempotency_key, idempotency_request_hash(data))
+        stored = load_idempotent_entries(get_db_connection(), [idempotency_key]).get(idempotency_key)
+        if stored is not None:
+            if stored[0] != key_info[1]:
+                return (jsonify({"error": "La clave de idempotencia ya se usó con otros datos"}), 422), None
+            return _idempotent_add_log_response(stored[1]), None
+    log_entry_data_for_db, error_message = build_log_entry(
+        data, get_csv_cache_index(item_master_cache), get_csv_cache_index(grn_cache))
+    if error_message:
+        return (jsonify({"error": error_message}), 400), None
+    return None, {'entries': [log_entry_data_for_db], 'idempotency': [key_info], 'finish': _finish_add_log}
+
+def _finish_add_log(results):
+    log_entry_data_for_response, replayed = _single_log_entry_result(results)
+    if log_entry_data_for_response is None:
+        logger.error("API (add_log): Error al guardar, la entrada no se insertó.")
         return jsonify({"error": "Error interno al guardar registro"}), 500
+    if replayed: return _idempotent_add_log_response(log_entry_data_for_response)
+    logger.debug("API (add_log): Devolviendo entrada: %s", log_entry_data_for_response)
+    return jsonify({"message": "Registro añadido con éxito", "entry": log_entry_data_for_response}), 201
+
+@app.route('/api/add_log', methods=['POST'])
+def add_log():
+    response, pending = prepare_add_log_request()
+    return response if pending is None else run_log_write(pending)
+
+def prepare_add_logs_request():
+    # Lote de líneas de recepción: {"lines": [{importRef, waybill, itemCode, quantity, relocateBin}, ...]}
+    # Todas se validan primero; las válidas se guardan en una sola transacción y se devuelve
+    # un resultado por línea (en el mismo orden) con la entrada creada o el error.
+    # Cada línea puede traer su idempotencyKey: las ya guardadas devuelven la entrada original
+    # ("replayed": true), así un lote reenviado tras un corte no duplica escaneos.
+    data = request.get_json(silent=True)
+    lines = data.get('lines') if isinstance(data, dict) else data
+    if not isinstance(lines, list) or not lines:
+        return (jsonify({"error": "Se esperaba una lista 'lines' con al menos una línea"}), 400), None
+    if len(lines) > ADD_LOGS_MAX_LINES:
+        return (jsonify({"error": f"Máximo {ADD_LOGS_MAX_LINES} líneas por lote"}), 400), None
+    logger.debug("API (add_logs): Recibido lote de %d líneas.", len(lines))
+
+    key_infos = []
+    for line in lines:
+        try:
+            key = parse_idempotency_key(line.get('idempotencyKey')) if isinstance(line, dict) else None
+        except ValueError:
+            key = None  # La línea se rechaza abajo
+        key_infos.append((key, idempotency_request_hash(line)) if key else None)
+    stored = load_idempotent_entries(get_db_connection(), [key_info[0] for key_info in key_infos if key_info])
+
+    item_master_index = get_csv_cache_index(item_master_cache)
+    grn_index = get_csv_cache_index(grn_cache)
+    results = []
+    valid_entries = []
+    valid_key_infos = []
+    replay_count = 0
+    for position, (line, key_info) in enumerate(zip(lines, key_infos)):
+        if isinstance(line, dict) and line.get('idempotencyKey') not in (None, '') and key_info is None:
+            results.append({"index": position, "error": "Clave de idempotencia inválida"})
+            continue
+        if key_info is not None and key_info[0] in stored:
+            request_hash, saved_entry = stored[key_info[0]]
+            if request_hash != key_info[1]:
+                results.append({"index": position, "error": "La clave de idempotencia ya se usó con otros datos"})
+            else:
+                results.append({"index": position, "entry": saved_entry, "replayed": True})
+                replay_count += 1
+            continue
+        entry, error_message = build_log_entry(line, item_master_index, grn_index)
+        if error_message:
+            results.append({"index": position, "error": error_message})
+        else:
+            results.append({"index": position, "entry": entry})
+            valid_entries.append(entry)
+            valid_key_infos.append(key_info)
+
+    if not valid_entries and not replay_count:
+        return (jsonify({"error": "Ninguna línea del lote es válida", "results": results}), 400), None
+    return None, {'entries': valid_entries, 'idempotency': valid_key_infos,
+                  'finish': functools.partial(_finish_add_logs, results, replay_count)}
+
+def _finish_add_logs(results, replay_count, saved):
+    if saved is None:
+        return jsonify({"error": "Error interno al guardar el lote"}), 500
+    saved_iter = iter(saved)
+    for result in results:
+        if 'entry' in result and not result.get('replayed'):
+            result['entry'], replayed = next(saved_iter)
+            if replayed:
+                result['replayed'] = True
+                replay_count += 1
+    if replay_count: metrics.inc('inbound_idempotent_replays_total', {'endpoint': 'add_logs'}, replay_count)
+    error_count = sum(1 for result in results if 'error' in result)
+    added_count = len(results) - error_count - replay_count
+    message = f"{added_count} registros añadidos"
+    if replay_count: message += f", {replay_count} ya registrados"
+    if error_count: message += f", {error_count} con error"
+    return jsonify({"message": message, "results": results}), 201 if error_count == 0 else 207
+
+@app.route('/api/add_logs', methods=['POST'])
+def add_logs():
+    response, pending = prepare_add_logs_request()
+    return response if pending is None else run_log_write(pending)
+
+# Vistas cuya escritura asgi.py espera de forma asíncrona (endpoint -> prepare_*_request)
+LOG_WRITE_VIEWS = {'add_log': prepare_add_log_request, 'add_logs': prepare_add_logs_request}
+
+# --- Importación de sesiones sin red (/api/import_log) ---
+# Cuando se cae la red los muelles anotan las recepciones en papel o en una planilla. En vez
+# de volver a teclearlas una por una, se sube el archivo (CSV o XLSX con las columnas de
+# export_log; Item Description, Bin, Qty. GRN y Difference se ignoran y se recalculan):
+#   - Se lee fila a fila (csv.reader / openpyxl read-only) y cada fila se valida contra los
+#     mismos índices del maestro y del GRN que add_log. Nada se escribe si el archivo no se
+#     puede leer entero.
+#   - Las filas válidas se guardan en orden de timestamp, en bloques de IMPORT_LOG_CHUNK_ROWS
+#     que pasan por el escritor agrupado (un COMMIT por bloque, intercalado con los escaneos
+#     en vivo). La diferencia acumulada sigue desde los totales ya guardados.
+#   - Cada fila lleva una clave de idempotencia (SHA-1 del archivo + número de línea): volver
+#     a subir el mismo archivo, p. ej. tras un corte a mitad, solo agrega lo que faltó.
+IMPORT_LOG_CHUNK_ROWS = 1000
+IMPORT_LOG_MAX_ROWS = 200000
+IMPORT_LOG_MAX_REPORTED_ERRORS = 500
+IMPORT_LOG_REQUIRED_COLUMNS = ['importRef', 'waybill', 'itemCode', 'qtyReceived']
+IMPORT_LOG_HEADER_ALIASES = {
+    **{column.lower(): column for column, _ in LOG_EXPORT_COLUMNS},
+    **{header.lower(): column for column, header in LOG_EXPORT_COLUMNS},
+    'quantity': 'qtyReceived', 'relocatebin': 'relocatedBin',
+}
+
+def _import_cell_text(value):
+    # Las celdas de Excel llegan tipadas: 21049 -> '21049', 5.0 -> '5', fechas -> ISO
+    if value is None: return ''
+    if isinstance(value, float) and value.is_integer(): value = int(value)
+    if isinstance(value, datetime.datetime): return value.isoformat(timespec='seconds')
+    return str(value).strip()
+
+def detect_import_format(upload, filename):
+    extension = os.path.splitext(filename or '')[1].lower()
+    if extension in ('.csv', '.txt'): return 'csv'
+    if extension in ('.xlsx', '.xlsm'): return 'xlsx'
+    magic = upload.read(4)
+    upload.seek(0)
+    return 'xlsx' if magic == b'PK\x03\x04' else 'csv'
+
+def read_import_rows(upload, file_format):
+    """Devuelve (separador decimal, generador de (número de línea, [textos])) del archivo subido."""
+    if file_format == 'xlsx': return '.', _iter_xlsx_rows(upload)
+    text = TextIOWrapper(upload, encoding='utf-8-sig', newline='')
+    try:
+        first_line = text.readline()
+    except UnicodeDecodeError:
+        text.detach()
+        raise ValueError("El CSV debe estar guardado en UTF-8")
+    # Excel en español guarda los CSV con ';' y coma decimal
+    delimiter = max(',;\t', key=first_line.count)
+    return (',' if delimiter == ';' else '.'), _iter_csv_rows(text, first_line, delimiter)
+
+def _iter_xlsx_rows(upload):
+    workbook = openpyxl.load_workbook(upload, read_only=True, data_only=True)
+    try:
+        for line_number, row in enumerate(workbook.worksheets[0].iter_rows(values_only=True), 1):
+            yield line_number, [_import_cell_text(value) for value in row]
+    finally:
+        workbook.close()
+
+def _iter_csv_rows(text, first_line, delimiter):
+    try:
+        reader = csv.reader(itertools.chain([first_line], text), delimiter=delimiter)
+        for row in reader:
+            yield reader.line_num, [value.strip() for value in row]
+    except UnicodeDecodeError:
+        raise ValueError("El CSV debe estar guardado en UTF-8")
+    finally:
+        text.detach()
+
+def _import_header_positions(row):
+    positions = {}
+    for position, header in enumerate(row):
+        column = IMPORT_LOG_HEADER_ALIASES.get(header.strip().lower())
+        if column is not None: positions.setdefault(column, position)
+    missing = [header for column, header in LOG_EXPORT_COLUMNS
+               if column in IMPORT_LOG_REQUIRED_COLUMNS and column not in positions]
+    if missing: raise ValueError(f"Faltan columnas en el archivo: {', '.join(missing)}")
+    return positions
+
+def _import_quantity(text, decimal_separator='.'):
+    # '2.0' (o '2,0' en un CSV con ';') cuenta como 2. Lanza ValueError con el motivo del rechazo;
+    # cero y negativos los rechaza build_log_entry como en add_log.
+    normalized = text.replace(',', '.') if decimal_separator == ',' and '.' not in text else text
+    try:
+        number = float(normalized)
+    except ValueError:
+        if ',' in text and decimal_separator == '.':
+            raise ValueError(f"Cantidad debe ser número ({text}): en un CSV separado por comas use punto decimal")
+        raise ValueError("Cantidad debe ser número")
+    if not number.is_integer(): raise ValueError(f"Cantidad debe ser un número entero ({text})")
+    return int(number)
+
+def _import_timestamp(text):
+    if not text: return None
+    parsed = datetime.datetime.fromisoformat(text)  # ValueError si no es ISO
+    if parsed.tzinfo is not None: parsed = parsed.astimezone().replace(tzinfo=None)
+    return parsed.isoformat(timespec='seconds')
+
+def parse_import_log_file(upload, file_format, item_master_index, grn_index):
+    # Devuelve ([(línea, entrada, datos de la fila)], [rechazos], filas de datos leídas)
+    positions = None
+    accepted, rejected = [], []
+    row_count = 0
+    decimal_separator, rows = read_import_rows(upload, file_format)
+    for line_number, row in rows:
+        if not any(row): continue
+        if positions is None:
+            positions = _import_header_positions(row)
+            continue
+        row_count += 1
+        if row_count > IMPORT_LOG_MAX_ROWS:
+            raise ValueError(f"Máximo {IMPORT_LOG_MAX_ROWS} filas por archivo")
+        values = {column: row[position] if position < len(row) else '' for column, position in positions.items()}
+        entry, error_message = None, "Faltan datos requeridos"
+        if values['importRef'] and values['itemCode'] and values['qtyReceived']:
+            try:
+                quantity = _import_quantity(values['qtyReceived'], decimal_separator)
+            except ValueError as e:
+                error_message = str(e)
+            else:
+                entry, error_message = build_log_entry(
+                    {'importRef': values['importRef'], 'waybill': values['waybill'], 'itemCode': values['itemCode'],
+                     'quantity': quantity, 'relocateBin': values.get('relocatedBin', '')},
+                    item_master_index, grn_index)
+        if entry is not None:
+            try:
+                entry['timestamp'] = _import_timestamp(values.get('timestamp')) or entry['timestamp']
+            except ValueError:
+                entry, error_message = None, "Timestamp inválido"
+        if entry is None:
+            rejected.append({"line": line_number, "importRef": values['importRef'],
+                             "itemCode": values['itemCode'], "error": error_message})
+        else:
+            accepted.append((line_number, entry, values))
+    if positions is None: raise ValueError("El archivo está vacío")
+    return accepted, rejected, row_count
+
+def import_log_entries(entries, key_infos):
+    # Un bloque a la vez: los escaneos en vivo que llegan entre bloques no esperan a todo el archivo.
+    # El escritor acumula la diferencia en orden de id; al final, las filas importadas (con fecha
+    # pasada) y las posteriores de cada (GRN, ítem) se recalculan en orden de escaneo. También
+    # las repetidas: volver a subir el archivo completa un recálculo que no llegó a hacerse.
+    saved = []
+    complete = True
+    for start in range(0, len(entries), IMPORT_LOG_CHUNK_ROWS):
+        try:
+            results = submit_log_entries(entries[start:start + IMPORT_LOG_CHUNK_ROWS],
+                                         key_infos[start:start + IMPORT_LOG_CHUNK_ROWS]).result()
+        except sqlite3.Error:
+            results = None
+        if results is None:
+            complete = False
+            break
+        saved.extend(results)
+    positions = {}
+    for saved_entry, _ in saved:
+        pair = (saved_entry.get('importRef'), saved_entry.get('itemCode'))
+        position = (saved_entry['timestamp'], saved_entry['id'])
+        if pair not in positions or position < positions[pair]: positions[pair] = position
+    try:
+        recompute_differences_db(positions)
+    except sqlite3.Error as e:
+        logger.error("DB Error (import_log_entries): recálculo de diferencias: %s", e)
+        complete = False
+    return saved, complete
+
+def recompute_differences_db(positions):
+    # positions: {(importRef, itemCode): (timestamp, id)} desde donde recalcular cada par
+    if not positions: return
+    with db_write_transaction() as conn:
+        for (import_ref, item_code), (timestamp, log_id) in positions.items():
+            conn.execute(SQL_RECOMPUTE_DIFFERENCES, (import_ref, item_code, timestamp, log_id))
+    notify_log_events()
+
+def _file_sha1(upload):
+    digest = hashlib.sha1()
+    for chunk in iter(lambda: upload.read(1024 * 1024), b''): digest.update(chunk)
+    upload.seek(0)
+    return digest.hexdigest()
+
+@app.route('/api/import_log', methods=['POST'])
+def import_log():
+    # multipart/form-data con el archivo en el campo 'file'
+    upload = request.files.get('file')
+    if upload is None or not upload.filename:
+        return jsonify({"error": "Adjunte el archivo CSV o XLSX en el campo 'file'"}), 400
+    item_master_index = get_csv_cache_index(item_master_cache)
+    if item_master_index is None:
+        return jsonify({"error": "Maestro de artículos no disponible"}), 503
+    started = time.perf_counter()
+    file_format = detect_import_format(upload.stream, upload.filename)
+    file_sha1 = _file_sha1(upload.stream)
+    try:
+        accepted, rejected, row_count = parse_import_log_file(
+            upload.stream, file_format, item_master_index, get_csv_cache_index(grn_cache))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:  # openpyxl/zipfile con un archivo que no es un libro válido
+        logger.warning("API (import_log): No se pudo leer '%s' como %s: %s", upload.filename, file_format, e)
+        return jsonify({"error": f"No se pudo leer el archivo como {file_format.upper()}"}), 400
+
+    accepted.sort(key=lambda item: item[1]['timestamp'])  # Estable: mismo timestamp -> orden del archivo
+    key_infos = [(f"import:{file_sha1[:24]}:{line_number}", idempotency_request_hash(values))
+                 for line_number, _, values in accepted]
+    saved, complete = import_log_entries([entry for _, entry, _ in accepted], key_infos)
+    replay_count = sum(1 for _, replayed in saved if replayed)
+    report = {
+        "file": upload.filename, "format": file_format, "rows": row_count,
+        "imported": len(saved) - replay_count, "replayed": replay_count, "rejected": len(rejected),
+        "rejectedLines": rejected[:IMPORT_LOG_MAX_REPORTED_ERRORS],
+        "rejectedLinesTruncated": len(rejected) > IMPORT_LOG_MAX_REPORTED_ERRORS,
+        "seconds": round(time.perf_counter() - started, 3),
+    }
+    for result, count in (('imported', report['imported']), ('replayed', replay_count), ('rejected', len(rejected))):
+        if count: metrics.inc('inbound_log_import_rows_total', {'result': result}, count)
+    logger.info("API (import_log): '%s' (%s): %d filas, %d importadas, %d ya registradas, %d rechazadas en %.2fs.",
+                upload.filename, file_format, row_count, report['imported'], replay_count, len(rejected), report['seconds'])
+    if not complete:
+        logger.error("API (import_log): Error al guardar un bloque; se detuvo tras %d filas.", len(saved))
+        return jsonify({"error": "Error interno al guardar; vuelva a subir el archivo para completar", **report}), 500
+    if not accepted:
+        return jsonify({"error": "Ninguna fila del archivo es válida", **report}), 400
+    message = f"{report['imported']} registros importados"
+    if replay_count: message += f", {replay_count} ya registrados"
+    if rejected: message += f", {len(rejected)} rechazados"
+    return jsonify({"message": message, **report}), 201 if not rejected else 207
 
 @app.route('/api/update_log/<int:log_id>', methods=['PUT'])
 def update_log(log_id):
     data = request.get_json(silent=True) 
-    print(f"API (update_log): Recibido para actualizar log ID {log_id}. Datos parseados: {data}")
+    logger.debug("API (update_log): Recibido para actualizar log ID %s. Datos parseados: %s", log_id, data)
 
     if data is None: 
         return jsonify({"error": "No se recibieron datos JSON válidos."}), 400
@@ -290,10 +2343,10 @@ def update_log(log_id):
             
     if missing_keys:
         error_message = f"Faltan datos requeridos para la actualización: {', '.join(missing_keys)}"
-        print(f"API (update_log): Validación fallida. {error_message}")
+        logger.info("API (update_log): Validación fallida. %s", error_message)
         return jsonify({"error": error_message}), 400
     
-    print("API (update_log): Todos los campos requeridos del frontend están presentes.")
+    logger.debug("API (update_log): Todos los campos requeridos del frontend están presentes.")
 
     try:
         qty_received_updated = int(data[key_from_frontend_qtyReceived]) 
@@ -302,176 +2355,256 @@ def update_log(log_id):
     except (ValueError, TypeError):
         return jsonify({"error": "Cantidad recibida debe ser un número válido"}), 400
 
-    original_log_entry = get_log_entry_by_id(log_id)
-    if not original_log_entry:
-        return jsonify({"error": f"Registro de log con ID {log_id} no encontrado."}), 404
-
-    original_qty_grn = original_log_entry['qtyGrn'] 
-    updated_difference = qty_received_updated - original_qty_grn
-
     updated_log_data_for_db = {
         "waybill": data[key_from_frontend_waybill], 
         "relocatedBin": data[key_from_frontend_relocateBin], 
         "qtyReceived": qty_received_updated,
-        "difference": updated_difference,
         "timestamp": datetime.datetime.now().isoformat(timespec='seconds'),
     }
     
-    if update_log_entry_db(log_id, updated_log_data_for_db):
-        full_updated_entry_for_response = {
-            "id": log_id,
-            "importRef": original_log_entry['importRef'],
-            "waybill": updated_log_data_for_db["waybill"],
-            "itemCode": original_log_entry['itemCode'],
-            "itemDescription": original_log_entry['itemDescription'],
-            "binLocation": original_log_entry['binLocation'],
-            "relocatedBin": updated_log_data_for_db["relocatedBin"], # <-- CORREGIDO
-            "qtyReceived": updated_log_data_for_db["qtyReceived"],
-            "qtyGrn": original_log_entry['qtyGrn'],
-            "difference": updated_log_data_for_db["difference"],
-            "timestamp": updated_log_data_for_db["timestamp"] 
-        }
-        print(f"API (update_log): Devolviendo entrada actualizada al frontend: {full_updated_entry_for_response}")
-        return jsonify({"message": "Registro actualizado con éxito", "entry": full_updated_entry_for_response}), 200
-    else:
-        return jsonify({"error": "Error interno o ID no encontrado al actualizar el registro en BD"}), 500
+    affected_entries = update_log_entry_db(log_id, updated_log_data_for_db)
+    if affected_entries is None:
+        if get_log_entry_by_id(log_id) is None:
+            return jsonify({"error": f"Registro de log con ID {log_id} no encontrado."}), 404
+        return jsonify({"error": "Error interno al actualizar el registro en BD"}), 500
+    full_updated_entry_for_response = affected_entries[0]
+    logger.debug("API (update_log): Devolviendo entrada actualizada al frontend: %s", full_updated_entry_for_response)
+    return jsonify({
+        "message": "Registro actualizado con éxito",
+        "entry": full_updated_entry_for_response,
+        "adjustedEntries": affected_entries[1:],
+    }), 200
 
 @app.route('/api/get_logs', methods=['GET'])
+@compressed_response
 def get_logs():
-    logs = load_log_data_db()
-    return jsonify(logs), 200
+    try:
+        filters = parse_log_filters(request.args)
+        limit = request.args.get('limit', LOGS_PAGE_DEFAULT_LIMIT, type=int)
+        before_id = request.args.get('before_id', type=int)
+        since_id = request.args.get('since_id', type=int)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if limit is None or limit <= 0:
+        return jsonify({"error": "'limit' debe ser un número mayor que 0"}), 400
+    if before_id is not None and since_id is not None:
+        return jsonify({"error": "Use 'before_id' o 'since_id', no ambos"}), 400
+    limit = min(limit, LOGS_PAGE_MAX_LIMIT)
+    try:
+        # Se lee antes que la página: un cambio que caiga en medio llega igual por /api/log_stream
+        # (y la próxima consulta ve otra versión, así que no se sirve un 304 con datos viejos)
+        version = get_logs_version_db()
+        etag = make_version_etag('logs', version['maxId'], version['lastEventId'], version['archiveRunId'],
+                                 request.query_string.decode('latin-1'))
+        last_modified = _http_datetime(version['lastModified'])
+        not_modified = not_modified_response(etag, last_modified)
+        if not_modified is not None: return not_modified
+        logs_json, row_count, has_more, newest_id, oldest_id = query_logs_page_db(
+            filters, limit, before_id=before_id, since_id=since_id)
+    except sqlite3.Error as e:
+        logger.error("DB Error (get_logs): %s", e)
+        return jsonify({"error": "Error interno al leer los registros"}), 500
+    latest_id = newest_id if row_count else since_id
+    next_before_id = oldest_id if row_count and has_more and since_id is None else None
+    body = (f'{{"hasMore":{json.dumps(has_more)},"lastEventId":{version["lastEventId"]},'
+            f'"latestId":{json.dumps(latest_id)},"logs":{logs_json},"nextBeforeId":{json.dumps(next_before_id)}}}')
+    return set_validators(json_response(body), etag, last_modified)
+
+def _format_sse(event_id, event_type=None, data=None):
+    lines = [f"id: {event_id}"]
+    if event_type: lines.append(f"event: {event_type}")
+    if data is not None: lines.append(f"data: {json.dumps(data, ensure_ascii=False)}")
+    return '\n'.join(lines) + '\n\n'
+
+def _release_log_stream_client():
+    with _log_events_condition:
+        log_stream_state['clients'] -= 1
+
+def _log_stream_generator(last_event_id):
+    deadline = time.monotonic() + LOG_STREAM_MAX_SECONDS
+    yield f"retry: {LOG_STREAM_RETRY_MS}\n\n"
+    last_write = time.monotonic()
+    try:
+        while True:
+            generation = log_stream_state['generation']
+            events, last_seq, has_more = query_log_events_after_db(last_event_id, LOG_STREAM_BATCH_LIMIT)
+            if events is None:
+                last_event_id = get_last_log_event_id()
+                yield _format_sse(last_event_id, 'reset', {})
+                last_write = time.monotonic()
+                continue
+            for event_id, kind, entry in events:
+                yield _format_sse(event_id, 'log', {"kind": kind, "entry": entry})
+            if last_seq != last_event_id:
+                # Si los últimos eventos eran de registros borrados, avanzar igual el id del cliente
+                if not events or events[-1][0] != last_seq: yield _format_sse(last_seq)
+                metrics.inc('inbound_log_stream_events_total', amount=len(events))
+                last_event_id = last_seq
+                last_write = time.monotonic()
+            if has_more: continue
+            now = time.monotonic()
+            if now >= deadline: return
+            if now - last_write >= LOG_STREAM_HEARTBEAT_SECONDS:
+                yield ": keepalive\n\n"
+                last_write = now
+            wait_for_log_events(generation, min(LOG_STREAM_POLL_SECONDS, deadline - now))
+    except sqlite3.Error as e:
+        # El navegador reconecta solo y retoma desde el último id recibido
+        logger.error("DB Error (log_stream): %s", e)
+
+@app.route('/api/log_stream', methods=['GET'])
+def log_stream():
+    # Server-sent events con los registros nuevos o modificados. Para retomar, el navegador
+    # envía Last-Event-ID al reconectar; la primera conexión puede pasar ?last_event_id=
+    # (el 'lastEventId' de /api/get_logs). Sin id, solo se envían los cambios desde ahora.
+    raw_last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    try:
+        last_event_id = int(raw_last_event_id) if raw_last_event_id else None
+    except ValueError:
+        return jsonify({"error": "Last-Event-ID inválido"}), 400
+    with _log_events_condition:
+        if log_stream_state['clients'] >= LOG_STREAM_MAX_CLIENTS:
+            return jsonify({"error": "Demasiados clientes conectados al stream de registros"}), 503
+        log_stream_state['clients'] += 1
+    try:
+        if last_event_id is None: last_event_id = get_last_log_event_id()
+    except sqlite3.Error as e:
+        _release_log_stream_client()
+        logger.error("DB Error (log_stream): %s", e)
+        return jsonify({"error": "Error interno al leer los registros"}), 500
+    response = Response(_log_stream_generator(last_event_id), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    response.call_on_close(_release_log_stream_client)
+    return response
+
+@app.route('/api/log_archive', methods=['GET'])
+def log_archive_status():
+    try:
+        return jsonify(get_log_archive_status()), 200
+    except sqlite3.Error as e:
+        logger.error("DB Error (log_archive_status): %s", e)
+        return jsonify({"error": "Error interno al leer el archivo"}), 500
+
+@app.route('/api/log_archive/run', methods=['POST'])
+def run_log_archive():
+    # Ejecuta ahora la pasada que el hilo de fondo hace cada LOG_ARCHIVE_INTERVAL_SECONDS
+    try:
+        grn_count, row_count = archive_logs_db()
+    except sqlite3.Error as e:
+        logger.error("DB Error (run_log_archive): %s", e)
+        return jsonify({"error": "Error interno al archivar registros"}), 500
+    return jsonify({"archivedGrns": grn_count, "archivedRows": row_count}), 200
+
+@app.route('/api/cache_status', methods=['GET'])
+def cache_status():
+    return jsonify({
+        "itemMaster": get_csv_cache_stats(item_master_cache),
+        "grn": get_csv_cache_stats(grn_cache),
+    }), 200
+
+@app.route('/api/db_status', methods=['GET'])
+def db_status():
+    return jsonify(get_db_pool_stats()), 200
+
+@app.route('/api/metrics', methods=['GET'])
+def metrics_endpoint():
+    gauges = []
+    for cache in (item_master_cache, grn_cache):
+        labels = {'cache': cache['name']}
+        gauges.append(('inbound_csv_cache_rows', labels, cache['row_count']))
+        gauges.append(('inbound_csv_cache_keys', labels, cache['key_count']))
+        gauges.append(('inbound_csv_cache_load_seconds', labels, cache['load_seconds']))
+    gauges.append(('inbound_db_connections_opened', None, db_pool_stats['connections_opened']))
+    gauges.append(('inbound_log_stream_clients', None, log_stream_state['clients']))
+    return Response(metrics.render(gauges), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+@app.route('/api/export_jobs', methods=['POST'])
+def create_export_job():
+    # {"kind": "log" | "summary", ...filtros del log}; también se aceptan como query string.
+    data = request.get_json(silent=True)
+    params = data if isinstance(data, dict) else request.args
+    kind = params.get('kind', 'log')
+    if kind not in EXPORT_KINDS:
+        return jsonify({"error": f"Tipo de exportación desconocido: {kind}"}), 400
+    try:
+        filters = parse_log_filters(params)
+        job = submit_export_job(kind, filters)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except sqlite3.Error as e:
+        logger.error("DB Error (create_export_job): %s", e)
+        return jsonify({"error": "Error interno al preparar la exportación"}), 500
+    return jsonify(export_job_to_json(job)), 200 if job['status'] == 'done' else 202
+
+@app.route('/api/export_jobs/<job_id>', methods=['GET'])
+def get_export_job(job_id):
+    job = find_export_job(job_id)
+    if job is None:
+        return jsonify({"error": "Trabajo de exportación no encontrado o expirado"}), 404
+    return jsonify(export_job_to_json(job)), 200
+
+@app.route('/api/export_jobs/<job_id>/download', methods=['GET'])
+def download_export_job(job_id):
+    job = find_export_job(job_id)
+    if job is None:
+        return jsonify({"error": "Trabajo de exportación no encontrado o expirado"}), 404
+    if job['status'] != 'done':
+        return jsonify(export_job_to_json(job)), 409
+    if not os.path.exists(job['path']):
+        return jsonify({"error": "El archivo ya no está disponible; vuelva a exportar"}), 410
+    return send_export_job_file(job)
 
 @app.route('/api/export_log', methods=['GET'])
 def export_log():
+    # Descarga directa (compatibilidad): usa el mismo trabajo/caché que /api/export_jobs
     try:
-        logs_data = load_log_data_db()
-        print(f"API (export_log): Datos cargados de la BD para exportar: {len(logs_data)} registros.") # DEBUG
-        if logs_data and len(logs_data) > 0: # DEBUG: Imprimir una muestra
-            print(f"API (export_log): Muestra del primer registro para exportar: {logs_data[0]}")
-            if len(logs_data) > 1:
-                 print(f"API (export_log): Muestra del último registro para exportar: {logs_data[-1]}")
-
-
-        if not logs_data:
-            return jsonify({"error": "No hay registros para exportar"}), 404
-        
-        df = pd.DataFrame(logs_data)
-        # Asegurarse de que los nombres de columna en la selección coincidan con la BD
-        # La columna en la BD es 'relocatedBin' (con 'd')
-        df_export = df[[
-            'timestamp', 'importRef', 'waybill', 'itemCode', 'itemDescription',
-            'binLocation', 'relocatedBin', 'qtyReceived', 'qtyGrn', 'difference'
-        ]].rename(columns={
-            'timestamp': 'Timestamp', 'importRef': 'GRN 1.', 'waybill': 'Waybill',
-            'itemCode': 'Item Code', 'itemDescription': 'Item Description',
-            'binLocation': 'Bin Location (Original)', 'relocatedBin': 'Relocated Bin (New)',
-            'qtyReceived': 'Qty. Received', 'qtyGrn': 'Qty. GRN', 'difference': 'Difference'
-        })
-        output = BytesIO()
-        with pd.ExcelWriter(output, engine='openpyxl') as writer:
-            df_export.to_excel(writer, index=False, sheet_name='InboundLog')
-            worksheet = writer.sheets['InboundLog']
-            for i, col_name in enumerate(df_export.columns):
-                 column_letter = get_column_letter(i + 1)
-                 max_len = max(
-                     df_export[col_name].astype(str).map(len).max(),
-                     len(col_name)
-                 ) + 2
-                 worksheet.column_dimensions[column_letter].width = max_len
-        output.seek(0)
-        timestamp_str = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-        filename = f"inbound_log_{timestamp_str}.xlsx"
-        return send_file(
-            output,
-            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-            as_attachment=True,
-            download_name=filename
-        )
-    except Exception as e:
-        print(f"Error durante la exportación a Excel: {e}")
-        import traceback
-        traceback.print_exc()
+        filters = parse_log_filters(request.args)
+        job = submit_export_job('log', filters)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except sqlite3.Error as e:
+        logger.error("DB Error (export_log): %s", e)
         return jsonify({"error": "Error interno al generar el archivo Excel"}), 500
+    wait_for_export_job(job, EXPORT_SYNC_TIMEOUT_SECONDS)
+    return _export_job_response(job, "No hay registros para exportar")
 
 @app.route('/api/export_summary', methods=['GET'])
 def export_summary():
-    # ... (sin cambios significativos, asume que load_log_data_db() es correcto)
-    print("API: Solicitud de exportación de resumen (agrupado por GRN) recibida.")
-    try:
-        logs_data = load_log_data_db()
-        if not logs_data:
-            print("API Resumen: No hay datos en el log para generar resumen.")
-            return jsonify({"error": "No hay registros en el log para generar el resumen"}), 404
-        
-        df_logs = pd.DataFrame(logs_data)
-        required_log_cols = ['importRef', 'itemCode', 'qtyReceived', 'itemDescription', 'qtyGrn']
-        if not all(col in df_logs.columns for col in required_log_cols):
-             missing_cols = [col for col in required_log_cols if col not in df_logs.columns]
-             print(f"API Resumen: Faltan columnas en los logs: {missing_cols}")
-             return jsonify({"error": f"Datos de log incompletos para resumen. Faltan: {', '.join(missing_cols)}"}), 500
-        
-        df_logs['qtyReceived'] = pd.to_numeric(df_logs['qtyReceived'], errors='coerce').fillna(0)
-        df_logs['qtyGrn'] = pd.to_numeric(df_logs['qtyGrn'], errors='coerce').fillna(0)
-
-        df_received_summary = df_logs.groupby(['importRef', 'itemCode']).agg(
-            totalReceived=('qtyReceived', 'sum'),
-            itemDescription=('itemDescription', 'first'),
-            totalExpectedGrn=('qtyGrn', 'first') 
-        ).reset_index()
-        
-        df_received_summary['difference'] = df_received_summary['totalReceived'] - df_received_summary['totalExpectedGrn']
-        df_received_summary = df_received_summary.sort_values(by=['importRef', 'itemCode'])
-
-        df_final_export = df_received_summary.rename(columns={
-            'importRef': 'Número de GRN', 'itemCode': 'Código Ítem',
-            'itemDescription': 'Descripción Ítem', 'totalReceived': 'Total Recibido (por GRN)',
-            'totalExpectedGrn': 'Total Esperado para Ítem (según Log)', 'difference': 'Diferencia'
-        })
-        df_final_export = df_final_export[[
-            'Número de GRN', 'Código Ítem', 'Descripción Ítem', 
-            'Total Recibido (por GRN)', 'Total Esperado para Ítem (según Log)', 'Diferencia'
-        ]]
-
-        output = BytesIO()
-        with pd.ExcelWriter(output, engine='openpyxl') as writer:
-            df_final_export.to_excel(writer, index=False, sheet_name='ResumenPorGRN')
-            worksheet = writer.sheets['ResumenPorGRN']
-            blue_font = Font(color="0000FF", bold=True)
-            red_font = Font(color="FF0000", bold=True)
-            try:
-                diff_col_letter = get_column_letter(df_final_export.columns.get_loc('Diferencia') + 1)
-                for row_idx in range(2, worksheet.max_row + 1):
-                    cell_ref = f"{diff_col_letter}{row_idx}"
-                    cell = worksheet[cell_ref]
-                    if cell.value is not None:
-                        try:
-                            diff_value = int(cell.value)
-                            if diff_value > 0: cell.font = blue_font
-                            elif diff_value < 0: cell.font = red_font
-                        except (ValueError, TypeError): pass
-            except KeyError:
-                print("API Resumen: Columna 'Diferencia' no encontrada para aplicar formato.")
-            for i, col_name in enumerate(df_final_export.columns):
-                 column_letter = get_column_letter(i + 1)
-                 max_len = max(
-                     df_final_export[col_name].astype(str).map(len).max(),
-                     len(col_name)
-                 ) + 2
-                 worksheet.column_dimensions[column_letter].width = max_len
-        output.seek(0)
-        timestamp_str = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-        filename = f"resumen_por_grn_{timestamp_str}.xlsx"
-        return send_file(
-            output,
-            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-            as_attachment=True,
-            download_name=filename
-        )
-    except Exception as e:
-        print(f"Error durante la generación del resumen por GRN Excel: {e}")
-        import traceback
-        traceback.print_exc()
+    logger.info("API: Solicitud de exportación de resumen (agrupado por GRN) recibida.")
+    try:
+        job = submit_export_job('summary', {})
+    except sqlite3.Error as e:
+        logger.error("DB Error (export_summary): %s", e)
         return jsonify({"error": "Error interno al generar el archivo de resumen por GRN"}), 500
+    wait_for_export_job(job, EXPORT_SYNC_TIMEOUT_SECONDS)
+    return _export_job_response(job, "No hay registros en el log para generar el resumen")
+
+@app.route('/api/analytics/variance', methods=['GET'])
+@compressed_response
+def analytics_variance():
+    # ?import_ref=<GRN opcional>&include_archive=1&top=<n>&item_limit=<n>
+    import_ref = (request.args.get('import_ref') or '').strip() or None
+    include_archive = str(request.args.get('include_archive') or '').strip().lower() in ('1', 'true', 'yes', 'on')
+    top = request.args.get('top', VARIANCE_TOP_DEFAULT, type=int)
+    item_limit = request.args.get('item_limit', VARIANCE_ITEMS_DEFAULT_LIMIT, type=int)
+    if top is None or top <= 0 or item_limit is None or item_limit <= 0:
+        return jsonify({"error": "'top' e 'item_limit' deben ser números mayores que 0"}), 400
+    params = (include_archive, import_ref, min(top, VARIANCE_TOP_MAX), min(item_limit, VARIANCE_ITEMS_MAX_LIMIT))
+    try:
+        version = get_logs_version_db()
+        grn_info = erp_import.get_import_info(get_db_connection(), erp_import.GRN_LINES_TABLE)
+        version_key = (version['maxId'], version['lastEventId'], version['archiveRunId'],
+                       grn_info['source_sha1'] if grn_info else None)
+        etag = make_version_etag('variance', *version_key, *params)
+        last_modified = _http_datetime(version['lastModified'])
+        not_modified = not_modified_response(etag, last_modified)
+        if not_modified is not None: return not_modified
+        body = get_variance_report_json(version_key, params)
+    except sqlite3.Error as e:
+        logger.error("DB Error (analytics_variance): %s", e)
+        return jsonify({"error": "Error interno al calcular las diferencias"}), 500
+    return set_validators(json_response(body), etag, last_modified)
 
 # --- Ruta para servir el archivo HTML principal ---
 @app.route('/Registro_inbound')
@@ -479,46 +2612,75 @@ def registro_inbound_page():
     return render_template('inbound.html')
 
 # --- Lógica de inicialización ---
-if not os.path.exists(DATABASE_FOLDER):
-    os.makedirs(DATABASE_FOLDER)
-    print(f"FS: Carpeta de bases de datos creada: {DATABASE_FOLDER}")
-templates_dir = os.path.join(APP_ROOT, 'templates')
-if not os.path.exists(templates_dir):
-    os.makedirs(templates_dir)
-    print(f"FS: Carpeta de plantillas creada: {templates_dir}")
-    placeholder_html_path = os.path.join(templates_dir, 'inbound.html')
-    if not os.path.exists(placeholder_html_path):
-        with open(placeholder_html_path, 'w', encoding='utf-8') as f:
-            f.write("<h1>Placeholder para inbound.html</h1><p>Por favor, coloca tu archivo inbound.html aquí.</p>")
-        print(f"FS: Archivo inbound.html de placeholder creado en {templates_dir}")
-static_dir = os.path.join(APP_ROOT, 'static')
-if not os.path.exists(static_dir):
-    os.makedirs(static_dir)
-    print(f"FS: Carpeta estática creada: {static_dir}")
-    static_images_dir = os.path.join(static_dir, 'images')
-    if not os.path.exists(static_images_dir):
-       os.makedirs(static_images_dir)
-       print(f"FS: Carpeta static/images creada.")
-
-init_db() 
-
-if not os.path.exists(ITEM_MASTER_CSV_PATH):
-     print(f"FS ADVERTENCIA: Archivo maestro no encontrado. Creando ejemplo en: {ITEM_MASTER_CSV_PATH}")
-     example_master_df = pd.DataFrame({
-         'Item_Code': ['BG1234567890123', 'FT9876543210987', 'OTRO_ITEM_001'],
-         'Item_Description': ['Maintenance Kit 1000h', 'Filtro de Aceite Modelo X', 'Repuesto Genérico Alfa'],
-         'Weight_per_Unit': ['10 kg', '2 kg', '0.5 kg'],
-         'Bin_1': ['RA25A', 'SB10C', 'ZC01X'],
-         'Aditional_Bin_Location': ['RA25A', 'SB10C, SB11A', 'ZC01X']
-     })
-     example_master_df.to_csv(ITEM_MASTER_CSV_PATH, index=False, encoding='utf-8')
-if not os.path.exists(GRN_CSV_FILE_PATH):
-     print(f"FS ADVERTENCIA: Archivo GRN no encontrado. Creando ejemplo en: {GRN_CSV_FILE_PATH}")
-     example_grn_df = pd.DataFrame({
-         GRN_COLUMN_NAME_IN_CSV: ['21044', '21044', '21048', '21049'],
-         'Item_Code': ['BG01499917', 'FT9876543210987', 'BG01499917', 'OTRO_ITEM_001'],
-         'Quantity': [12, 5, 8, 20]
-     })
-     example_grn_df.to_csv(GRN_CSV_FILE_PATH, index=False, encoding='utf-8')
+# Al importar app.py en el proceso que sirve (python -m waitress app:app, uvicorn asgi:application,
+# el principal de serve.py, benchmark.py) se prepara todo aquí. Los procesos hijos ('spawn':
+# procesos de serve.py y pool de exportaciones) vuelven a importar el módulo y no deben repetirlo:
+# el principal ya creó la base y los CSV, y corre los trabajos únicos (archivo, purga,
+# vigilancia del ERP). Los procesos de serve.py llaman a start_background_tasks(singletons=False).
+_background_tasks_lock = threading.Lock()
+_background_tasks_started = False
+
+def init_storage():
+    """Crea carpetas, el esquema de la base y CSV de ejemplo si faltan."""
+    if not os.path.exists(DATABASE_FOLDER):
+        os.makedirs(DATABASE_FOLDER)
+        logger.info("FS: Carpeta de bases de datos creada: %s", DATABASE_FOLDER)
+    templates_dir = os.path.join(APP_ROOT, 'templates')
+    if not os.path.exists(templates_dir):
+        os.makedirs(templates_dir)
+        logger.info("FS: Carpeta de plantillas creada: %s", templates_dir)
+        placeholder_html_path = os.path.join(templates_dir, 'inbound.html')
+        if not os.path.exists(placeholder_html_path):
+            with open(placeholder_html_path, 'w', encoding='utf-8') as f:
+                f.write("<h1>Placeholder para inbound.html</h1><p>Por favor, coloca tu archivo inbound.html aquí.</p>")
+            logger.info("FS: Archivo inbound.html de placeholder creado en %s", templates_dir)
+    static_dir = os.path.join(APP_ROOT, 'static')
+    if not os.path.exists(static_dir):
+        os.makedirs(static_dir)
+        logger.info("FS: Carpeta estática creada: %s", static_dir)
+        static_images_dir = os.path.join(static_dir, 'images')
+        if not os.path.exists(static_images_dir):
+           os.makedirs(static_images_dir)
+           logger.info("FS: Carpeta static/images creada.")
+
+    init_db() 
+
+    if not os.path.exists(ITEM_MASTER_CSV_PATH):
+         logger.warning("FS ADVERTENCIA: Archivo maestro no encontrado. Creando ejemplo en: %s", ITEM_MASTER_CSV_PATH)
+         example_master_df = pd.DataFrame({
+             'Item_Code': ['BG1234567890123', 'FT9876543210987', 'OTRO_ITEM_001'],
+             'Item_Description': ['Maintenance Kit 1000h', 'Filtro de Aceite Modelo X', 'Repuesto Genérico Alfa'],
+             'Weight_per_Unit': ['10 kg', '2 kg', '0.5 kg'],
+             'Bin_1': ['RA25A', 'SB10C', 'ZC01X'],
+             'Aditional_Bin_Location': ['RA25A', 'SB10C, SB11A', 'ZC01X']
+         })
+         example_master_df.to_csv(ITEM_MASTER_CSV_PATH, index=False, encoding='utf-8')
+    if not os.path.exists(GRN_CSV_FILE_PATH):
+         logger.warning("FS ADVERTENCIA: Archivo GRN no encontrado. Creando ejemplo en: %s", GRN_CSV_FILE_PATH)
+         example_grn_df = pd.DataFrame({
+             GRN_COLUMN_NAME_IN_CSV: ['21044', '21044', '21048', '21049'],
+             'Item_Code': ['BG01499917', 'FT9876543210987', 'BG01499917', 'OTRO_ITEM_001'],
+             'Quantity': [12, 5, 8, 20]
+         })
+         example_grn_df.to_csv(GRN_CSV_FILE_PATH, index=False, encoding='utf-8')
+
+def start_background_tasks(singletons=True):
+    """Precarga los índices del ERP y, con singletons, arranca los trabajos únicos. Una vez por proceso."""
+    global _background_tasks_started
+    with _background_tasks_lock:
+        if _background_tasks_started: return
+        _background_tasks_started = True
+    # Precargar los índices en segundo plano para que la primera petición no pague la lectura
+    _start_csv_cache_reload(item_master_cache)
+    _start_csv_cache_reload(grn_cache)
+    if not singletons: return
+    evict_export_artifacts()
+    threading.Thread(target=_purge_idempotency_keys_worker, name='purge-idempotency', daemon=True).start()
+    threading.Thread(target=_archive_logs_worker, name='archive-logs', daemon=True).start()
+    threading.Thread(target=_watch_erp_files_worker, name='watch-erp', daemon=True).start()
+
+if multiprocessing.parent_process() is None:
+    init_storage()
+    start_background_tasks()
 
 # No app.run() aquí
@@ -0,0 +1,225 @@
+import io
+import os
+import sys
+import asyncio
+import sqlite3
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.exceptions import HTTPException
+import app as inbound_app
+
+# --- Modo ASGI (asyncio) ---
+# Puerta de entrada asíncrona para muchas pistolas a la vez: el servidor ASGI (uvicorn,
+# ver serve.py --server asgi) atiende las conexiones en un solo bucle de eventos y solo
+# las peticiones en curso usan un hilo de un pool acotado (ASGI_THREADS).
+#   - Todas las rutas son las de app.py: la petición se pasa a la app Flask (WSGI) en el pool.
+#   - add_log y add_logs (app.LOG_WRITE_VIEWS) validan en el pool, esperan el COMMIT del
+#     escritor agrupado con await (sin ocupar un hilo) y arman la respuesta en el pool. Pasan
+#     por los mismos before_request, after_request (CORS, métricas) y teardown_request que
+#     una petición normal.
+#   - Las respuestas con cuerpo conocido y chico se leen de una vez; el resto (exportaciones,
+#     /api/log_stream) se transmite trozo a trozo y se corta si el cliente se desconecta.
+ASGI_THREADS = int(os.environ.get('INBOUND_ASGI_THREADS', '32'))
+ASGI_MAX_BODY_BYTES = 64 * 1024 * 1024
+ASGI_BUFFER_RESPONSE_BYTES = 1024 * 1024
+
+logger = logging.getLogger('inbound.asgi')
+flask_app = inbound_app.app
+_executor = ThreadPoolExecutor(max_workers=ASGI_THREADS, thread_name_prefix='asgi')
+_STREAM_END = object()
+
+
+def build_environ(scope, body):
+    """Entorno WSGI (PEP 3333) equivalente a una petición HTTP de ASGI."""
+    server_name, server_port = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server_name,
+        'SERVER_PORT': str(server_port),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for raw_name, raw_value in scope.get('headers', []):
+        name = raw_name.decode('latin-1').upper().replace('-', '_')
+        value = raw_value.decode('latin-1')
+        if name == 'CONTENT_TYPE' or name == 'CONTENT_LENGTH':
+            environ[name] = value
+        else:
+            key = f"HTTP_{name}"
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+def _match_endpoint(scope):
+    try:
+        endpoint, _ = flask_app.url_map.bind('localhost').match(scope['path'], method=scope['method'])
+    except HTTPException:
+        return None
+    return endpoint
+
+
+# --- Puente WSGI (todas las rutas) ---
+def _call_wsgi(environ):
+    started = {}
+    def start_response(status, headers, exc_info=None):
+        if exc_info and started: raise exc_info[1].with_traceback(exc_info[2])
+        started['status'], started['headers'] = status, headers
+        return lambda data: None  # write() obsoleto: Flask no lo usa
+    result = flask_app(environ, start_response)
+    iterator = iter(result)
+    first = next(iterator, _STREAM_END)
+    content_length = next((value for name, value in started['headers'] if name.lower() == 'content-length'), None)
+    if content_length is not None and int(content_length) <= ASGI_BUFFER_RESPONSE_BYTES:
+        # Cuerpo chico y de largo conocido (JSON): leerlo entero aquí, sin más saltos al pool
+        body = b''.join([first] + list(iterator)) if first is not _STREAM_END else b''
+        if hasattr(result, 'close'): result.close()
+        return int(started['status'].split(' ', 1)[0]), started['headers'], body, None, None
+    return int(started['status'].split(' ', 1)[0]), started['headers'], first, iterator, result
+
+
+async def _send_start(send, status, headers):
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]})
+
+
+async def _watch_disconnect(receive, disconnected):
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            disconnected.set()
+            return
+
+
+async def _serve_wsgi(scope, body, receive, send):
+    loop = asyncio.get_running_loop()
+    status, headers, first, iterator, result = await loop.run_in_executor(_executor, _call_wsgi, build_environ(scope, body))
+    await _send_start(send, status, headers)
+    if iterator is None:
+        await send({'type': 'http.response.body', 'body': first})
+        return
+    disconnected = asyncio.Event()
+    watcher = asyncio.create_task(_watch_disconnect(receive, disconnected))
+    try:
+        chunk = first
+        while chunk is not _STREAM_END and not disconnected.is_set():
+            if chunk: await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            chunk = await loop.run_in_executor(_executor, next, iterator, _STREAM_END)
+        if not disconnected.is_set():
+            await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        watcher.cancel()
+        # Cierra el generador (p. ej. libera el cupo de /api/log_stream)
+        if hasattr(result, 'close'): await loop.run_in_executor(_executor, result.close)
+
+
+# --- Escrituras de registros (add_log, add_logs) ---
+# La petición se atiende en dos fases, cada una en su hilo del pool y con su contexto de
+# petición, y cada fase sigue el ciclo de Flask (full_dispatch_request + wsgi_app):
+# excepciones a sus manejadores, after_request al armar la respuesta y teardown_request al
+# salir del contexto. before_request corre una sola vez, al preparar; si devuelve una
+# respuesta, la vista no se ejecuta. Las dos fases comparten el contexto de la app, así que
+# g (el inicio de la petición para las métricas, el perfilador) es el mismo de punta a punta.
+def _run_phase(environ, app_context, view):
+    with app_context, flask_app.request_context(environ):
+        try:
+            try:
+                rv, pending = view()
+            except Exception as e:
+                rv, pending = flask_app.handle_user_exception(e), None
+            if pending is not None: return None, pending
+            response = flask_app.finalize_request(rv)
+        except Exception as e:
+            response = flask_app.handle_exception(e)
+        return (response.status_code, response.headers.to_wsgi_list(), response.get_data()), None
+
+
+def _run_prepare(environ, app_context, prepare):
+    def view():
+        rv = flask_app.preprocess_request()
+        if rv is not None: return rv, None
+        return prepare()
+    return _run_phase(environ, app_context, view)
+
+
+def _run_finish(environ, app_context, pending, results, error):
+    def view():
+        if error is not None: raise error
+        return pending['finish'](results), None
+    return _run_phase(environ, app_context, view)[0]
+
+
+async def _serve_log_write(scope, body, send, prepare):
+    loop = asyncio.get_running_loop()
+    environ = build_environ(scope, body)
+    app_context = flask_app.app_context()
+    response, pending = await loop.run_in_executor(_executor, _run_prepare, environ, app_context, prepare)
+    if response is None:
+        results, error = [], None
+        if pending['entries']:
+            try:
+                results = await asyncio.wrap_future(
+                    inbound_app.submit_log_entries(pending['entries'], pending['idempotency']))
+            except sqlite3.Error:
+                results = None  # Como run_log_write: finish responde el 500 habitual
+            except Exception as e:
+                error = e
+        environ['wsgi.input'] = io.BytesIO(body)
+        response = await loop.run_in_executor(_executor, _run_finish, environ, app_context, pending, results, error)
+    status, headers, response_body = response
+    await _send_start(send, status, headers)
+    await send({'type': 'http.response.body', 'body': response_body})
+
+
+# --- Aplicación ASGI ---
+async def _read_body(receive):
+    chunks = []
+    size = 0
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect': return None
+        chunk = message.get('body', b'')
+        size += len(chunk)
+        if size > ASGI_MAX_BODY_BYTES: return False
+        chunks.append(chunk)
+        if not message.get('more_body'): return b''.join(chunks)
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            _executor.shutdown(wait=False, cancel_futures=True)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await _lifespan(receive, send)
+        return
+    if scope['type'] != 'http': return
+    body = await _read_body(receive)
+    if body is None: return
+    if body is False:
+        await _send_start(send, 413, [('Content-Type', 'text/plain; charset=utf-8')])
+        await send({'type': 'http.response.body', 'body': 'Cuerpo de la petición demasiado grande'.encode('utf-8')})
+        return
+    prepare = inbound_app.LOG_WRITE_VIEWS.get(_match_endpoint(scope)) if scope['method'] == 'POST' else None
+    if prepare is not None:
+        await _serve_log_write(scope, body, send, prepare)
+    else:
+        await _serve_wsgi(scope, body, receive, send)
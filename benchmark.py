@@ -0,0 +1,429 @@
+import os
+import sys
+import io
+import json
+import time
+import shutil
+import sqlite3
+import argparse
+import datetime
+import platform
+import tempfile
+import threading
+import contextlib
+import subprocess
+import http.client
+import importlib.util
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+# --- Banco de pruebas de carga para la API de inbound ---
+# Crea un directorio de trabajo temporal con una copia de app.py, CSV sintéticos del ERP
+# y una tabla 'logs' ya poblada, y mide cada endpoint:
+#   - 'client':   Flask test client en el mismo proceso (sin red).
+#   - 'waitress': un proceso waitress real en localhost, con varios hilos cliente.
+# Los resultados (p50/p95/p99, throughput, pico de RSS) se guardan en JSON y pueden
+# compararse con una ejecución anterior (--compare) para detectar regresiones.
+APP_ROOT = os.path.dirname(os.path.abspath(__file__))
+APP_FILES = ['app.py', 'asgi.py', 'erp_import.py', 'erp_snapshot.py', 'metrics.py', 'serve.py']
+MASTER_CSV_NAME = 'AURRSGLBD0250 - Item Stockroom Balance.csv'
+GRN_CSV_NAME = 'AURRSGLBD0280 - Stock In Goods Inwards And Inspection.csv'
+ENDPOINTS = ['find_item', 'add_log', 'update_log', 'get_logs', 'export_log', 'export_summary']
+HEAVY_ENDPOINTS = {'export_log', 'export_summary'}
+
+
+# --- Generación de datos sintéticos ---
+def generate_master_csv(path, item_count, rng):
+    """Escribe un maestro de artículos sintético con item_count filas."""
+    codes = np.char.add('IT', np.char.zfill(np.arange(item_count).astype(str), 9))
+    bins = np.char.add(np.array(list('ABCDEFGHRS'))[rng.integers(0, 10, item_count)],
+                       np.char.zfill(rng.integers(0, 999, item_count).astype(str), 3))
+    df = pd.DataFrame({
+        'Item_Code': codes,
+        'Item_Description': np.char.add('ITEM DESCRIPTION ', rng.integers(0, 50000, item_count).astype(str)),
+        'Weight_per_Unit': np.round(rng.uniform(0.01, 50, item_count), 2).astype(str),
+        'Bin_1': bins,
+        'Aditional_Bin_Location': bins,
+    })
+    df.to_csv(path, index=False, encoding='utf-8')
+    return codes
+
+
+def generate_grn_csv(path, codes, line_count, lines_per_grn, rng):
+    """Escribe un CSV de GRN sintético; ~0.1% de las cantidades son inválidas a propósito."""
+    grn_count = max(1, line_count // lines_per_grn)
+    grn_numbers = (20000 + rng.integers(0, grn_count, line_count)).astype(str)
+    item_codes = codes[rng.integers(0, len(codes), line_count)]
+    quantities = rng.integers(1, 60, line_count).astype(str).astype(object)
+    quantities[rng.random(line_count) < 0.001] = 'N/A'
+    df = pd.DataFrame({'GRN_Number': grn_numbers, 'Item_Code': item_codes, 'Quantity': quantities})
+    df.to_csv(path, index=False, encoding='utf-8')
+    return df.drop_duplicates(subset=['GRN_Number', 'Item_Code'])
+
+
+def prefill_logs(db_path, grn_lines, row_count, rng):
+    """Inserta row_count registros en 'logs' con diferencias acumuladas coherentes."""
+    if row_count <= 0 or grn_lines.empty: return
+    picks = grn_lines.iloc[rng.integers(0, len(grn_lines), row_count)].reset_index(drop=True)
+    qty_grn = pd.to_numeric(picks['Quantity'], errors='coerce').fillna(0).astype(int)
+    qty_received = pd.Series(rng.integers(1, 20, row_count))
+    cumulative = qty_received.groupby([picks['GRN_Number'], picks['Item_Code']]).cumsum()
+    start = datetime.datetime.now() - datetime.timedelta(days=90)
+    offsets = np.sort(rng.integers(0, 90 * 24 * 3600, row_count))
+    rows = [
+        ((start + datetime.timedelta(seconds=int(offset))).isoformat(timespec='seconds'), grn, item,
+         f"WB{rng_value:06d}", 'ITEM DESCRIPTION', 'A001', '', int(received), int(expected), int(total - expected))
+        for offset, grn, item, rng_value, received, expected, total in zip(
+            offsets, picks['GRN_Number'], picks['Item_Code'], rng.integers(0, 5000, row_count),
+            qty_received, qty_grn, cumulative)
+    ]
+    conn = sqlite3.connect(db_path)
+    try:
+        conn.executemany(
+            "INSERT INTO logs (timestamp, importRef, itemCode, waybill, itemDescription, binLocation, "
+            "relocatedBin, qtyReceived, qtyGrn, difference) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def prepare_workdir(workdir, args):
+    """Copia la aplicación a workdir y genera los CSV del ERP sintéticos."""
+    rng = np.random.default_rng(args.seed)
+    os.makedirs(os.path.join(workdir, 'databases'), exist_ok=True)
+    for name in APP_FILES:
+        shutil.copy2(os.path.join(APP_ROOT, name), os.path.join(workdir, name))
+    print(f"Bench: Generando maestro ({args.items} artículos) y GRN ({args.grn_lines} líneas)...")
+    codes = generate_master_csv(os.path.join(workdir, 'databases', MASTER_CSV_NAME), args.items, rng)
+    grn_lines = generate_grn_csv(os.path.join(workdir, 'databases', GRN_CSV_NAME), codes, args.grn_lines,
+                                 args.lines_per_grn, rng)
+    return codes, grn_lines
+
+
+APP_MODULES = [os.path.splitext(name)[0] for name in APP_FILES]
+
+def load_app_module(workdir):
+    """Importa la copia de app.py del directorio de trabajo (init_db, carpetas, etc.)."""
+    # Sus imports (erp_import, erp_snapshot, metrics) también deben salir de la copia y no del
+    # checkout desde el que corre benchmark.py: con --compare se miden dos árboles distintos
+    sys.path.insert(0, workdir)
+    for name in APP_MODULES: sys.modules.pop(name, None)
+    spec = importlib.util.spec_from_file_location('bench_inbound_app', os.path.join(workdir, 'app.py'))
+    module = importlib.util.module_from_spec(spec)
+    with contextlib.redirect_stdout(io.StringIO()):
+        spec.loader.exec_module(module)
+    return module
+
+
+# --- Generación de peticiones ---
+def build_request_plan(endpoint, count, codes, grn_lines, log_id_range, rng):
+    """Devuelve una lista de (método, ruta, cuerpo JSON) para un endpoint."""
+    grn_pairs = grn_lines[['GRN_Number', 'Item_Code']].to_numpy()
+    low_id, high_id = log_id_range
+    plan = []
+    for _ in range(count):
+        grn_number, item_code = grn_pairs[rng.integers(0, len(grn_pairs))]
+        if endpoint == 'find_item':
+            if rng.random() < 0.1: item_code = codes[rng.integers(0, len(codes))]
+            plan.append(('GET', f"/api/find_item/{urllib.parse.quote(item_code)}/{grn_number}", None))
+        elif endpoint == 'add_log':
+            plan.append(('POST', '/api/add_log', {
+                'importRef': grn_number, 'waybill': f"WB{rng.integers(0, 5000):06d}",
+                'itemCode': item_code, 'quantity': int(rng.integers(1, 20)), 'relocateBin': ''}))
+        elif endpoint == 'update_log':
+            plan.append(('PUT', f"/api/update_log/{int(rng.integers(low_id, high_id + 1))}", {
+                'waybill': f"WB{rng.integers(0, 5000):06d}", 'qtyReceived': int(rng.integers(1, 20)),
+                'relocateBin': ''}))
+        elif endpoint == 'get_logs':
+            choice = rng.random()
+            if choice < 0.5: path = '/api/get_logs'
+            elif choice < 0.8: path = f"/api/get_logs?importRef={grn_number}"
+            else: path = f"/api/get_logs?since_id={max(low_id, high_id - 50)}"
+            plan.append(('GET', path, None))
+        else:
+            plan.append(('GET', f"/api/{endpoint}", None))
+    return plan
+
+
+# --- Medición de memoria ---
+def reset_peak_rss(pid):
+    # Linux permite reiniciar VmHWM escribiendo '5' en clear_refs; en otros sistemas se
+    # informa el pico del proceso desde su inicio.
+    try:
+        with open(f"/proc/{pid}/clear_refs", 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def peak_rss_mb(pid):
+    try:
+        import psutil
+        info = psutil.Process(pid).memory_info()
+        peak = getattr(info, 'peak_wset', None)
+        if peak: return round(peak / 1048576, 1)
+    except Exception:
+        pass
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    if pid == os.getpid():
+        try:
+            import resource
+            return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+        except ImportError:
+            pass
+    return None
+
+
+# --- Ejecución ---
+def summarize(endpoint, latencies, errors, wall_seconds, rss):
+    latencies_ms = np.array(latencies) * 1000 if latencies else np.array([0.0])
+    return {
+        'endpoint': endpoint,
+        'requests': len(latencies),
+        'errors': errors,
+        'p50_ms': round(float(np.percentile(latencies_ms, 50)), 2),
+        'p95_ms': round(float(np.percentile(latencies_ms, 95)), 2),
+        'p99_ms': round(float(np.percentile(latencies_ms, 99)), 2),
+        'max_ms': round(float(latencies_ms.max()), 2),
+        'throughput_rps': round(len(latencies) / wall_seconds, 2) if wall_seconds > 0 else None,
+        'peak_rss_mb': rss,
+    }
+
+
+def run_plan(plan, concurrency, send):
+    """Ejecuta el plan con 'concurrency' hilos; send(método, ruta, cuerpo) -> código HTTP."""
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+
+    def worker(item):
+        nonlocal errors
+        method, path, body = item
+        start = time.perf_counter()
+        try:
+            status = send(method, path, body)
+        except Exception:
+            status = 0
+        elapsed = time.perf_counter() - start
+        with lock:
+            latencies.append(elapsed)
+            if status >= 400 or status == 0: errors += 1
+
+    wall_start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(worker, plan))
+    return latencies, errors, time.perf_counter() - wall_start
+
+
+def run_client_mode(app_module, plans, concurrency):
+    print("Bench: Modo Flask test client...")
+    client_local = threading.local()
+
+    def send(method, path, body):
+        client = getattr(client_local, 'client', None)
+        if client is None:
+            client = client_local.client = app_module.app.test_client()
+        response = client.open(path, method=method, json=body)
+        response.get_data()
+        return response.status_code
+
+    results = []
+    with contextlib.redirect_stdout(io.StringIO()) as captured:
+        for endpoint, plan in plans.items():
+            reset_peak_rss(os.getpid())
+            workers = 1 if endpoint in HEAVY_ENDPOINTS else concurrency
+            latencies, errors, wall = run_plan(plan, workers, send)
+            results.append(summarize(endpoint, latencies, errors, wall, peak_rss_mb(os.getpid())))
+            captured.truncate(0)
+            captured.seek(0)
+    return results
+
+
+def wait_for_server(port, timeout=120):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+            conn.request('GET', '/api/cache_status')
+            status = json.loads(conn.getresponse().read())
+            if all(cache.get('loaded') for cache in status.values()): return True
+        except (OSError, ValueError, http.client.HTTPException):
+            pass
+        time.sleep(0.5)
+    return False
+
+
+def run_waitress_mode(workdir, plans, concurrency, port, server_threads, server_workers=1, server='waitress'):
+    print(f"Bench: Modo {server} (puerto {port}, {server_workers} proceso(s) x {server_threads} hilos de servidor)...")
+    if server_workers > 1 or server == 'asgi':
+        # serve.py: el pico de RSS medido es solo el del proceso principal
+        command = [sys.executable, 'serve.py', '--host', '127.0.0.1', f'--port={port}',
+                   f'--workers={server_workers}', f'--threads={server_threads}', f'--server={server}']
+    else:
+        command = [sys.executable, '-m', 'waitress', '--host', '127.0.0.1', f'--port={port}',
+                   f'--threads={server_threads}', 'app:app']
+    server = subprocess.Popen(command, cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        if not wait_for_server(port):
+            raise RuntimeError("El servidor waitress no respondió a tiempo")
+        connection_local = threading.local()
+
+        def send(method, path, body):
+            conn = getattr(connection_local, 'conn', None)
+            if conn is None:
+                conn = connection_local.conn = http.client.HTTPConnection('127.0.0.1', port, timeout=300)
+            payload = json.dumps(body) if body is not None else None
+            headers = {'Content-Type': 'application/json'} if body is not None else {}
+            try:
+                conn.request(method, path, body=payload, headers=headers)
+                response = conn.getresponse()
+                response.read()
+            except (OSError, http.client.HTTPException):
+                connection_local.conn = None
+                conn.close()
+                raise
+            return response.status
+
+        results = []
+        for endpoint, plan in plans.items():
+            reset_peak_rss(server.pid)
+            workers = 1 if endpoint in HEAVY_ENDPOINTS else concurrency
+            latencies, errors, wall = run_plan(plan, workers, send)
+            results.append(summarize(endpoint, latencies, errors, wall, peak_rss_mb(server.pid)))
+        return results
+    finally:
+        server.terminate()
+        try:
+            server.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            server.kill()
+
+
+def compare_results(current, baseline_path, threshold_pct):
+    """Imprime la variación de p95 frente a una ejecución anterior; devuelve True si hay regresión."""
+    with open(baseline_path, encoding='utf-8') as f:
+        baseline = json.load(f)
+    regression = False
+    for mode, rows in current['results'].items():
+        previous = {row['endpoint']: row for row in baseline.get('results', {}).get(mode, [])}
+        for row in rows:
+            old = previous.get(row['endpoint'])
+            if not old or not old.get('p95_ms'): continue
+            change = (row['p95_ms'] - old['p95_ms']) / old['p95_ms'] * 100
+            flag = ''
+            if change > threshold_pct:
+                flag = '  <-- REGRESIÓN'
+                regression = True
+            print(f"  [{mode}] {row['endpoint']:<15} p95 {old['p95_ms']:>9.2f} -> {row['p95_ms']:>9.2f} ms ({change:+.1f}%){flag}")
+    return regression
+
+
+def print_table(mode, rows):
+    print(f"\n--- Resultados ({mode}) ---")
+    print(f"{'endpoint':<15}{'n':>6}{'err':>5}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'req/s':>10}{'RSS MB':>9}")
+    for row in rows:
+        print(f"{row['endpoint']:<15}{row['requests']:>6}{row['errors']:>5}{row['p50_ms']:>10}{row['p95_ms']:>10}"
+              f"{row['p99_ms']:>10}{str(row['throughput_rps']):>10}{str(row['peak_rss_mb']):>9}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Banco de pruebas de carga para la API de Registro Inbound.")
+    parser.add_argument('--items', type=int, default=10000, help="Artículos en el maestro sintético (10k-1M)")
+    parser.add_argument('--grn-lines', type=int, default=100000, help="Líneas del CSV de GRN sintético")
+    parser.add_argument('--lines-per-grn', type=int, default=40, help="Líneas promedio por GRN")
+    parser.add_argument('--log-rows', type=int, default=50000, help="Registros precargados en 'logs'")
+    parser.add_argument('--requests', type=int, default=500, help="Peticiones por endpoint ligero")
+    parser.add_argument('--export-requests', type=int, default=3, help="Peticiones por endpoint de exportación")
+    parser.add_argument('--concurrency', type=int, default=8, help="Hilos cliente concurrentes")
+    parser.add_argument('--server-threads', type=int, default=8, help="Hilos del servidor waitress")
+    parser.add_argument('--server-workers', type=int, default=1, help="Procesos del servidor (>1 usa serve.py)")
+    parser.add_argument('--server', choices=['waitress', 'asgi'], default='waitress',
+                        help="Servidor del modo waitress (asgi usa serve.py --server asgi)")
+    parser.add_argument('--mode', choices=['client', 'waitress', 'both'], default='both')
+    parser.add_argument('--endpoints', default=','.join(ENDPOINTS), help="Lista separada por comas")
+    parser.add_argument('--port', type=int, default=5099)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', default='bench_results.json', help="Archivo JSON de resultados")
+    parser.add_argument('--compare', help="JSON de una ejecución anterior para comparar p95")
+    parser.add_argument('--threshold', type=float, default=20.0, help="%% de aumento de p95 considerado regresión")
+    parser.add_argument('--workdir', help="Directorio de trabajo (por defecto uno temporal que se borra al final)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    endpoints = [name.strip() for name in args.endpoints.split(',') if name.strip()]
+    unknown = set(endpoints) - set(ENDPOINTS)
+    if unknown:
+        print(f"Bench Error: endpoints desconocidos: {', '.join(sorted(unknown))}")
+        return 2
+    workdir = args.workdir or tempfile.mkdtemp(prefix='inbound_bench_')
+    # Sin archivo del log: los registros precargados (últimos 90 días) no deben moverse a mitad de la medición
+    os.environ.setdefault('INBOUND_LOG_ARCHIVE_DAYS', '0')
+    os.environ.setdefault('INBOUND_LOG_ARCHIVE_CLOSED_DAYS', '0')
+    try:
+        setup_start = time.perf_counter()
+        codes, grn_lines = prepare_workdir(workdir, args)
+        app_module = load_app_module(workdir)  # init_db crea el esquema
+        print(f"Bench: Precargando {args.log_rows} registros en 'logs'...")
+        prefill_logs(app_module.DB_FILE_PATH, grn_lines, args.log_rows, np.random.default_rng(args.seed + 1))
+        with contextlib.redirect_stdout(io.StringIO()):
+            app_module.get_csv_cache_index(app_module.item_master_cache)
+            app_module.get_csv_cache_index(app_module.grn_cache)
+        setup_seconds = time.perf_counter() - setup_start
+        print(f"Bench: Preparación completada en {setup_seconds:.1f} s (directorio: {workdir})")
+
+        rng = np.random.default_rng(args.seed + 2)
+        log_id_range = (1, max(1, args.log_rows))
+        plans = {
+            endpoint: build_request_plan(
+                endpoint, args.export_requests if endpoint in HEAVY_ENDPOINTS else args.requests,
+                codes, grn_lines, log_id_range, rng)
+            for endpoint in endpoints
+        }
+
+        report = {
+            'createdAt': datetime.datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'config': {key: value for key, value in vars(args).items() if key not in ('compare', 'workdir')},
+            'setupSeconds': round(setup_seconds, 2),
+            'cacheStats': {
+                'itemMaster': app_module.get_csv_cache_stats(app_module.item_master_cache),
+                'grn': app_module.get_csv_cache_stats(app_module.grn_cache),
+            },
+            'results': {},
+        }
+        if args.mode in ('client', 'both'):
+            report['results']['client'] = run_client_mode(app_module, plans, args.concurrency)
+            print_table('client', report['results']['client'])
+        if args.mode in ('waitress', 'both'):
+            report['results']['waitress'] = run_waitress_mode(
+                workdir, plans, args.concurrency, args.port, args.server_threads, args.server_workers, args.server)
+            print_table('waitress', report['results']['waitress'])
+
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f"\nBench: Resultados guardados en {args.output}")
+
+        if args.compare:
+            print(f"\n--- Comparación con {args.compare} (umbral {args.threshold:.0f}%) ---")
+            if compare_results(report, args.compare, args.threshold):
+                return 1
+        return 0
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,454 @@
+import os
+import hashlib
+import logging
+import sqlite3
+import datetime
+import time
+from contextlib import contextmanager
+import numpy as np
+import pandas as pd
+if os.name == 'nt':
+    import msvcrt
+else:
+    import fcntl
+
+# --- Importación de los CSV del ERP a SQLite ---
+# Los CSV se leen por bloques (memoria acotada) hacia una tabla de staging, y la
+# tabla de staging reemplaza a la definitiva dentro de una única transacción.
+# La tabla 'erp_imports' guarda la firma (mtime, tamaño) del CSV importado para
+# saber si hace falta volver a importar.
+# Refresco por diferencias: el ERP deja copias nuevas varias veces al día y casi todo
+# se repite. Si la tabla ya existe, el staging se compara con ella en SQL (EXCEPT) y
+# solo las claves nuevas, modificadas o desaparecidas se aplican a la tabla, a su
+# índice de búsqueda y a 'erp_changes', de donde la app las superpone a la instantánea
+# (ver erp_snapshot.OverlayTable). Antes de tocar nada el archivo se verifica: columnas
+# requeridas, sin bytes NUL al final (copia preasignada a medias), firma estable durante
+# la lectura y una cantidad de filas razonable frente a la importación anterior (force
+# no compara filas). El motivo del último rechazo de cada CSV queda en get_rejection.
+CHUNK_SIZE = 50000
+ITEM_MASTER_TABLE = 'item_master'
+GRN_LINES_TABLE = 'grn_lines'
+# Índice FTS5 (tokenizador trigram) de código y descripción para /api/search_items.
+# Se construye junto a la tabla de staging del maestro y se reemplaza en el mismo swap.
+ITEM_SEARCH_TABLE = 'item_search'
+# Claves cambiadas desde la última instantánea completa (key2 = '' en el maestro)
+ERP_CHANGES_TABLE = 'erp_changes'
+MIN_ROW_RATIO = 0.5          # Filas nuevas / anteriores por debajo de esto: se rechaza el archivo
+TAIL_CHECK_BYTES = 64 * 1024
+
+logger = logging.getLogger('inbound.erp_import')
+
+# Último rechazo por ruta del CSV: {'reason', 'row_count_check', 'signature', 'rejected_at'}
+_rejections = {}
+
+
+class RowCountError(ValueError):
+    """El archivo tiene muchas menos filas que la importación anterior (¿truncado?)."""
+
+
+def _quote(identifier):
+    return '"' + identifier.replace('"', '""') + '"'
+
+
+def file_sha1(file_path, block_size=1024 * 1024):
+    digest = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+@contextmanager
+def interprocess_lock(lock_path):
+    """Bloqueo exclusivo entre procesos sobre lock_path (se crea si no existe)."""
+    with open(lock_path, 'a+b') as lock_file:
+        if os.name == 'nt':
+            lock_file.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    continue  # LK_LOCK se rinde tras ~10 s; seguir esperando
+        else:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if os.name == 'nt':
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+def _file_signature(file_path):
+    try:
+        stat_result = os.stat(file_path)
+    except OSError:
+        return None
+    return (stat_result.st_mtime_ns, stat_result.st_size)
+
+
+def wait_for_complete_file(file_path, settle_seconds, timeout_seconds):
+    """Espera a que la firma del archivo no cambie durante settle_seconds (copia terminada).
+
+    Devuelve la firma, o None si el archivo no existe o sigue cambiando al vencer timeout_seconds.
+    """
+    deadline = time.monotonic() + timeout_seconds
+    signature = _file_signature(file_path)
+    while signature is not None:
+        time.sleep(settle_seconds)
+        current = _file_signature(file_path)
+        if current == signature: return signature
+        if time.monotonic() >= deadline: return None
+        signature = current
+    return None
+
+
+def _item_master_ddl(table, columns):
+    column_defs = ', '.join(
+        f"{_quote(col)} TEXT PRIMARY KEY" if col == 'Item_Code' else f"{_quote(col)} TEXT"
+        for col in columns
+    )
+    return f"CREATE TABLE IF NOT EXISTS {_quote(table)} ({column_defs})"
+
+
+def _grn_lines_ddl(table):
+    return (f"CREATE TABLE IF NOT EXISTS {_quote(table)} ("
+            "GRN_Number TEXT NOT NULL, Item_Code TEXT NOT NULL, Quantity INTEGER, "
+            "PRIMARY KEY (GRN_Number, Item_Code)) WITHOUT ROWID")
+
+
+def ensure_erp_tables(conn, master_columns):
+    """Crea (vacías) las tablas del ERP y la tabla de control si aún no existen."""
+    cursor = conn.cursor()
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS erp_imports (
+            table_name TEXT PRIMARY KEY, source_file TEXT, source_mtime_ns INTEGER,
+            source_size INTEGER, row_count INTEGER, malformed_count INTEGER,
+            imported_at TEXT, load_seconds REAL, source_sha1 TEXT,
+            snapshot_sha1 TEXT, import_mode TEXT, changed_rows INTEGER, delta_ready INTEGER
+        )''')
+    existing_columns = {row[1] for row in cursor.execute("PRAGMA table_info(erp_imports)")}
+    for column, column_type in (('source_sha1', 'TEXT'), ('snapshot_sha1', 'TEXT'), ('import_mode', 'TEXT'),
+                                ('changed_rows', 'INTEGER'), ('delta_ready', 'INTEGER')):
+        if column not in existing_columns:
+            cursor.execute(f"ALTER TABLE erp_imports ADD COLUMN {column} {column_type}")
+    cursor.execute(f'''CREATE TABLE IF NOT EXISTS {ERP_CHANGES_TABLE} (
+            table_name TEXT NOT NULL, key1 TEXT NOT NULL, key2 TEXT NOT NULL DEFAULT '',
+            PRIMARY KEY (table_name, key1, key2)) WITHOUT ROWID''')
+    cursor.execute(_item_master_ddl(ITEM_MASTER_TABLE, master_columns))
+    cursor.execute(_grn_lines_ddl(GRN_LINES_TABLE))
+    cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_grn_lines_item ON {GRN_LINES_TABLE} (Item_Code)")
+    conn.commit()
+
+
+def fts5_trigram_available(conn):
+    try:
+        conn.execute("CREATE VIRTUAL TABLE temp.__fts5_probe USING fts5(x, tokenize='trigram')")
+        conn.execute("DROP TABLE temp.__fts5_probe")
+        return True
+    except sqlite3.OperationalError:
+        return False
+
+
+def _table_exists(conn, table_name):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (table_name,)).fetchone() is not None
+
+
+def _build_item_search_staging(cursor, staging):
+    # Devuelve [(tabla_staging, tabla_definitiva)] para el swap, o [] si no hay FTS5 trigram.
+    if not fts5_trigram_available(cursor.connection):
+        logger.warning("Import ERP: SQLite sin FTS5/trigram; /api/search_items usará búsqueda LIKE.")
+        return []
+    search_staging = f"{ITEM_SEARCH_TABLE}__staging_{os.getpid()}"
+    cursor.execute(f"DROP TABLE IF EXISTS {_quote(search_staging)}")
+    cursor.execute(f"CREATE VIRTUAL TABLE {_quote(search_staging)} USING fts5(Item_Code, Item_Description, tokenize='trigram')")
+    # rowid del índice = rowid de item_master: el refresco por diferencias borra por rowid
+    cursor.execute(f"INSERT INTO {_quote(search_staging)} (rowid, Item_Code, Item_Description) "
+                   f"SELECT rowid, Item_Code, COALESCE(Item_Description, '') FROM {_quote(staging)}")
+    cursor.connection.commit()
+    return [(search_staging, ITEM_SEARCH_TABLE)]
+
+
+def _apply_item_search_changes(cursor, table, apply_rows):
+    # Dentro de la transacción del refresco: quitar del índice las claves tocadas, aplicar
+    # los cambios a item_master (INSERT OR REPLACE cambia el rowid) y volver a indexarlas
+    has_search = _table_exists(cursor.connection, ITEM_SEARCH_TABLE)
+    if has_search:
+        cursor.execute(f"DELETE FROM {ITEM_SEARCH_TABLE} WHERE rowid IN "
+                       f"(SELECT rowid FROM {_quote(table)} WHERE Item_Code IN (SELECT Item_Code FROM temp.erp_diff))")
+    apply_rows()
+    if has_search:
+        cursor.execute(f"INSERT INTO {ITEM_SEARCH_TABLE} (rowid, Item_Code, Item_Description) "
+                       f"SELECT rowid, Item_Code, COALESCE(Item_Description, '') FROM {_quote(table)} "
+                       f"WHERE Item_Code IN (SELECT Item_Code FROM temp.erp_diff WHERE deleted = 0)")
+
+
+def get_import_info(conn, table_name):
+    """Devuelve la fila de 'erp_imports' de una tabla como dict, o None."""
+    keys = ['table_name', 'source_file', 'source_mtime_ns', 'source_size', 'row_count', 'malformed_count',
+            'imported_at', 'load_seconds', 'source_sha1', 'snapshot_sha1', 'import_mode', 'changed_rows', 'delta_ready']
+    cursor = conn.execute(f"SELECT {', '.join(keys)} FROM erp_imports WHERE table_name = ?", (table_name,))
+    row = cursor.fetchone()
+    if row is None: return None
+    return dict(zip(keys, row))
+
+
+def get_rejection(csv_path):
+    """Motivo del último rechazo de csv_path en este proceso, o None si su última importación fue aceptada."""
+    return _rejections.get(csv_path)
+
+
+def count_changes(conn, table_name):
+    return conn.execute(f"SELECT COUNT(*) FROM {ERP_CHANGES_TABLE} WHERE table_name = ?", (table_name,)).fetchone()[0]
+
+
+def mark_snapshot_current(conn, table_name, source_sha1):
+    """Registra que ya hay instantánea completa de source_sha1 y descarta los cambios acumulados.
+
+    Se ejecuta dentro de la transacción de escritura del llamador. Si entretanto otra importación
+    cambió la tabla (source_sha1 distinto) no hace nada: esos cambios aún no están en la instantánea.
+    """
+    cursor = conn.execute("UPDATE erp_imports SET snapshot_sha1 = source_sha1 WHERE table_name = ? AND source_sha1 = ?",
+                          (table_name, source_sha1))
+    if cursor.rowcount:
+        conn.execute(f"DELETE FROM {ERP_CHANGES_TABLE} WHERE table_name = ?", (table_name,))
+
+
+def is_import_current(conn, table_name, csv_path):
+    info = get_import_info(conn, table_name)
+    signature = _file_signature(csv_path)
+    if info is None or signature is None: return False
+    return (info['source_mtime_ns'], info['source_size']) == signature
+
+
+def _item_master_rows(chunk, columns):
+    chunk = chunk[chunk['Item_Code'].notna()]
+    chunk = chunk.astype(object).where(chunk.notna(), None)
+    return chunk[columns].itertuples(index=False, name=None), 0
+
+
+def _grn_rows(chunk, grn_column):
+    chunk = chunk[chunk[grn_column].notna() & chunk['Item_Code'].notna()]
+    quantities = pd.to_numeric(chunk['Quantity'], errors='coerce')
+    malformed_count = int(quantities.isna().sum())
+    quantities = np.trunc(quantities).astype('Int64').astype(object).where(quantities.notna(), None)
+    return zip(chunk[grn_column].tolist(), chunk['Item_Code'].tolist(), quantities.tolist()), malformed_count
+
+
+def _verify_source_file(csv_path, usecols):
+    # Lanza ValueError si el archivo no sirve: faltan columnas o termina en bytes NUL
+    # (Windows preasigna el tamaño final y rellena con ceros mientras copia)
+    header = pd.read_csv(csv_path, nrows=0, dtype=str)
+    missing = [column for column in usecols if column not in header.columns]
+    if missing:
+        raise ValueError(f"faltan columnas requeridas: {', '.join(missing)}")
+    with open(csv_path, 'rb') as f:
+        f.seek(max(0, os.path.getsize(csv_path) - TAIL_CHECK_BYTES))
+        if b'\x00' in f.read():
+            raise ValueError("el archivo termina en bytes NUL (copia incompleta)")
+
+
+def _verify_row_count(row_count, previous, min_row_ratio):
+    if row_count == 0:
+        raise ValueError("el archivo no tiene filas")
+    previous_rows = previous['row_count'] if previous else None
+    if previous_rows and min_row_ratio and row_count < previous_rows * min_row_ratio:
+        raise RowCountError(f"{row_count} filas frente a {previous_rows} de la importación anterior "
+                         f"(mínimo {min_row_ratio:.0%}); ¿archivo truncado?")
+
+
+def _table_columns(conn, table):
+    return [row[1] for row in conn.execute(f"PRAGMA table_info({_quote(table)})")]
+
+
+def _build_diff(cursor, table, staging, key_columns):
+    # temp.erp_diff: una fila por clave nueva/modificada (deleted = 0) o desaparecida (deleted = 1)
+    keys = ', '.join(_quote(column) for column in key_columns)
+    key_match = ' AND '.join(f"s.{_quote(column)} = t.{_quote(column)}" for column in key_columns)
+    cursor.execute("DROP TABLE IF EXISTS temp.erp_diff")
+    cursor.execute(f"CREATE TEMP TABLE erp_diff AS "
+                   f"SELECT {keys}, 0 AS deleted FROM "
+                   f"(SELECT * FROM {_quote(staging)} EXCEPT SELECT * FROM main.{_quote(table)}) "
+                   f"UNION ALL "
+                   f"SELECT {keys}, 1 FROM main.{_quote(table)} t "
+                   f"WHERE NOT EXISTS (SELECT 1 FROM {_quote(staging)} s WHERE {key_match})")
+    return cursor.execute("SELECT COUNT(*) FROM temp.erp_diff").fetchone()[0]
+
+
+def _apply_diff(cursor, table, staging, key_columns, apply_derived_changes):
+    keys = ', '.join(_quote(column) for column in key_columns)
+    def apply_rows():
+        cursor.execute(f"DELETE FROM main.{_quote(table)} "
+                       f"WHERE ({keys}) IN (SELECT {keys} FROM temp.erp_diff WHERE deleted = 1)")
+        cursor.execute(f"INSERT OR REPLACE INTO main.{_quote(table)} SELECT * FROM {_quote(staging)} "
+                       f"WHERE ({keys}) IN (SELECT {keys} FROM temp.erp_diff WHERE deleted = 0)")
+    if apply_derived_changes:
+        apply_derived_changes(cursor, table, apply_rows)
+    else:
+        apply_rows()
+    key2 = _quote(key_columns[1]) if len(key_columns) > 1 else "''"
+    cursor.execute(f"INSERT OR IGNORE INTO {ERP_CHANGES_TABLE} (table_name, key1, key2) "
+                   f"SELECT ?, {_quote(key_columns[0])}, {key2} FROM temp.erp_diff", (table,))
+
+
+def _import_csv(db_path, csv_path, table, usecols, key_columns, create_staging_sql, insert_sql, to_rows,
+                extra_index_sql=(), build_derived=None, apply_derived_changes=None, min_row_ratio=MIN_ROW_RATIO,
+                force=False):
+    # Con varios procesos (serve.py) todos detectan el CSV nuevo a la vez: uno importa y
+    # los demás esperan aquí y luego encuentran la importación ya hecha.
+    with interprocess_lock(f"{db_path}.{table}.import.lock"):
+        return _import_csv_locked(db_path, csv_path, table, usecols, key_columns, create_staging_sql, insert_sql,
+                                  to_rows, extra_index_sql, build_derived, apply_derived_changes, min_row_ratio, force)
+
+
+def _import_csv_locked(db_path, csv_path, table, usecols, key_columns, create_staging_sql, insert_sql, to_rows,
+                       extra_index_sql, build_derived, apply_derived_changes, min_row_ratio, force):
+    signature = _file_signature(csv_path)
+    if signature is None:
+        logger.warning("Import ERP: Archivo no encontrado en %s", csv_path)
+        return None
+    conn = sqlite3.connect(db_path, timeout=30)
+    staging = f"{table}__staging_{os.getpid()}"
+    try:
+        previous = get_import_info(conn, table)
+        if not force and is_import_current(conn, table, csv_path):
+            _rejections.pop(csv_path, None)
+            previous['skipped'] = True
+            return previous
+        start = time.perf_counter()
+        _verify_source_file(csv_path, usecols)
+        source_sha1 = file_sha1(csv_path)
+        if not force and previous and previous['source_sha1'] == source_sha1:
+            # Misma exportación copiada de nuevo: solo cambia la firma
+            with conn:
+                conn.execute("UPDATE erp_imports SET source_mtime_ns = ?, source_size = ? WHERE table_name = ?",
+                             (signature[0], signature[1], table))
+            logger.info("Import ERP: %s sin cambios de contenido; se conserva '%s'", os.path.basename(csv_path), table)
+            _rejections.pop(csv_path, None)
+            info = get_import_info(conn, table)
+            info['skipped'] = True
+            return info
+        cursor = conn.cursor()
+        cursor.execute(f"DROP TABLE IF EXISTS {_quote(staging)}")
+        cursor.execute(create_staging_sql(staging))
+        conn.commit()
+
+        row_count = 0
+        malformed_count = 0
+        reader = pd.read_csv(csv_path, usecols=usecols, dtype=str, keep_default_na=True, chunksize=CHUNK_SIZE)
+        for chunk in reader:
+            rows, chunk_malformed = to_rows(chunk)
+            cursor.executemany(insert_sql.format(table=_quote(staging)), rows)
+            row_count += len(chunk)
+            malformed_count += chunk_malformed
+            conn.commit()
+        if _file_signature(csv_path) != signature:
+            raise ValueError("el archivo cambió durante la lectura")
+        _verify_row_count(row_count, previous, None if force else min_row_ratio)
+
+        # Diferencias si la tabla actual salió de una importación de este formato; si no, reemplazo completo
+        delta = bool(not force and previous is not None and previous['delta_ready']
+                     and _table_columns(conn, table) == _table_columns(conn, staging))
+        if delta:
+            changed_rows = _build_diff(cursor, table, staging, key_columns)
+            derived_tables = []
+        else:
+            changed_rows = row_count
+            # Tablas derivadas (p. ej. el índice de búsqueda), también fuera del bloqueo de escritura
+            derived_tables = build_derived(cursor, staging) if build_derived else []
+
+        # Un solo COMMIT: los lectores ven la tabla anterior o la nueva, nunca una a medias
+        conn.isolation_level = None
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            if delta:
+                _apply_diff(cursor, table, staging, key_columns, apply_derived_changes)
+                snapshot_sha1 = previous['snapshot_sha1'] or previous['source_sha1']
+            else:
+                cursor.execute(f"DROP TABLE IF EXISTS {_quote(table)}")
+                cursor.execute(f"ALTER TABLE {_quote(staging)} RENAME TO {_quote(table)}")
+                for derived_staging, derived_table in derived_tables:
+                    cursor.execute(f"DROP TABLE IF EXISTS {_quote(derived_table)}")
+                    cursor.execute(f"ALTER TABLE {_quote(derived_staging)} RENAME TO {_quote(derived_table)}")
+                for sql in extra_index_sql:
+                    cursor.execute(sql)
+                cursor.execute(f"DELETE FROM {ERP_CHANGES_TABLE} WHERE table_name = ?", (table,))
+                snapshot_sha1 = source_sha1
+            elapsed = time.perf_counter() - start
+            imported_at = datetime.datetime.now().isoformat(timespec='seconds')
+            cursor.execute(
+                "INSERT OR REPLACE INTO erp_imports (table_name, source_file, source_mtime_ns, source_size, row_count, "
+                "malformed_count, imported_at, load_seconds, source_sha1, snapshot_sha1, import_mode, changed_rows, "
+                "delta_ready) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 1)",
+                (table, os.path.basename(csv_path), signature[0], signature[1], row_count, malformed_count,
+                 imported_at, elapsed, source_sha1, snapshot_sha1, 'delta' if delta else 'full', changed_rows))
+            cursor.execute("COMMIT")
+        except sqlite3.Error:
+            cursor.execute("ROLLBACK")
+            raise
+        if delta:
+            logger.info("Import ERP: %d filas de %s comparadas con '%s' en %.2f s; %d claves cambiadas",
+                        row_count, os.path.basename(csv_path), table, elapsed, changed_rows)
+        else:
+            logger.info("Import ERP: %d filas de %s importadas a '%s' en %.2f s",
+                        row_count, os.path.basename(csv_path), table, elapsed)
+        if malformed_count:
+            logger.warning("Import ERP: %d filas con cantidad inválida en '%s' (se guardan como NULL).", malformed_count, table)
+        _rejections.pop(csv_path, None)
+        info = get_import_info(conn, table)
+        info['skipped'] = False
+        return info
+    except ValueError as e:
+        logger.error("Import ERP: %s rechazado, se conservan los datos anteriores de '%s': %s",
+                     os.path.basename(csv_path), table, e)
+        _rejections[csv_path] = {'reason': str(e), 'row_count_check': isinstance(e, RowCountError),
+                                 'signature': signature,
+                                 'rejected_at': datetime.datetime.now().isoformat(timespec='seconds')}
+        return None
+    except (sqlite3.Error, OSError) as e:
+        logger.error("Import ERP Error (%s): %s", table, e)
+        return None
+    finally:
+        _drop_staging(conn, staging)
+        conn.close()
+
+
+def _drop_staging(conn, staging):
+    # El staging queda tras un rechazo o un refresco por diferencias (el reemplazo completo lo renombra)
+    try:
+        conn.isolation_level = ''
+        conn.execute(f"DROP TABLE IF EXISTS {_quote(staging)}")
+        conn.commit()
+    except sqlite3.Error:
+        pass
+
+
+def import_item_master(db_path, csv_path, columns, min_row_ratio=MIN_ROW_RATIO, force=False):
+    """Importa el maestro de artículos a 'item_master' (y su índice 'item_search') si el CSV cambió."""
+    if not force:
+        # Bases anteriores al índice de búsqueda: reimportar una vez para construirlo
+        conn = sqlite3.connect(db_path, timeout=30)
+        try:
+            force = fts5_trigram_available(conn) and not _table_exists(conn, ITEM_SEARCH_TABLE)
+        finally:
+            conn.close()
+    placeholders = ', '.join('?' for _ in columns)
+    insert_sql = f"INSERT OR IGNORE INTO {{table}} ({', '.join(_quote(c) for c in columns)}) VALUES ({placeholders})"
+    return _import_csv(
+        db_path, csv_path, ITEM_MASTER_TABLE, columns, ['Item_Code'],
+        lambda staging: _item_master_ddl(staging, columns), insert_sql,
+        lambda chunk: _item_master_rows(chunk, columns), build_derived=_build_item_search_staging,
+        apply_derived_changes=_apply_item_search_changes, min_row_ratio=min_row_ratio, force=force)
+
+
+def import_grn_lines(db_path, csv_path, columns, grn_column='GRN_Number', min_row_ratio=MIN_ROW_RATIO, force=False):
+    """Importa las líneas GRN a 'grn_lines' si el CSV cambió desde la última importación."""
+    insert_sql = "INSERT OR IGNORE INTO {table} (GRN_Number, Item_Code, Quantity) VALUES (?, ?, ?)"
+    return _import_csv(
+        db_path, csv_path, GRN_LINES_TABLE, columns, ['GRN_Number', 'Item_Code'],
+        _grn_lines_ddl, insert_sql, lambda chunk: _grn_rows(chunk, grn_column),
+        extra_index_sql=[f"CREATE INDEX IF NOT EXISTS idx_grn_lines_item ON {GRN_LINES_TABLE} (Item_Code)"],
+        min_row_ratio=min_row_ratio, force=force)
@@ -0,0 +1,205 @@
+import os
+import json
+import shutil
+import hashlib
+import logging
+from collections.abc import Mapping
+import numpy as np
+
+# --- Instantáneas columnares de las tablas del ERP ---
+# Cada tabla importada (item_master, grn_lines) se vuelca una vez a arrays NumPy en
+# disco: las claves ordenadas como bytes de ancho fijo (búsqueda binaria con
+# searchsorted) y cada columna de texto como offsets + bytes UTF-8 concatenados.
+# Los arrays se abren con mmap: arrancar cuesta milisegundos y varios procesos
+# comparten las mismas páginas en lugar de tener cada uno su dict de dicts.
+# El nombre de la instantánea sale del hash del CSV de origen (erp_imports.source_sha1).
+# Tras un refresco por diferencias se sigue usando la instantánea de la última importación
+# completa (erp_imports.snapshot_sha1) con las filas cambiadas encima (OverlayTable).
+SNAPSHOT_FORMAT_VERSION = 1
+KEY_SEPARATOR = '\x1f'  # Para claves compuestas, p. ej. (GRN, ítem)
+
+logger = logging.getLogger('inbound.erp_snapshot')
+
+
+def snapshot_key(import_info, columns):
+    source_id = import_info.get('source_sha1') or (
+        f"{import_info['source_mtime_ns']}:{import_info['source_size']}:{import_info['imported_at']}")
+    key_data = f"{SNAPSHOT_FORMAT_VERSION}|{import_info['table_name']}|{source_id}|{','.join(columns)}"
+    return hashlib.sha1(key_data.encode('utf-8')).hexdigest()[:20]
+
+
+def _encode_key(key):
+    if isinstance(key, tuple): key = KEY_SEPARATOR.join(key)
+    return key.encode('utf-8')
+
+
+def _encode_strings(values):
+    encoded = [(value if value is not None else '').encode('utf-8') for value in values]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(value) for value in encoded], out=offsets[1:])
+    return offsets, np.frombuffer(b''.join(encoded), dtype=np.uint8)
+
+
+def write_snapshot(folder, name, key, keys, columns):
+    """Escribe la instantánea 'name' con sus claves y columnas ({nombre: lista}).
+
+    Las columnas de enteros se guardan tal cual (int64); el resto como texto.
+    """
+    final_path = os.path.join(folder, f"{name}_{key}")
+    temp_path = f"{final_path}.tmp-{os.getpid()}"
+    shutil.rmtree(temp_path, ignore_errors=True)
+    os.makedirs(temp_path)
+    encoded_keys = [_encode_key(k) for k in keys]
+    key_array = np.array(encoded_keys, dtype=f"S{max((len(k) for k in encoded_keys), default=1) or 1}")
+    order = np.argsort(key_array, kind='stable')
+    np.save(os.path.join(temp_path, 'keys.npy'), key_array[order])
+    meta = {'name': name, 'rows': len(encoded_keys), 'columns': []}
+    order_list = order.tolist()
+    for i, (column, values) in enumerate(columns.items()):
+        values = [values[j] for j in order_list]
+        if all(isinstance(value, int) for value in values):
+            np.save(os.path.join(temp_path, f"col{i}.npy"), np.array(values, dtype=np.int64))
+            meta['columns'].append({'name': column, 'kind': 'int'})
+        else:
+            offsets, data = _encode_strings(values)
+            np.save(os.path.join(temp_path, f"col{i}.offsets.npy"), offsets)
+            np.save(os.path.join(temp_path, f"col{i}.data.npy"), data)
+            meta['columns'].append({'name': column, 'kind': 'text'})
+    with open(os.path.join(temp_path, 'meta.json'), 'w', encoding='utf-8') as f:
+        json.dump(meta, f)
+    try:
+        os.replace(temp_path, final_path)
+    except OSError:
+        # Otro proceso la escribió primero: es idéntica, se usa esa
+        shutil.rmtree(temp_path, ignore_errors=True)
+        if not os.path.isdir(final_path): raise
+
+
+def open_snapshot(folder, name, key, scalar_column=None):
+    """Abre la instantánea con mmap, o devuelve None si no existe."""
+    path = os.path.join(folder, f"{name}_{key}")
+    meta_path = os.path.join(path, 'meta.json')
+    if not os.path.exists(meta_path): return None
+    with open(meta_path, encoding='utf-8') as f:
+        meta = json.load(f)
+    keys = np.load(os.path.join(path, 'keys.npy'), mmap_mode='r')
+    columns = []
+    for i, column in enumerate(meta['columns']):
+        if column['kind'] == 'int':
+            columns.append((column['name'], np.load(os.path.join(path, f"col{i}.npy"), mmap_mode='r'), None))
+        else:
+            columns.append((column['name'], np.load(os.path.join(path, f"col{i}.offsets.npy"), mmap_mode='r'),
+                            np.load(os.path.join(path, f"col{i}.data.npy"), mmap_mode='r')))
+    return SnapshotTable(keys, columns, scalar_column=scalar_column)
+
+
+def remove_stale_snapshots(folder, name, keep_key):
+    prefix = f"{name}_"
+    for dir_entry in os.scandir(folder):
+        if not dir_entry.name.startswith(prefix) or dir_entry.name == f"{name}_{keep_key}": continue
+        # En Windows falla si otro proceso la tiene abierta; se borra en la próxima importación
+        shutil.rmtree(dir_entry.path, ignore_errors=True)
+
+
+def load_or_build(folder, name, import_info, columns, read_table, scalar_column=None):
+    """Devuelve la instantánea de la importación descrita por import_info, creándola si falta.
+
+    read_table() devuelve (claves, {columna: valores}) leídos de la tabla SQLite.
+    """
+    key = snapshot_key(import_info, columns)
+    table = open_snapshot(folder, name, key, scalar_column=scalar_column)
+    if table is not None: return table
+    os.makedirs(folder, exist_ok=True)
+    keys, column_values = read_table()
+    write_snapshot(folder, name, key, keys, column_values)
+    remove_stale_snapshots(folder, name, key)
+    logger.info("Instantánea %s: %d filas escritas (%s)", name, len(keys), key)
+    return open_snapshot(folder, name, key, scalar_column=scalar_column)
+
+
+class SnapshotTable(Mapping):
+    """Vista de solo lectura (clave -> fila) sobre los arrays mapeados de una instantánea.
+
+    Cada fila es un dict {columna: valor}, o solo el valor de scalar_column si se indica.
+    """
+
+    def __init__(self, keys, columns, scalar_column=None):
+        self._keys = keys
+        self._columns = columns
+        self._key_width = keys.dtype.itemsize
+        self._scalar = None
+        if scalar_column is not None:
+            self._scalar = next(column for column in columns if column[0] == scalar_column)
+
+    def _position(self, key):
+        encoded = _encode_key(key)
+        if len(encoded) > self._key_width or len(self._keys) == 0: return None
+        position = int(np.searchsorted(self._keys, encoded))
+        if position < len(self._keys) and self._keys[position] == encoded: return position
+        return None
+
+    @staticmethod
+    def _value(column, position):
+        _, values, data = column
+        if data is None: return int(values[position])
+        return data[values[position]:values[position + 1]].tobytes().decode('utf-8')
+
+    def get(self, key, default=None):
+        position = self._position(key)
+        if position is None: return default
+        if self._scalar is not None: return self._value(self._scalar, position)
+        return {column[0]: self._value(column, position) for column in self._columns}
+
+    def __getitem__(self, key):
+        value = self.get(key, self)
+        if value is self: raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self._position(key) is not None
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __iter__(self):
+        for encoded in self._keys:
+            key = encoded.decode('utf-8')
+            yield tuple(key.split(KEY_SEPARATOR)) if KEY_SEPARATOR in key else key
+
+    def with_changes(self, changes):
+        return OverlayTable(self, changes)
+
+
+class OverlayTable(Mapping):
+    """Instantánea con cambios superpuestos: changes es {clave: fila}, con None para las claves borradas."""
+
+    def __init__(self, base, changes):
+        self._base = base
+        self._changes = changes
+        added = sum(1 for key, row in changes.items() if row is not None and key not in base)
+        removed = sum(1 for key, row in changes.items() if row is None and key in base)
+        self._length = len(base) + added - removed
+
+    def get(self, key, default=None):
+        if key in self._changes:
+            row = self._changes[key]
+            return default if row is None else row
+        return self._base.get(key, default)
+
+    def __getitem__(self, key):
+        value = self.get(key, self)
+        if value is self: raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        if key in self._changes: return self._changes[key] is not None
+        return key in self._base
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        for key in self._base:
+            if key not in self._changes: yield key
+        for key, row in self._changes.items():
+            if row is not None: yield key
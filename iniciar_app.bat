@@ -39,8 +39,11 @@ REM Asegurate de que 'app.py' define una instancia de Flask llamada 'app'.
 REM Usamos 'python -m waitress' para mayor robustez.
 REM --host 0.0.0.0 permite conexiones desde otras maquinas en la red.
 REM --port=5000 define el puerto.
-echo Ejecutando: python -m waitress --host 0.0.0.0 --port=5000 app:app
-start "Backend Server (Waitress)" python -m waitress --host 0.0.0.0 --port=5000 app:app
+REM --threads=16: cada pantalla abierta mantiene una conexion /api/log_stream ocupando un hilo.
+REM Modo multiproceso (exportaciones sin frenar el registro): python serve.py --workers 4 --threads 16 --port 5000
+REM Modo ASGI (muchas pistolas a la vez, commits agrupados): python serve.py --server asgi --workers 2 --port 5000
+echo Ejecutando: python -m waitress --host 0.0.0.0 --port=5000 --threads=16 app:app
+start "Backend Server (Waitress)" python -m waitress --host 0.0.0.0 --port=5000 --threads=16 app:app
 
 echo.
 echo Esperando unos segundos para que el servidor Waitress se inicie completamente...
@@ -0,0 +1,94 @@
+import threading
+
+# --- Registro de métricas en memoria (formato de texto Prometheus) ---
+# Contadores e histogramas simples, seguros entre hilos, sin dependencias externas.
+# Las etiquetas se pasan como dict y se guardan como tupla ordenada.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_lock = threading.Lock()
+_counters = {}
+_histograms = {}
+_descriptions = {}
+
+
+def describe(name, metric_type, help_text):
+    """Registra el tipo ('counter', 'histogram', 'gauge') y la ayuda de una métrica."""
+    _descriptions[name] = (metric_type, help_text)
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items())) if labels else ()
+
+
+def inc(name, labels=None, amount=1):
+    key = (name, _label_key(labels))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+
+def observe(name, value, labels=None, buckets=LATENCY_BUCKETS):
+    key = (name, _label_key(labels))
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = {'buckets': buckets, 'counts': [0] * len(buckets), 'sum': 0.0, 'count': 0}
+        for i, upper_bound in enumerate(histogram['buckets']):
+            if value <= upper_bound:
+                histogram['counts'][i] += 1
+                break
+        histogram['sum'] += value
+        histogram['count'] += 1
+
+
+def counter_value(name, labels=None):
+    with _lock:
+        return _counters.get((name, _label_key(labels)), 0)
+
+
+def _escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(label_items):
+    if not label_items: return ''
+    return '{' + ','.join(f'{key}="{_escape_label_value(value)}"' for key, value in label_items) + '}'
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(round(value, 6))
+    return str(value)
+
+
+def render(gauges=None):
+    """Devuelve todas las métricas en formato de texto Prometheus.
+
+    gauges: lista opcional de (nombre, etiquetas, valor) calculados al momento de la consulta.
+    """
+    with _lock:
+        counters = dict(_counters)
+        histograms = {key: {'buckets': h['buckets'], 'counts': list(h['counts']), 'sum': h['sum'], 'count': h['count']}
+                      for key, h in _histograms.items()}
+    samples = {}
+    for (name, label_items), value in counters.items():
+        samples.setdefault(name, []).append(f"{name}{_format_labels(label_items)} {_format_value(value)}")
+    for (name, label_items), histogram in histograms.items():
+        lines = samples.setdefault(name, [])
+        cumulative = 0
+        for upper_bound, count in zip(histogram['buckets'], histogram['counts']):
+            cumulative += count
+            lines.append(f"{name}_bucket{_format_labels(label_items + (('le', upper_bound),))} {cumulative}")
+        lines.append(f"{name}_bucket{_format_labels(label_items + (('le', '+Inf'),))} {histogram['count']}")
+        lines.append(f"{name}_sum{_format_labels(label_items)} {_format_value(histogram['sum'])}")
+        lines.append(f"{name}_count{_format_labels(label_items)} {histogram['count']}")
+    for name, labels, value in gauges or []:
+        if value is None: continue
+        samples.setdefault(name, []).append(f"{name}{_format_labels(_label_key(labels))} {_format_value(value)}")
+
+    output = []
+    for name in sorted(samples):
+        metric_type, help_text = _descriptions.get(name, ('untyped', ''))
+        if help_text: output.append(f"# HELP {name} {help_text}")
+        output.append(f"# TYPE {name} {metric_type}")
+        output.extend(samples[name])
+    return '\n'.join(output) + '\n'
@@ -0,0 +1,124 @@
+import os
+import sys
+import time
+import socket
+import signal
+import threading
+import logging
+import argparse
+import multiprocessing
+
+# --- Servidor multiproceso ---
+# Un solo waitress corre todo bajo un mismo GIL: una exportación pesada frena el registro
+# de todos. Aquí el proceso principal prepara la base y los índices del ERP una vez, abre
+# el puerto y arranca N procesos waitress que aceptan conexiones del mismo socket.
+#   - Los índices del ERP son instantáneas mapeadas en memoria (erp_snapshot.py): los
+#     procesos comparten las páginas en lugar de tener cada uno su copia.
+#   - Las escrituras van a SQLite en modo WAL con BEGIN IMMEDIATE y reintentos
+#     (db_write_transaction), que ya coordina varios procesos.
+#   - Cada proceso genera sus exportaciones en su propio pool de procesos
+#     (INBOUND_EXPORT_PROCESSES), fuera de los hilos que atienden peticiones.
+#   - Con --server asgi cada proceso corre uvicorn con asgi.py: las conexiones las atiende
+#     asyncio y add_log/add_logs esperan el COMMIT agrupado sin ocupar hilos (--threads es
+#     entonces el tamaño del pool para el resto del trabajo bloqueante).
+# Uso: python serve.py --workers 4 --threads 16 --port 5000 [--server asgi]
+WORKER_RESTART_DELAY_SECONDS = 2
+WORKER_STOP_TIMEOUT_SECONDS = 10
+
+logger = logging.getLogger('inbound.serve')
+
+
+def _worker_main(listen_socket, threads, export_processes, server='waitress'):
+    # Se ejecuta en cada proceso hijo (contexto 'spawn', también en Windows)
+    os.environ['INBOUND_EXPORT_PROCESSES'] = str(export_processes)
+    # Si el proceso principal muere sin avisar (p. ej. TerminateProcess en Windows), salir también
+    parent = multiprocessing.parent_process()
+    threading.Thread(target=lambda: (parent.join(), os._exit(0)), name='parent-watch', daemon=True).start()
+    if server == 'asgi': os.environ['INBOUND_ASGI_THREADS'] = str(threads)
+    import app as inbound_app
+    # Solo la precarga de índices: archivo, purga y vigilancia del ERP corren en el proceso principal
+    inbound_app.start_background_tasks(singletons=False)
+    if server == 'asgi':
+        import uvicorn
+        import asgi
+        config = uvicorn.Config(asgi.application, lifespan='on', log_level='warning', access_log=False)
+        uvicorn.Server(config).run(sockets=[listen_socket])
+        return
+    from waitress import serve
+    serve(inbound_app.app, sockets=[listen_socket], threads=threads)
+
+
+def _start_worker(context, listen_socket, args, worker_number):
+    process = context.Process(target=_worker_main,
+                              args=(listen_socket, args.threads, args.export_processes, args.server),
+                              name=f"inbound-worker-{worker_number}")
+    process.start()
+    logger.info("Serve: Proceso %d iniciado (pid %d)", worker_number, process.pid)
+    return process
+
+
+def _stop_workers(processes):
+    for process in processes.values():
+        if process.is_alive(): process.terminate()
+    for process in processes.values():
+        process.join(WORKER_STOP_TIMEOUT_SECONDS)
+        if process.is_alive(): process.kill()
+
+
+def prepare_shared_state():
+    """Crea el esquema, importa los CSV del ERP y escribe sus instantáneas antes de arrancar los procesos.
+
+    Al importarse aquí, app.py arranca también los trabajos únicos (archivo, purga, vigilancia del ERP)."""
+    import app as inbound_app
+    inbound_app.get_csv_cache_index(inbound_app.item_master_cache)
+    inbound_app.get_csv_cache_index(inbound_app.grn_cache)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Servidor multiproceso de Registro Inbound (waitress).")
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--workers', type=int, default=min(4, os.cpu_count() or 1), help="Procesos waitress")
+    parser.add_argument('--threads', type=int, default=16, help="Hilos por proceso (cada /api/log_stream ocupa uno)")
+    parser.add_argument('--server', choices=['waitress', 'asgi'], default='waitress',
+                        help="waitress (hilos) o asgi (uvicorn + asyncio, ver asgi.py)")
+    parser.add_argument('--export-processes', type=int, default=1,
+                        help="Procesos para generar exportaciones, por proceso waitress (0 = en un hilo)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    prepare_shared_state()  # También configura el logger 'inbound'
+
+    listen_socket = socket.create_server((args.host, args.port), backlog=1024)
+    context = multiprocessing.get_context('spawn')
+    processes = {number: _start_worker(context, listen_socket, args, number) for number in range(1, args.workers + 1)}
+    logger.info("Serve: Escuchando en %s:%d con %d procesos %s x %d hilos",
+                args.host, args.port, args.workers, args.server, args.threads)
+
+    stopping = False
+    def request_stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+    signal.signal(signal.SIGTERM, request_stop)
+    try:
+        while not stopping:
+            time.sleep(1)
+            for number, process in processes.items():
+                if process.is_alive() or stopping: continue
+                logger.error("Serve: El proceso %d (pid %d) terminó con código %s; reiniciándolo",
+                             number, process.pid, process.exitcode)
+                time.sleep(WORKER_RESTART_DELAY_SECONDS)
+                processes[number] = _start_worker(context, listen_socket, args, number)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        logger.info("Serve: Deteniendo procesos...")
+        _stop_workers(processes)
+        listen_socket.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,6 +1,8 @@
 import os
+import logging
 import sqlite3
 import pandas as pd
+import erp_import
 
 # --- Configuración de Archivos (Debe coincidir con app.py) ---
 APP_ROOT = os.path.dirname(os.path.abspath(__file__))
@@ -8,6 +10,9 @@ DATABASE_FOLDER = os.path.join(APP_ROOT, 'databases')
 ITEM_MASTER_CSV_PATH = os.path.join(DATABASE_FOLDER, 'AURRSGLBD0250 - Item Stockroom Balance.csv')
 GRN_CSV_FILE_PATH = os.path.join(DATABASE_FOLDER, 'AURRSGLBD0280 - Stock In Goods Inwards And Inspection.csv')
 DB_FILE_PATH = os.path.join(APP_ROOT, 'inbound_log.db')
+COLUMNS_TO_READ_MASTER = ['Item_Code', 'Item_Description', 'Weight_per_Unit', 'Bin_1', 'Aditional_Bin_Location']
+GRN_COLUMN_NAME_IN_CSV = 'GRN_Number'
+COLUMNS_TO_READ_GRN = [GRN_COLUMN_NAME_IN_CSV, 'Item_Code', 'Quantity']
 # --- Fin Configuración ---
 
 def init_db():
@@ -42,6 +47,8 @@ def init_db():
         cursor.execute("CREATE INDEX IF NOT EXISTS idx_importRef_itemCode ON logs (importRef, itemCode)")
         print("Índice 'idx_importRef_itemCode' verificado/creado.")
         conn.commit()
+        erp_import.ensure_erp_tables(conn, COLUMNS_TO_READ_MASTER)
+        print("Tablas 'item_master', 'grn_lines' y 'erp_imports' verificadas/creadas.")
         conn.close()
         print(f"Base de datos SQLite inicializada correctamente.")
     except sqlite3.Error as e:
@@ -68,18 +75,35 @@ def create_example_csvs():
         # Verificar/Crear archivo GRN CSV de ejemplo
         if not os.path.exists(GRN_CSV_FILE_PATH):
              print(f"ADVERTENCIA: Archivo GRN no encontrado. Creando ejemplo en: {GRN_CSV_FILE_PATH}")
-             example_grn_df = pd.DataFrame({'Item_Code': ['BG1234567890123', 'FT9876543210987', 'ITEM_SIN_DETALLES'], 'Quantity': [1, 5, 10]})
+             example_grn_df = pd.DataFrame({
+                 GRN_COLUMN_NAME_IN_CSV: ['21044', '21044', '21048'],
+                 'Item_Code': ['BG1234567890123', 'FT9876543210987', 'ITEM_SIN_DETALLES'], 'Quantity': [1, 5, 10]
+             })
              example_grn_df.to_csv(GRN_CSV_FILE_PATH, index=False)
              print("Archivo GRN de ejemplo creado.")
     except Exception as e:
         print(f"Error creando archivos CSV de ejemplo: {e}")
 
+
+def import_erp_csvs():
+    """Importa los CSV del ERP a las tablas SQLite indexadas (solo si cambiaron)."""
+    master_info = erp_import.import_item_master(DB_FILE_PATH, ITEM_MASTER_CSV_PATH, COLUMNS_TO_READ_MASTER)
+    grn_info = erp_import.import_grn_lines(DB_FILE_PATH, GRN_CSV_FILE_PATH, COLUMNS_TO_READ_GRN,
+                                           grn_column=GRN_COLUMN_NAME_IN_CSV)
+    for info in (master_info, grn_info):
+        if info and info.get('skipped'):
+            print(f"Tabla '{info['table_name']}' ya está al día ({info['row_count']} filas).")
+
 # --- Ejecución del Script de Setup ---
 if __name__ == '__main__':
+    # Los mensajes del importador ERP van por 'logging'; en el setup se muestran tal cual por consola
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
     print("--- Iniciando Configuración ---")
     # 1. Inicializar la base de datos (crea carpeta si es necesario)
     init_db()
     # 2. Crear archivos CSV de ejemplo si no existen (opcional)
     create_example_csvs()
+    # 3. Importar los CSV del ERP a SQLite
+    import_erp_csvs()
     print("--- Configuración Completada ---")
 
@@ -0,0 +1,62 @@
+import os
+import sys
+import time
+import shutil
+
+import pandas as pd
+import pytest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_ROOT not in sys.path: sys.path.insert(0, REPO_ROOT)
+
+import benchmark
+
+# --- Entorno de pruebas ---
+# La app se copia a un directorio temporal (como benchmark.py) para que init_db, las
+# migraciones y el archivo no toquen inbound_log.db del checkout. Todas las pruebas comparten
+# ese proceso y esa base: cada una usa sus propios GRN para no pisarse.
+MASTER_ITEMS = ['IT001', 'IT002', 'IT003', 'IT004', 'IT005']
+GRN_LINES = [
+    ('G100', 'IT001', 10), ('G100', 'IT002', 5),
+    ('G200', 'IT001', 8),
+    ('G300', 'IT003', 20),
+    ('G400', 'IT004', 6),
+    ('G500', 'IT005', 4),
+]
+
+
+def write_erp_csvs(databases_dir):
+    pd.DataFrame({
+        'Item_Code': MASTER_ITEMS,
+        'Item_Description': [f"Descripción {code}" for code in MASTER_ITEMS],
+        'Weight_per_Unit': ['1 kg'] * len(MASTER_ITEMS),
+        'Bin_1': [f"A{index:03d}" for index in range(len(MASTER_ITEMS))],
+        'Aditional_Bin_Location': [''] * len(MASTER_ITEMS),
+    }).to_csv(os.path.join(databases_dir, benchmark.MASTER_CSV_NAME), index=False, encoding='utf-8')
+    pd.DataFrame(GRN_LINES, columns=['GRN_Number', 'Item_Code', 'Quantity']).to_csv(
+        os.path.join(databases_dir, benchmark.GRN_CSV_NAME), index=False, encoding='utf-8')
+
+
+@pytest.fixture(scope='session')
+def inbound(tmp_path_factory):
+    """Módulo app cargado desde una copia en un directorio temporal, con los índices del ERP listos."""
+    workdir = str(tmp_path_factory.mktemp('inbound'))
+    databases_dir = os.path.join(workdir, 'databases')
+    os.makedirs(databases_dir)
+    for name in benchmark.APP_FILES:
+        shutil.copy2(os.path.join(REPO_ROOT, name), os.path.join(workdir, name))
+    write_erp_csvs(databases_dir)
+    module = benchmark.load_app_module(workdir)
+    # La precarga de start_background_tasks corre en segundo plano: esperar a que termine
+    for cache in (module.item_master_cache, module.grn_cache):
+        deadline = time.monotonic() + 30
+        while (cache['index'] is None or cache['reloading']) and time.monotonic() < deadline:
+            time.sleep(0.05)
+        assert cache['index'] is not None
+    return module
+
+
+@pytest.fixture
+def client(inbound):
+    return inbound.app.test_client()
+
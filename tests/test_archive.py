@@ -0,0 +1,42 @@
+def _insert_log(inbound, timestamp, import_ref, item_code, quantity, qty_grn):
+    with inbound.db_write_transaction() as conn:
+        conn.execute("INSERT INTO logs (timestamp, importRef, waybill, itemCode, qtyReceived, qtyGrn) VALUES (?, ?, ?, ?, ?, ?)",
+                     (timestamp, import_ref, 'WB1', item_code, quantity, qty_grn))
+
+
+def _summary(inbound, import_ref, item_code):
+    row = inbound.get_db_connection().execute(
+        "SELECT rowCount, totalReceived FROM archive.log_archive_summary WHERE importRef = ? AND itemCode = ?",
+        (import_ref, item_code)).fetchone()
+    return tuple(row) if row else None
+
+
+def test_archive_moves_idle_grn_to_month_tables(client, inbound):
+    _insert_log(inbound, '2020-01-05T10:00:00', 'G500', 'IT005', 1, 4)
+    _insert_log(inbound, '2020-02-05T10:00:00', 'G500', 'IT005', 2, 4)
+
+    inbound.archive_logs_db()
+
+    conn = inbound.get_db_connection()
+    assert conn.execute("SELECT COUNT(*) FROM logs WHERE importRef = 'G500'").fetchone()[0] == 0
+    assert conn.execute("SELECT COUNT(*) FROM grn_item_totals WHERE importRef = 'G500'").fetchone()[0] == 0
+    assert conn.execute("SELECT COUNT(*) FROM archive.logs_2020_01 WHERE importRef = 'G500'").fetchone()[0] == 1
+    assert conn.execute("SELECT COUNT(*) FROM archive.logs_2020_02 WHERE importRef = 'G500'").fetchone()[0] == 1
+    assert _summary(inbound, 'G500', 'IT005') == (2, 3)
+    # Un escaneo nuevo del GRN archivado acumula sobre lo archivado
+    response = client.post('/api/add_log', json={'importRef': 'G500', 'waybill': 'WB2', 'itemCode': 'IT005', 'quantity': 1})
+    assert response.get_json()['entry']['difference'] == 3 + 1 - 4
+
+
+def test_archive_summary_survives_interrupted_run(inbound):
+    _insert_log(inbound, '2020-03-05T10:00:00', 'G600', 'IT001', 2, 0)
+    _insert_log(inbound, '2020-03-06T10:00:00', 'G600', 'IT001', 3, 0)
+    # Pasada cortada tras confirmar el archivo: el resumen ya sumó las filas, que siguen en 'logs'
+    where_sql, params = inbound._grn_refs_where(['G600'])
+    with inbound.db_write_transaction() as conn:
+        conn.execute(inbound.SQL_UPSERT_ARCHIVE_SUMMARY.format(where_sql=where_sql), params)
+
+    inbound.archive_logs_db()
+
+    assert _summary(inbound, 'G600', 'IT001') == (2, 5)
+    assert inbound.get_db_connection().execute("SELECT COUNT(*) FROM logs WHERE importRef = 'G600'").fetchone()[0] == 0
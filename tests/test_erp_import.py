@@ -0,0 +1,67 @@
+import os
+import sqlite3
+
+import pytest
+
+import erp_import
+
+COLUMNS = ['GRN_Number', 'Item_Code', 'Quantity']
+
+
+def _write_grn_csv(path, lines, mtime_ns):
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('GRN_Number,Item_Code,Quantity\n')
+        f.writelines(f"{grn},{item},{quantity}\n" for grn, item, quantity in lines)
+    os.utime(path, ns=(mtime_ns, mtime_ns))  # Firma distinta aunque el tamaño coincida
+
+
+@pytest.fixture
+def erp_db(tmp_path):
+    db_path = str(tmp_path / 'erp.db')
+    conn = sqlite3.connect(db_path)
+    erp_import.ensure_erp_tables(conn, ['Item_Code', 'Item_Description'])
+    conn.close()
+    return db_path, str(tmp_path / 'grn.csv')
+
+
+def _table(db_path, sql):
+    conn = sqlite3.connect(db_path)
+    try:
+        return sorted(conn.execute(sql).fetchall())
+    finally:
+        conn.close()
+
+
+def test_second_import_applies_only_changed_keys(erp_db):
+    db_path, csv_path = erp_db
+    lines = [(f"G{index // 10}", f"IT{index:03d}", index % 7 + 1) for index in range(100)]
+    _write_grn_csv(csv_path, lines, 1_000_000_000)
+    first = erp_import.import_grn_lines(db_path, csv_path, COLUMNS)
+    assert first['import_mode'] == 'full' and first['row_count'] == 100
+
+    changed = [line for line in lines if line[1] != 'IT005']                # desaparece
+    changed = [(grn, item, 50 if item == 'IT010' else quantity) for grn, item, quantity in changed]  # cambia
+    changed.append(('G99', 'IT999', 3))                                      # nueva
+    _write_grn_csv(csv_path, changed, 2_000_000_000)
+    second = erp_import.import_grn_lines(db_path, csv_path, COLUMNS)
+
+    assert second['import_mode'] == 'delta'
+    assert second['changed_rows'] == 3
+    assert _table(db_path, "SELECT GRN_Number, Item_Code, Quantity FROM grn_lines") == sorted(changed)
+    assert _table(db_path, "SELECT key1, key2 FROM erp_changes WHERE table_name = 'grn_lines'") == [
+        ('G0', 'IT005'), ('G1', 'IT010'), ('G99', 'IT999')]
+
+
+def test_much_smaller_file_is_rejected_unless_forced(erp_db):
+    db_path, csv_path = erp_db
+    lines = [(f"G{index // 10}", f"IT{index:03d}", 1) for index in range(100)]
+    _write_grn_csv(csv_path, lines, 1_000_000_000)
+    erp_import.import_grn_lines(db_path, csv_path, COLUMNS)
+
+    _write_grn_csv(csv_path, lines[:20], 2_000_000_000)
+    assert erp_import.import_grn_lines(db_path, csv_path, COLUMNS) is None
+    assert erp_import.get_rejection(csv_path)['row_count_check']
+
+    forced = erp_import.import_grn_lines(db_path, csv_path, COLUMNS, force=True)
+    assert forced['row_count'] == 20
+    assert erp_import.get_rejection(csv_path) is None
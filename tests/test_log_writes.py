@@ -0,0 +1,84 @@
+import io
+import datetime
+
+
+def _entry(import_ref, item_code, quantity, qty_grn, timestamp=None):
+    return {
+        'timestamp': timestamp or datetime.datetime.now().isoformat(timespec='seconds'),
+        'importRef': import_ref, 'waybill': 'WB1', 'itemCode': item_code, 'itemDescription': 'x',
+        'binLocation': 'A000', 'relocatedBin': '', 'qtyReceived': quantity, 'qtyGrn': qty_grn,
+    }
+
+
+def _pair_rows(inbound, import_ref, item_code):
+    return [dict(row) for row in inbound.get_db_connection().execute(
+        "SELECT * FROM logs WHERE importRef IS ? AND itemCode IS ? ORDER BY timestamp, id", (import_ref, item_code))]
+
+
+def _received(inbound, import_ref, item_code):
+    return inbound.get_db_connection().execute(inbound.SQL_SELECT_TOTAL_RECEIVED, (import_ref, item_code)).fetchone()[0]
+
+
+def test_group_commit_isolates_failed_request_in_its_savepoint(inbound):
+    broken = _entry('G100', 'IT001', 7, 10)
+    broken['timestamp'] = None  # timestamp NOT NULL: esta petición falla dentro de su SAVEPOINT
+    outcomes = inbound.save_log_entries_db([
+        ([_entry('G100', 'IT001', 2, 10)], [None]),
+        ([_entry('G100', 'IT001', 3, 10), broken], [None, None]),
+        ([_entry('G100', 'IT001', 4, 10)], [None]),
+    ])
+
+    assert isinstance(outcomes[1], Exception)
+    assert [saved['difference'] for saved, _ in outcomes[0]] == [2 - 10]
+    # La petición descartada no cuenta en la diferencia acumulada de las siguientes del grupo
+    assert [saved['difference'] for saved, _ in outcomes[2]] == [6 - 10]
+    assert [row['qtyReceived'] for row in _pair_rows(inbound, 'G100', 'IT001')] == [2, 4]
+    assert _received(inbound, 'G100', 'IT001') == 6
+
+
+def test_add_log_replays_idempotency_key(client, inbound):
+    scan = {'importRef': 'G200', 'waybill': 'WB9', 'itemCode': 'IT001', 'quantity': 3}
+    headers = {'Idempotency-Key': 'prueba-replay-1'}
+
+    first = client.post('/api/add_log', json=scan, headers=headers)
+    retry = client.post('/api/add_log', json=scan, headers=headers)
+    conflict = client.post('/api/add_log', json=dict(scan, quantity=4), headers=headers)
+
+    assert first.status_code == 201 and 'Idempotent-Replayed' not in first.headers
+    assert retry.status_code == 201 and retry.headers['Idempotent-Replayed'] == 'true'
+    assert retry.get_json()['entry'] == first.get_json()['entry']
+    assert conflict.status_code == 422
+    assert len(_pair_rows(inbound, 'G200', 'IT001')) == 1
+    assert first.get_json()['entry']['difference'] == 3 - 8
+
+
+def test_import_recomputes_differences_in_scan_order(client, inbound):
+    client.post('/api/add_log', json={'importRef': 'G300', 'waybill': 'WB1', 'itemCode': 'IT003', 'quantity': 2})
+    session = ("Timestamp,GRN 1.,Waybill,Item Code,Qty. Received\n"
+               "2020-01-01T08:00:00,G300,WB0,IT003,5\n"
+               "2020-01-01T09:00:00,G300,WB0,IT003,1\n")
+    response = client.post('/api/import_log', data={'file': (io.BytesIO(session.encode()), 'sesion.csv')},
+                           content_type='multipart/form-data')
+
+    assert response.status_code == 201
+    rows = _pair_rows(inbound, 'G300', 'IT003')
+    assert [row['qtyReceived'] for row in rows] == [5, 1, 2]
+    # Las filas importadas van antes del escaneo en vivo, que se recalcula con ellas
+    assert [row['difference'] for row in rows] == [5 - 20, 6 - 20, 8 - 20]
+
+
+def test_update_log_recomputes_following_rows(client, inbound):
+    for quantity in (1, 2, 3):
+        inbound.save_log_entries_db([([_entry('G400', 'IT004', quantity, 6, f"2024-05-0{quantity}T10:00:00")], [None])])
+    first, second, third = _pair_rows(inbound, 'G400', 'IT004')
+
+    response = client.put(f"/api/update_log/{second['id']}", json={'qtyReceived': 5, 'waybill': 'WB1', 'relocateBin': ''})
+
+    assert response.status_code == 200
+    body = response.get_json()
+    assert body['entry']['id'] == second['id']
+    # La edición lleva la hora actual: la fila pasa a ser el último escaneo de su par
+    assert [row['id'] for row in _pair_rows(inbound, 'G400', 'IT004')] == [first['id'], third['id'], second['id']]
+    assert [row['difference'] for row in _pair_rows(inbound, 'G400', 'IT004')] == [1 - 6, 4 - 6, 9 - 6]
+    assert [entry['id'] for entry in body['adjustedEntries']] == [third['id']]
+    assert _received(inbound, 'G400', 'IT004') == 9